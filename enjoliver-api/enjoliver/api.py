@@ -5,6 +5,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from werkzeug.contrib.cache import FileSystemCache
 
+from enjoliver import matchbox
 from enjoliver.app import create_app
 from enjoliver.routes import register_routes
 from enjoliver.configs import EnjoliverConfig
@@ -22,8 +23,13 @@ def gunicorn():
         name='enjoliver-api',
         ec=ec,
     )
-    registry = RepositoryRegistry(sess_maker)
-    register_routes(app=app, ec=ec, cache=cache, sess_maker=sess_maker, registry=registry)
+    registry = RepositoryRegistry(sess_maker, state_flush_interval=ec.machine_state_flush_interval,
+                                  state_flush_size=ec.machine_state_flush_size,
+                                  state_history_days=ec.machine_state_history_days,
+                                  overview_delta_overlap=ec.overview_delta_overlap)
+    matchbox_session = matchbox.new_session(ec)
+    register_routes(app=app, ec=ec, cache=cache, sess_maker=sess_maker, registry=registry,
+                    matchbox_session=matchbox_session)
     return app
 
 
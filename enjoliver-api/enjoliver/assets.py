@@ -0,0 +1,264 @@
+"""
+Serve the matchbox assets (kernel, initrd, CoreOS images) through the API
+"""
+import hashlib
+import logging
+import os
+import time
+
+import requests
+from flask import Response
+from werkzeug.wsgi import wrap_file
+
+logger = logging.getLogger(__name__)
+
+# Headers of the client (iPXE, coreos-install) forwarded to matchbox
+FORWARDED_REQUEST_HEADERS = ["Range", "If-Range", "If-None-Match", "If-Modified-Since"]
+
+# Headers of matchbox forwarded back to the client
+FORWARDED_RESPONSE_HEADERS = ["Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified"]
+
+
+def select_headers(headers, names: list):
+    """
+    Keep only the given header names, case insensitive
+    :param headers: dict like
+    :param names: list of header names
+    :return: dict
+    """
+    return {k: headers[k] for k in names if headers.get(k) is not None}
+
+
+def stream_upstream(matchbox_session: requests.Session, url: str, request_headers, chunk_size: int):
+    """
+    Proxy the url by passing the chunks to the client as soon as they arrive
+    The memory used by a request is bounded by the chunk_size, no matter how big is the asset
+    :param matchbox_session: the HTTP session to matchbox
+    :param url: the matchbox url of the asset
+    :param request_headers: the headers of the client request
+    :param chunk_size: size in bytes of each chunk read from matchbox
+    :return: flask.Response
+    """
+    upstream = matchbox_session.get(
+        url, headers=select_headers(request_headers, FORWARDED_REQUEST_HEADERS), stream=True)
+    return relay_upstream(upstream, chunk_size)
+
+
+def relay_upstream(upstream: requests.Response, chunk_size: int):
+    """
+    Pass the chunks of a streamed matchbox response to the client as soon as they arrive, with its status
+    :param upstream: the matchbox response opened with stream=True, closed at the end of the relay
+    :param chunk_size: size in bytes of each chunk read from matchbox
+    :return: flask.Response
+    """
+
+    def generate():
+        try:
+            for chunk in upstream.iter_content(chunk_size=chunk_size):
+                yield chunk
+        finally:
+            upstream.close()
+
+    resp = Response(generate(), status=upstream.status_code, mimetype="application/octet-stream")
+    resp.headers.extend(select_headers(upstream.headers, FORWARDED_RESPONSE_HEADERS))
+    logger.debug("streaming %s status: %d" % (upstream.url, upstream.status_code))
+    return resp
+
+
+class AssetCache:
+    """
+    Local on-disk cache of the matchbox assets
+    The assets are immutable files (kernel, initrd, CoreOS images) so a PXE boot storm can be served with one upstream
+    transfer per file, the hits are sent zero-copy with the wsgi.file_wrapper of the WSGI server
+
+    Each file of the cache is named by the digest of the asset path and its upstream validator (ETag or
+    Last-Modified / Content-Length). The mtime of the files is touched on each hit to evict them by LRU order
+    The directory can be shared across the gunicorn workers: files are filled under a '.part' name and then renamed
+    """
+    part_suffix = ".part"
+    # a '.part' file older than this is considered as abandoned by a dead worker
+    stale_part_seconds = 600
+
+    def __init__(self, matchbox_session: requests.Session, cache_dir: str, max_bytes: int, revalidate_seconds: int,
+                 chunk_size: int):
+        """
+        :param matchbox_session: the HTTP session to matchbox
+        :param cache_dir: directory of the cached files
+        :param max_bytes: budget in bytes of the cache directory
+        :param revalidate_seconds: delay before asking matchbox again if an asset changed
+        :param chunk_size: size in bytes of each chunk read from matchbox
+        """
+        self.matchbox_session = matchbox_session
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self.chunk_size = chunk_size
+        # in memory per worker: path -> (digest, response headers, last check)
+        self._validators = dict()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _blob_path(self, digest: str):
+        return os.path.join(self.cache_dir, digest)
+
+    def _validate(self, path: str, url: str):
+        """
+        Get the validator of the asset, matchbox is asked at most every revalidate_seconds
+        :param path: path of the asset
+        :param url: the matchbox url of the asset
+        :return: (digest, headers) or None if the asset cannot be cached
+        """
+        now = time.time()
+        entry = self._validators.get(path)
+        if entry is not None and now - entry[2] < self.revalidate_seconds:
+            return entry[0], entry[1]
+
+        upstream = self.matchbox_session.head(url)
+        upstream.close()
+        headers = select_headers(upstream.headers, ["ETag", "Last-Modified", "Content-Length"])
+        if upstream.status_code != 200 or ("ETag" not in headers and "Last-Modified" not in headers):
+            logger.debug("not cacheable %s status: %d headers: %s" % (url, upstream.status_code, headers))
+            self._validators.pop(path, None)
+            return None
+
+        validator = "%s\n%s\n%s\n%s" % (
+            path, headers.get("ETag", ""), headers.get("Last-Modified", ""), headers.get("Content-Length", ""))
+        digest = hashlib.sha256(validator.encode()).hexdigest()
+        self._validators[path] = (digest, headers, now)
+        return digest, headers
+
+    def _serve_blob(self, blob_path: str, headers: dict, request):
+        """
+        Serve a cached file with the wsgi.file_wrapper and answer the conditional and Range requests
+        """
+        f = open(blob_path, "rb")
+        size = os.fstat(f.fileno()).st_size
+        resp = Response(wrap_file(request.environ, f, self.chunk_size), mimetype="application/octet-stream",
+                        direct_passthrough=True)
+        resp.headers["Content-Length"] = size
+        resp.headers.extend(select_headers(headers, ["ETag", "Last-Modified"]))
+        return resp.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+
+    def _acquire_part(self, part_path: str):
+        """
+        Only one worker fills a given file, the others are proxying matchbox meanwhile
+        :return: file descriptor or None if the file is already filled by someone else
+        """
+        try:
+            if time.time() - os.stat(part_path).st_mtime > self.stale_part_seconds:
+                logger.warning("removing stale %s" % part_path)
+                os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+        try:
+            return os.open(part_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+
+    def _fill(self, url: str, blob_path: str, request):
+        """
+        Stream the asset to the client and write it in the cache at the same time
+        """
+        part_path = blob_path + self.part_suffix
+        fd = self._acquire_part(part_path)
+        if fd is None:
+            logger.debug("%s already filling, proxying %s" % (part_path, url))
+            return stream_upstream(self.matchbox_session, url, request.headers, self.chunk_size)
+
+        try:
+            upstream = self.matchbox_session.get(url, stream=True)
+        except Exception:
+            os.close(fd)
+            os.remove(part_path)
+            raise
+
+        if upstream.status_code != 200:
+            os.close(fd)
+            os.remove(part_path)
+            return relay_upstream(upstream, self.chunk_size)
+
+        expected_size = upstream.headers.get("Content-Length")
+
+        def generate():
+            complete = False
+            size = 0
+            try:
+                with os.fdopen(fd, "wb") as part:
+                    for chunk in upstream.iter_content(chunk_size=self.chunk_size):
+                        part.write(chunk)
+                        size += len(chunk)
+                        yield chunk
+                complete = expected_size is None or int(expected_size) == size
+            finally:
+                upstream.close()
+                if complete:
+                    os.rename(part_path, blob_path)
+                    logger.info("cached %s as %s" % (url, blob_path))
+                    self.evict()
+                else:
+                    logger.warning("abort caching %s" % url)
+                    os.remove(part_path)
+
+        resp = Response(generate(), status=200, mimetype="application/octet-stream")
+        resp.headers.extend(select_headers(upstream.headers, FORWARDED_RESPONSE_HEADERS))
+        return resp
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits in its byte budget
+        :return: number of removed files
+        """
+        blobs = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.part_suffix):
+                continue
+            try:
+                st = os.stat(self._blob_path(name))
+            except FileNotFoundError:
+                continue
+            blobs.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        removed = 0
+        blobs.sort()
+        for mtime, size, name in blobs:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._blob_path(name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info("evicted %s of %d bytes" % (name, size))
+
+        return removed
+
+    def serve(self, path: str, url: str, request):
+        """
+        Serve the asset from the cache, fill the cache on a miss
+        :param path: path of the asset
+        :param url: the matchbox url of the asset
+        :param request: the flask request
+        :return: flask.Response
+        """
+        validated = self._validate(path, url)
+        if validated is None:
+            return stream_upstream(self.matchbox_session, url, request.headers, self.chunk_size)
+
+        digest, headers = validated
+        blob_path = self._blob_path(digest)
+        try:
+            os.utime(blob_path)
+            logger.debug("hit %s -> %s" % (path, blob_path))
+            return self._serve_blob(blob_path, headers, request)
+        except FileNotFoundError:
+            pass
+
+        # a partial content cannot fill the cache
+        if request.method != "GET" or request.headers.get("Range") is not None:
+            return stream_upstream(self.matchbox_session, url, request.headers, self.chunk_size)
+
+        logger.debug("miss %s -> %s" % (path, blob_path))
+        return self._fill(url, blob_path, request)
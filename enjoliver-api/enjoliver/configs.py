@@ -62,6 +62,11 @@ class EnjoliverConfig:
         # self.matchbox_path = self.config_override("matchbox_path", "%s/matchbox" % PROJECT_PATH)
         self.matchbox_path = self.config_override("matchbox_path", "%s/matchbox" % '/usr/local/')
         self.matchbox_assets = self.config_override("matchbox_assets", "%s/assets" % self.matchbox_path)
+        # Pool of keep-alive connections of each API worker to matchbox
+        self.matchbox_pool_size = int(self.config_override("matchbox_pool_size", 10))
+        self.matchbox_connect_timeout = float(self.config_override("matchbox_connect_timeout", 3))
+        self.matchbox_read_timeout = float(self.config_override("matchbox_read_timeout", 30))
+        self.matchbox_retries = int(self.config_override("matchbox_retries", 2))
         # For Health check
         self.matchbox_urls = self.config_override("matchbox_urls", [
             "/",
@@ -71,6 +76,16 @@ class EnjoliverConfig:
             "/metadata"
         ])
 
+        # Assets proxied from matchbox by chunks of bytes
+        self.assets_chunk_size = int(self.config_override("assets_chunk_size", 64 * 1024))
+        # Local on-disk cache of the assets, disabled with a budget of 0 bytes
+        self.assets_cache_dir = self.config_override(
+            "assets_cache_dir",
+            '%s/assets_cache' % os.path.dirname(os.path.abspath(__file__))
+        )
+        self.assets_cache_max_bytes = int(self.config_override("assets_cache_max_bytes", 0))
+        self.assets_cache_revalidate_sec = int(self.config_override("assets_cache_revalidate_sec", 60))
+
         # Databases
         self.db_uri = self.config_override("db_uri", 'postgresql://')
         self.ignition_journal_dir = self.config_override(
@@ -124,9 +139,29 @@ class EnjoliverConfig:
         # App cache level
         self.sync_cache_ttl = int(self.config_override("sync_cache_ttl", 0))
 
+        # Groups rendered and written concurrently by the sync, 1 to write them one after another
+        self.sync_workers = int(self.config_override("sync_workers", 1))
+        # Processes instead of threads for the sync workers, the rendering isn't bound by the GIL
+        self.sync_workers_processes = self.config_override("sync_workers_processes", False)
+
         # Notify in Sync
         self.sync_notify_ttl = int(self.config_override("sync_notify_ttl", 60))
 
+        # Ignition rendered by matchbox kept by the API
+        self.ignition_cache_ttl = int(self.config_override("ignition_cache_ttl", 300))
+
+        # Machines by transaction in POST /discovery/batch, 0 for a single transaction
+        self.discovery_batch_chunk_size = int(self.config_override("discovery_batch_chunk_size", 100))
+
+        # Write-behind of the machine states, 0 to write each state in its own transaction
+        # /ui/view/states only flushes the buffer of its worker, the states of the other ones lag up to this interval
+        self.machine_state_flush_interval = float(self.config_override("machine_state_flush_interval", 0))
+        self.machine_state_flush_size = int(self.config_override("machine_state_flush_size", 500))
+        # Days of state transitions kept for /ui/view/states/transitions, 0 to keep them forever
+        self.machine_state_history_days = int(self.config_override("machine_state_history_days", 30))
+        # Seconds between the refresh of a machine_overview row and its commit, sent again by /ui/view/machine?since
+        self.overview_delta_overlap = int(self.config_override("overview_delta_overlap", 30))
+
         # Application config
         self.kubernetes_apiserver_insecure_port = int(self.config_override(
             "kubernetes_apiserver_insecure_port", 8080)
@@ -214,6 +249,13 @@ class EnjoliverConfig:
         logger.debug('configs file: %s for %s', yaml_full_path, importer)
 
         self.discovery_fqdn_verify = self.config_override("discovery_fqdn_verify", True)
+        # Verify the fqdn in background and patch the interfaces later
+        self.discovery_fqdn_deferred = self.config_override("discovery_fqdn_deferred", False)
+        self.discovery_dns_ttl = int(self.config_override("discovery_dns_ttl", 300))
+        self.discovery_dns_negative_ttl = int(self.config_override("discovery_dns_negative_ttl", 30))
+        self.discovery_dns_workers = int(self.config_override("discovery_dns_workers", 8))
+        self.discovery_dns_deadline = float(self.config_override("discovery_dns_deadline", 2))
+        self.discovery_dns_tries = int(self.config_override("discovery_dns_tries", 3))
         self.sync_replace_ip_by_fqdn = self.config_override("sync_replace_ip_by_fqdn", False)
 
     def items(self):
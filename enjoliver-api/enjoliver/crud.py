@@ -5,12 +5,13 @@ Over the application Model, queries to the database
 import datetime
 import logging
 
-from sqlalchemy.orm import sessionmaker, Session, joinedload
+from sqlalchemy.orm import sessionmaker, Session, joinedload, selectinload
 
 from enjoliver.db import session_commit
 from enjoliver import tools
 from enjoliver.model import MachineInterface, Machine, Schedule, ScheduleRoles, LifecycleIgnition, \
     LifecycleCoreosInstall, LifecycleRolling
+from enjoliver.repositories import machine_overview, read_models
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +52,8 @@ class InjectLifecycle:
             lifecycle.up_to_date = up_to_date
             lifecycle.updated_date = now
 
+        machine_overview.update(self.session, self.machine.id, last_report=lifecycle.updated_date,
+                                up_to_date=lifecycle.up_to_date, last_change=lifecycle.last_change_date)
         self.session.commit()
 
     def refresh_lifecycle_coreos_install(self, success: bool):
@@ -83,6 +86,8 @@ class InjectLifecycle:
             lifecycle.strategy = strategy
             lifecycle.updated_date = datetime.datetime.utcnow()
 
+        machine_overview.update(self.session, self.machine.id,
+                                update_strategy=lifecycle.strategy if lifecycle.enable else "Disable")
         self.session.commit()
 
 
@@ -107,23 +112,8 @@ class FetchLifecycle:
                 return None
 
     def get_all_updated_status(self):
-        status = []
         with session_commit(sess_maker=self.sess_maker) as session:
-            for machine in session.query(Machine)\
-                    .join(LifecycleIgnition)\
-                    .join(MachineInterface)\
-                    .filter(MachineInterface.as_boot == True):
-
-                status.append({
-                    "up-to-date": machine.lifecycle_ignition[0].up_to_date,
-                    "fqdn": machine.interfaces[0].fqdn,
-                    "mac": machine.interfaces[0].mac,
-                    "cidrv4": machine.interfaces[0].cidrv4,
-                    "created_date": machine.created_date,
-                    "updated_date": machine.updated_date,
-                    "last_change_date": machine.lifecycle_ignition[0].last_change_date,
-                })
-        return status
+            return list(read_models.ignition_status(session))
 
     def get_coreos_install_status(self, mac: str):
         with session_commit(sess_maker=self.sess_maker) as session:
@@ -138,22 +128,8 @@ class FetchLifecycle:
                 return None
 
     def get_all_coreos_install_status(self):
-        life_status_list = []
         with session_commit(sess_maker=self.sess_maker) as session:
-            for machine in session.query(Machine)\
-                    .join(LifecycleCoreosInstall)\
-                    .join(MachineInterface)\
-                    .filter(MachineInterface.as_boot == True):
-
-                life_status_list.append({
-                    "mac": machine.interfaces[0].mac,
-                    "fqdn": machine.interfaces[0].fqdn,
-                    "cidrv4": machine.interfaces[0].cidrv4,
-                    "success": machine.lifecycle_coreos_install[0].success,
-                    "created_date": machine.lifecycle_coreos_install[0].created_date,
-                    "updated_date": machine.lifecycle_coreos_install[0].updated_date
-                })
-        return life_status_list
+            return list(read_models.coreos_install_status(session))
 
     def get_rolling_status(self, mac: str):
         with session_commit(sess_maker=self.sess_maker) as session:
@@ -171,26 +147,8 @@ class FetchLifecycle:
             return None, None
 
     def get_all_rolling_status(self):
-        life_roll_list = []
         with session_commit(sess_maker=self.sess_maker) as session:
-            for machine in session.query(Machine) \
-                    .join(LifecycleRolling) \
-                    .join(MachineInterface) \
-                    .options(joinedload("interfaces")) \
-                    .options(joinedload("lifecycle_rolling")) \
-                    .filter(MachineInterface.as_boot == True):
-                try:
-                    life_roll_list.append({
-                        "mac": machine.interfaces[0].mac,
-                        "fqdn": machine.interfaces[0].fqdn,
-                        "cidrv4": machine.interfaces[0].cidrv4,
-                        "enable": bool(machine.lifecycle_rolling[0].enable),
-                        "created_date": machine.lifecycle_rolling[0].created_date,
-                        "updated_date": machine.lifecycle_rolling[0].updated_date
-                    })
-                except IndexError:
-                    pass
-        return life_roll_list
+            return list(read_models.rolling_status(session))
 
 
 class BackupExport:
@@ -259,18 +217,28 @@ class BackupExport:
             }
         }
 
-    def get_playbook(self):
+    def iter_playbook(self):
         """
-        Get and reproduce the data sent inside the db from an API level
-        :return:
+        Get and reproduce the data sent inside the db from an API level, entry by entry
+        The machines are read by batches of read_models.batch_size with their interfaces and disks
+        :return: generator of dict
         """
-        playbook = []
         with session_commit(sess_maker=self.sess_maker) as session:
             for schedule_type in [ScheduleRoles.kubernetes_control_plane, ScheduleRoles.kubernetes_node]:
-                for machine in session.query(Machine).filter(Machine.schedules.any(Schedule.role == schedule_type)):
+                query = session.query(Machine) \
+                    .options(selectinload("interfaces")) \
+                    .options(selectinload("disks")) \
+                    .filter(Machine.schedules.any(Schedule.role == schedule_type)) \
+                    .order_by(Machine.id)
+                for machine in query.yield_per(read_models.batch_size):
                     discovery_data = self._construct_discovery(machine)
                     schedule_data = self._construct_schedule(discovery_data["boot-info"]["mac"], schedule_type)
-                    playbook.append({"data": discovery_data, "route": "/discovery"})
-                    playbook.append({"data": schedule_data, "route": "/scheduler"})
+                    yield {"data": discovery_data, "route": "/discovery"}
+                    yield {"data": schedule_data, "route": "/scheduler"}
 
-        return playbook
+    def get_playbook(self):
+        """
+        Get and reproduce the data sent inside the db from an API level
+        :return: list of dict
+        """
+        return list(self.iter_playbook())
@@ -1,9 +1,11 @@
+import difflib
+import hashlib
 import json
 import logging
 import os
 import re
-
-import deepdiff
+import tempfile
+import threading
 
 from enjoliver.configs import EnjoliverConfig
 
@@ -54,12 +56,128 @@ class Generator:
         self.profile.dump()
         self.group.dump()
 
+    def digests(self):
+        """
+        :return: the digests of the profile and the group content on disk, available after dumps()
+        """
+        return self.profile.digest, self.group.digest
+
+
+class MatchboxStore:
+    """
+    Writer of the groups / profiles of a matchbox directory
+    Each file is written in a staging directory of the same filesystem then moved over its target by os.replace:
+    matchbox never reads a partial file. The fsync of the written files are batched by commit, which replaces the
+    generation manifest once they are on disk.
+    """
+    staging_dir = ".staging"
+    manifest_file = "generation.json"
+    # matchbox path -> MatchboxStore, shared by the generators of the process
+    _stores = dict()
+    _stores_lock = threading.Lock()
+
+    def __init__(self, matchbox_path: str):
+        """
+        :param matchbox_path: /var/lib/matchbox
+        """
+        self.matchbox_path = matchbox_path
+        self.manifest_path = os.path.join(matchbox_path, self.manifest_file)
+        self._staging = os.path.join(matchbox_path, self.staging_dir)
+        # files replaced since the last commit
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, matchbox_path: str):
+        """
+        :param matchbox_path: /var/lib/matchbox
+        :return: the MatchboxStore of the directory
+        """
+        key = os.path.abspath(matchbox_path)
+        with cls._stores_lock:
+            store = cls._stores.get(key)
+            if store is None:
+                store = cls._stores[key] = MatchboxStore(key)
+            return store
+
+    def write(self, file_path: str, content: str, fsync=False):
+        """
+        Replace the file by the content
+        :param file_path: the target inside the matchbox directory
+        :param content: the whole content of the file
+        :param fsync: fsync the content before the replace instead of during the next commit
+        :return: None
+        """
+        os.makedirs(self._staging, exist_ok=True)
+        fd, staged = tempfile.mkstemp(dir=self._staging, suffix=".json")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.chmod(staged, 0o644)
+            os.replace(staged, file_path)
+        except Exception:
+            if os.path.exists(staged):
+                os.remove(staged)
+            raise
+        if not fsync:
+            self.track(file_path)
+
+    def track(self, file_path: str):
+        """
+        Add a file replaced by another process to the next commit
+        :param file_path: the target inside the matchbox directory
+        :return: None
+        """
+        with self._lock:
+            self._pending.add(os.path.abspath(file_path))
+
+    @staticmethod
+    def _fsync(path: str):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def commit(self, manifest: dict):
+        """
+        fsync the files replaced since the last commit and their directories, then replace the manifest
+        A reader finding the files listed with their digest in the manifest knows they are from the same generation
+        :param manifest: content of the generation manifest
+        :return: number of fsynced files
+        """
+        with self._lock:
+            pending, self._pending = self._pending, set()
+
+        directories = {self.matchbox_path}
+        nb = 0
+        for file_path in sorted(pending):
+            try:
+                self._fsync(file_path)
+            except FileNotFoundError:
+                continue
+            directories.add(os.path.dirname(file_path))
+            nb += 1
+
+        self.write(self.manifest_path, json.dumps(manifest, indent=2, sort_keys=True), fsync=True)
+        for directory in sorted(directories):
+            self._fsync(directory)
+        logger.debug("committed %d files with the manifest %s" % (nb, self.manifest_path))
+        return nb
+
 
 class GenerateCommon:
     """
     Common set of methods used to generate groups and profiles
     """
     _target_data = None
+    # sha256 of the content on disk, set by dump
+    digest = None
+    # file path -> (stat key, sha256) of the files written or read by the process
+    _disk_digests = dict()
 
     def generate(self):
         raise NotImplementedError()
@@ -74,26 +192,52 @@ class GenerateCommon:
         self.generate()
         return json.dumps(self._target_data, indent=indent, sort_keys=True)
 
-    def dump(self):
-        file_path = "%s/%s.json" % (self.target_path, self.target_data["id"])
+    @staticmethod
+    def _stat_key(file_path: str):
+        st = os.stat(file_path)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    @classmethod
+    def _disk_digest(cls, file_path: str):
+        """
+        The digest of a file is kept in memory while its inode, size and modification time are unchanged
+        :param file_path: the JSON file
+        :return: sha256 of the file content, None if the file isn't readable
+        """
         try:
-            with open(file_path, 'r') as f:
-                on_disk = json.loads(f.read())
-        except Exception as e:
-            logger.warning("get data of %s raise: %s" % (file_path, e))
-            on_disk = dict()
+            key = cls._stat_key(file_path)
+            cached = cls._disk_digests.get(file_path)
+            if cached and cached[0] == key:
+                return cached[1]
+            with open(file_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError as e:
+            logger.warning("get digest of %s raise: %s" % (file_path, e))
+            return None
+        cls._disk_digests[file_path] = key, digest
+        return digest
 
+    def dump(self):
+        """
+        Write the rendered content if the digest of the file on disk is different
+        :return: True if the file is written
+        """
         render = self.render()
-        diff = deepdiff.DeepDiff(self._target_data, on_disk, ignore_order=True)
-        if not diff:
+        file_path = "%s/%s.json" % (self.target_path, self._target_data["id"])
+        self.digest = hashlib.sha256(render.encode()).hexdigest()
+        on_disk = self._disk_digest(file_path)
+        if on_disk == self.digest:
             logger.debug("no diff: %s" % file_path)
             return False
 
-        if on_disk:
-            logger.info("diff on %s: %s" % (file_path, diff))
+        if on_disk is not None and logger.isEnabledFor(logging.DEBUG):
+            with open(file_path, 'r') as f:
+                previous = f.read()
+            logger.debug("diff on %s:\n%s" % (file_path, "".join(difflib.unified_diff(
+                previous.splitlines(True), render.splitlines(True), file_path, file_path))))
 
-        with open(file_path, "w") as fd:
-            fd.write(render)
+        MatchboxStore.of(os.path.dirname(self.target_path)).write(file_path, render)
+        self._disk_digests[file_path] = self._stat_key(file_path), self.digest
         logger.info("replaced: %s" % file_path)
         return True
 
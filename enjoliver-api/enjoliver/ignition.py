@@ -0,0 +1,105 @@
+"""
+Cache of the ignition configurations rendered by matchbox
+"""
+import hashlib
+import json
+import logging
+
+import requests
+from werkzeug.contrib.cache import BaseCache
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_digest(ignition) -> str:
+    """
+    Stable digest of an ignition configuration, independent of the keys order and the indentation
+    The nodes compute the same with: jq -cS . coreos-install.json | tr -d '\\n' | sha256sum
+    :param ignition: the decoded JSON
+    :return: sha256 hex digest
+    """
+    canonical = json.dumps(ignition, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class IgnitionCache:
+    """
+    Matchbox renders the ignition template of the matching group / profile on each request
+    The rendered payloads are stored in the werkzeug cache, keyed by the request query and the generation of the
+    matchbox data:
+    - the digest of the groups / profiles dumped by the sync process, sent with the POST /sync-notify
+    - the digest of the ignition templates reported to /ignition/version
+    A new sync generation or a new ignition template invalidates the entries
+    """
+    generation_key = "matchbox-generation"
+    versions_digest_key = "ignition-version-digest"
+
+    def __init__(self, cache: BaseCache, matchbox_session: requests.Session, matchbox_uri: str, timeout: int):
+        """
+        :param cache: the werkzeug cache instance
+        :param matchbox_session: the HTTP session to matchbox
+        :param matchbox_uri: http://127.0.0.1:8080
+        :param timeout: seconds to keep a rendered ignition
+        """
+        self.cache = cache
+        self.matchbox_session = matchbox_session
+        self.matchbox_uri = matchbox_uri
+        self.timeout = timeout
+
+    def set_generation(self, generation: str):
+        self.cache.set(self.generation_key, generation, timeout=0)
+
+    def set_versions(self, versions: dict):
+        digest = hashlib.sha256(json.dumps(versions, sort_keys=True).encode()).hexdigest()
+        self.cache.set(self.versions_digest_key, digest, timeout=0)
+
+    def _key(self, path: str):
+        generation = "%s\n%s\n%s" % (
+            self.cache.get(self.generation_key), self.cache.get(self.versions_digest_key), path)
+        return "ignition-%s" % hashlib.sha256(generation.encode()).hexdigest()
+
+    def _entry(self, path: str):
+        """
+        :param path: /ignition?<request_raw_query>
+        :return: (status_code, (etag, content, canonical digest))
+        """
+        key = self._key(path)
+        entry = self.cache.get(key)
+        if entry is not None:
+            logger.debug("hit %s %s" % (key, path))
+            return 200, entry
+
+        matchbox_resp = self.matchbox_session.get("%s%s" % (self.matchbox_uri, path))
+        content = matchbox_resp.content
+        matchbox_resp.close()
+        if matchbox_resp.status_code != 200:
+            return matchbox_resp.status_code, (None, content, None)
+
+        try:
+            digest = canonical_digest(json.loads(content.decode()))
+        except ValueError:
+            logger.warning("matchbox didn't render a JSON for %s" % path)
+            digest = None
+
+        entry = (hashlib.sha256(content).hexdigest(), content, digest)
+        self.cache.set(key, entry, timeout=self.timeout)
+        logger.debug("miss %s %s" % (key, path))
+        return 200, entry
+
+    def get(self, path: str):
+        """
+        Get the ignition rendered by matchbox for the given path
+        :param path: /ignition?<request_raw_query>
+        :return: (status_code, content, etag), the etag is None if the content isn't cacheable
+        """
+        status, entry = self._entry(path)
+        return status, entry[1], entry[0]
+
+    def get_digest(self, path: str):
+        """
+        Get the canonical digest of the ignition rendered by matchbox for the given path
+        :param path: /ignition?<request_raw_query>
+        :return: sha256 hex digest or None if matchbox didn't render a valid ignition
+        """
+        status, entry = self._entry(path)
+        return entry[2]
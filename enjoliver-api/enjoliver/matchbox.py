@@ -0,0 +1,56 @@
+"""
+HTTP client used by the API to query matchbox
+"""
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from enjoliver.configs import EnjoliverConfig
+
+logger = logging.getLogger(__name__)
+
+
+class MatchboxSession(requests.Session):
+    """
+    A requests.Session keeping alive a pool of connections to matchbox
+    Each request without an explicit timeout use the (connect, read) timeout of the session
+    """
+
+    def __init__(self, pool_size: int, connect_timeout: float, read_timeout: float, retries: int):
+        """
+        :param pool_size: number of connections kept alive to matchbox
+        :param connect_timeout: seconds to establish a connection
+        :param read_timeout: seconds between two bytes received
+        :param retries: retry budget of each request, only for idempotent methods
+        """
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=0.1),
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def new_session(ec: EnjoliverConfig) -> MatchboxSession:
+    """
+    Create the matchbox session of the current worker
+    :param ec: the EnjoliverConfig instance used to get config values
+    :return: MatchboxSession
+    """
+    logger.debug("pool_size: %d timeouts: %s/%s retries: %d" % (
+        ec.matchbox_pool_size, ec.matchbox_connect_timeout, ec.matchbox_read_timeout, ec.matchbox_retries))
+    return MatchboxSession(
+        pool_size=ec.matchbox_pool_size,
+        connect_timeout=ec.matchbox_connect_timeout,
+        read_timeout=ec.matchbox_read_timeout,
+        retries=ec.matchbox_retries,
+    )
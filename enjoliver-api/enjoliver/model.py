@@ -8,11 +8,13 @@ from sqlalchemy import (
     BigInteger,
     Boolean,
     Column,
+    Date,
     DateTime,
     Float,
     ForeignKey,
     Index,
     Integer,
+    Sequence,
     String,
 )
 from sqlalchemy.ext.declarative import declarative_base
@@ -85,6 +87,8 @@ class Chassis(Base):
 
     ports = relationship('ChassisPort')
 
+    Index('idx_chassis_mac_name', mac, name, unique=True)
+
     @validates('mac')
     def validate_mac(self, key, mac):
         return MAC_REGEX(mac)
@@ -110,6 +114,18 @@ class ChassisPort(Base):
         return "<%s: mac:%s chassis_mac:%s>" % (ChassisPort.__name__, self.mac, self.chassis_id)
 
 
+class FleetGeneration(Base):
+    """
+    Single row counter incremented after the transactions changing the discovery data or the schedules of the machines
+    The sync compares it between its cycles to skip the unchanged fleet
+    """
+    __tablename__ = 'fleet_generation'
+    id = Column(Integer, primary_key=True)
+
+    generation = Column(BigInteger, nullable=False, default=0)
+    updated_date = Column(DateTime, nullable=True)
+
+
 class Healthz(Base):
     """
     Healthz is used to check the write capabilities during health checks
@@ -186,6 +202,8 @@ class Machine(Base):
     uuid = Column(String(36), nullable=False)
     created_date = Column(DateTime, default=datetime.datetime.utcnow)
     updated_date = Column(DateTime, default=None)
+    # canonical digest of the last stored discovery data
+    discovery_digest = Column(String(64), nullable=True)
 
     interfaces = relationship('MachineInterface')
     boot_interface = relationship('MachineInterface', primaryjoin="and_(Machine.id==MachineInterface.machine_id, MachineInterface.as_boot==True)", uselist=False)
@@ -224,6 +242,8 @@ class MachineCurrentState(Base):
     state_name = Column(String(len(max(MachineStates.states, key=len))), nullable=False)
     created_date = Column(DateTime)
     updated_date = Column(DateTime)
+    # date of the change to the current state_name
+    state_date = Column(DateTime)
 
     machine = relationship('Machine')
     interfaces = relationship('MachineInterface', primaryjoin='MachineCurrentState.machine_id == foreign(MachineInterface.machine_id)')
@@ -299,6 +319,49 @@ class MachineInterface(Base):
         return "<%s: %s %s>" % (MachineInterface.__name__, self.mac, self.cidrv4)
 
 
+class MachineOverview(Base):
+    """
+    Denormalized row of each machine for the User Interface
+    Refreshed in the transactions writing the discovery, the schedules, the states and the lifecycle
+    """
+    __tablename__ = 'machine_overview'
+    machine_id = Column(Integer, ForeignKey('machine.id'), primary_key=True)
+
+    mac = Column(String(17), nullable=True)
+    fqdn = Column(String, nullable=True)
+    cidrv4 = Column(String(15 + 3), nullable=True)
+    last_state = Column(String(len(max(MachineStates.states, key=len))), nullable=True)
+    roles = Column(String, nullable=False, default="")
+    # sum of the disks in GiB, None without disk, the profile depends on the disks_ladder_gb config
+    disks_gb = Column(BigInteger, nullable=True)
+    last_report = Column(DateTime, nullable=True)
+    up_to_date = Column(Boolean, nullable=True)
+    last_change = Column(DateTime, nullable=True)
+    update_strategy = Column(String, nullable=False, default="Disable")
+    # date of the last refresh
+    updated_date = Column(DateTime, nullable=False, index=True)
+    # unique for the delta fetching, taken from a sequence: not in commit order
+    revision = Column(BigInteger, Sequence("machine_overview_revision_seq"), nullable=True, index=True)
+
+
+class MachineStateTransition(Base):
+    """
+    Append-only log of the state changes of the machines
+    The rows are bucketed by day to drop the expired days
+    """
+    __tablename__ = 'machine_state_transition'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    machine_mac = Column(String(17), nullable=False, index=True)
+    # None for the first state of a machine
+    from_state = Column(String(len(max(MachineStates.states, key=len))), nullable=True)
+    to_state = Column(String(len(max(MachineStates.states, key=len))), nullable=False)
+    date = Column(DateTime, nullable=False)
+    # seconds spent in from_state
+    duration = Column(Float, nullable=True)
+    day = Column(Date, nullable=False, index=True)
+
+
 class Schedule(Base):
     """
     Schedule is a state of a machine associated to ScheduleRoles
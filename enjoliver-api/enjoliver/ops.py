@@ -20,9 +20,10 @@ from enjoliver.model import Healthz
 logger = logging.getLogger(__name__)
 
 
-def healthz(application, sess_maker: sessionmaker, request):
+def healthz(application, sess_maker: sessionmaker, request, matchbox_session: requests.Session):
     """
     Query all services and return the status
+    :param matchbox_session: the HTTP session to matchbox
     :return: json
     """
     status = {
@@ -40,7 +41,7 @@ def healthz(application, sess_maker: sessionmaker, request):
         application.logger.error("MATCHBOX_URI is None")
     for k in status["matchbox"]:
         try:
-            req = requests.get("%s%s" % (application.config["MATCHBOX_URI"], k))
+            req = matchbox_session.get("%s%s" % (application.config["MATCHBOX_URI"], k))
             req.close()
             status["matchbox"][k] = True
         except Exception as e:
@@ -51,7 +52,7 @@ def healthz(application, sess_maker: sessionmaker, request):
     # Try a functional testing in discovery stages
     try:
         # here try if a default profile let any new machine boot in iPXE
-        req = requests.get("%s%s" % (application.config["MATCHBOX_URI"], "/ipxe"))
+        req = matchbox_session.get("%s%s" % (application.config["MATCHBOX_URI"], "/ipxe"))
         req.close()
         if req.status_code != 200:
             raise AssertionError("/ipxe returned a bad status code: %d" % req.status_code)
@@ -63,7 +64,7 @@ def healthz(application, sess_maker: sessionmaker, request):
     try:
         # create a random mac address to see if matchbox respond us something like it should
         ignition_url = "/ignition?mac=00-00-00-00-00-00"
-        req = requests.get("%s%s" % (application.config["MATCHBOX_URI"], ignition_url))
+        req = matchbox_session.get("%s%s" % (application.config["MATCHBOX_URI"], ignition_url))
         req.close()
         # Later parse the result to improve the coverage of this check
         json.loads(req.content.decode())
@@ -0,0 +1,73 @@
+"""
+Generation of the fleet: a counter incremented after the commit of the transactions changing the inputs of the
+matchbox sync
+The counter is incremented once per transaction in its own statement, the row isn't locked by the write transactions
+"""
+import datetime
+
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from enjoliver.model import FleetGeneration
+
+fleet_generation = FleetGeneration.__table__
+
+# id of the single row
+row_id = 1
+
+# key of the session.info marking a transaction to bump on commit
+changed_key = "fleet_generation_changed"
+
+
+def mark(session: Session):
+    """
+    Bump the generation after the commit of the transaction of the session, nothing is written
+    :param session: the session of the transaction
+    :return: None
+    """
+    session.info[changed_key] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_committed(session: Session):
+    if session.info.pop(changed_key, False):
+        # the session can't execute after its commit, the increment is committed on its own connection
+        with session.get_bind().begin() as connection:
+            bump(connection)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(session: Session):
+    session.info.pop(changed_key, None)
+
+
+def bump(connection: Connection, now: datetime.datetime = None):
+    """
+    Increment the generation, the sync reading the new generation reads the changes committed before it
+    :param connection: the connection of the increment
+    :param now: date of the change
+    :return: None
+    """
+    now = now if now else datetime.datetime.utcnow()
+    if connection.dialect.name in ("postgresql", "cockroachdb"):
+        stmt = postgresql.insert(fleet_generation).values(id=row_id, generation=1, updated_date=now)
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=[fleet_generation.c.id],
+            set_={"generation": fleet_generation.c.generation + 1, "updated_date": now}))
+        return
+
+    result = connection.execute(fleet_generation.update().where(fleet_generation.c.id == row_id).values(
+        generation=fleet_generation.c.generation + 1, updated_date=now))
+    if result.rowcount == 0:
+        connection.execute(fleet_generation.insert().values(id=row_id, generation=1, updated_date=now))
+
+
+def current(session: Session):
+    """
+    :param session: the session of the transaction
+    :return: int, 0 before the first change
+    """
+    return session.execute(select([fleet_generation.c.generation])
+                           .where(fleet_generation.c.id == row_id)).scalar() or 0
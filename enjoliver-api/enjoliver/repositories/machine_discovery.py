@@ -1,21 +1,30 @@
 import datetime
 import logging
 
+from prometheus_client import Counter
+from sqlalchemy import and_, exists, or_
 from sqlalchemy.orm import joinedload, Session, sessionmaker
 
 from enjoliver import tools
 from enjoliver.db import session_commit
+from enjoliver.ignition import canonical_digest
 from enjoliver.model import MachineInterface, Machine, MachineDisk, Chassis, ChassisPort
+from enjoliver.repositories import machine_overview, read_models
+from enjoliver.resolver import ReverseResolver
 
 
 logger = logging.getLogger(__name__)
 
+SHORT_CIRCUITED_COUNT = Counter("enjoliver_discovery_short_circuited_total",
+                                "Discovery reports identical to the stored ones")
+
 
 class MachineDiscoveryRepository:
     __name__ = "MachineDiscoveryRepository"
 
-    def __init__(self, sess_maker: sessionmaker):
+    def __init__(self, sess_maker: sessionmaker, resolver: ReverseResolver = None):
         self.__sess_maker = sess_maker
+        self.resolver = resolver if resolver is not None else tools.get_resolver()
 
     @staticmethod
     def _lint_discovery_data(discovery_data: dict):
@@ -31,140 +40,402 @@ class MachineDiscoveryRepository:
         return discovery_data
 
     @staticmethod
-    def _delete_all_attached(session: Session, machine: Machine):
+    def _digest(discovery_data: dict):
+        """
+        Canonical digest of the stored part of the discovery data, the ignition-journal and the random-id are ignored
+        :param discovery_data: linted discovery data
+        :return: sha256 hex digest
+        """
+        return canonical_digest({
+            "uuid": discovery_data["boot-info"]["uuid"],
+            "mac": discovery_data["boot-info"]["mac"],
+            "disks": discovery_data["disks"],
+            "interfaces": discovery_data["interfaces"],
+            "lldp": discovery_data["lldp"],
+        })
+
+    @staticmethod
+    def _named_macs(discovery_list: list):
+        return [i["mac"] for d in discovery_list for i in d["interfaces"] if i["mac"] and i.get("fqdn")]
+
+    @staticmethod
+    def _touch_unchanged(session: Session, digests: dict, now: datetime.datetime, named_macs: list):
+        """
+        Only update the updated_date of the machines already stored with the same discovery digest
+        The machines with a reported fqdn not stored are not short-circuited, its verification is retried
+        :param session: a DB session
+        :param digests: dict uuid -> digest of the reported discovery data
+        :param now: date of the update
+        :param named_macs: MAC of the interfaces reported with a fqdn
+        :return: set of the unchanged uuids
+        """
+        query = session.query(Machine)
+        if named_macs:
+            query = query.filter(~exists().where(and_(
+                MachineInterface.machine_id == Machine.id,
+                MachineInterface.mac.in_(named_macs),
+                MachineInterface.fqdn.is_(None))))
+
+        if len(digests) == 1:
+            uuid, digest = next(iter(digests.items()))
+            touched = query \
+                .filter(Machine.uuid == uuid, Machine.discovery_digest == digest) \
+                .update({Machine.updated_date: now}, synchronize_session=False)
+            unchanged = {uuid} if touched else set()
+        else:
+            unchanged = {uuid for uuid, digest in query.with_entities(Machine.uuid, Machine.discovery_digest)
+                         .filter(Machine.uuid.in_(list(digests))) if digest == digests[uuid]}
+            if unchanged:
+                session.query(Machine) \
+                    .filter(Machine.uuid.in_(list(unchanged))) \
+                    .update({Machine.updated_date: now}, synchronize_session=False)
+
+        if unchanged:
+            logger.debug("discovery data unchanged for %s" % ",".join(sorted(unchanged)))
+        return unchanged
+
+    @staticmethod
+    def _diff_disks(session: Session, machine: Machine, stored_disks: list, discovery_data: dict):
         """
-        Delete all resources attached to a machine
-        As we don't need performance we can avoid heuristics by dropping and re-creating theses needed resources
-        The discovery data is the reference of the reality
+        Apply the difference between the stored disks and the reported ones, keyed by path
         :param session: a DB session
         :param machine:
-        :return:
+        :param stored_disks: list of MachineDisk
+        :param discovery_data:
+        :return: None
         """
-        session.query(MachineDisk) \
-            .filter(MachineDisk.machine_id == machine.id) \
-            .delete()
+        stored = {d.path: d for d in stored_disks}
+        inserts = []
+        for d in discovery_data["disks"]:
+            disk = stored.pop(d["path"], None)
+            if disk is None:
+                inserts.append({"path": d["path"], "size": d["size-bytes"], "machine_id": machine.id})
+            elif disk.size != d["size-bytes"]:
+                disk.size = d["size-bytes"]
 
-        all_mi = session.query(MachineInterface) \
-            .filter(MachineInterface.machine_id == machine.id)
-        for i in all_mi:
-            session.query(ChassisPort) \
-                .filter(ChassisPort.machine_interface == i.id) \
-                .delete()
-            session.delete(i)
+        for disk in stored.values():
+            session.delete(disk)
+        if inserts:
+            session.bulk_insert_mappings(MachineDisk, inserts)
 
-        session.flush()
+    def _prefetch_fqdn(self, discovery_list: list):
+        """
+        Resolve concurrently the IPv4 of the reported interfaces, within the deadline of the resolver
+        """
+        if self.resolver.deferred or not self.resolver.verify_fqdn:
+            return
+        self.resolver.resolve_many(
+            [i["ipv4"] for d in discovery_list for i in d["interfaces"] if i["mac"] and i.get("fqdn")],
+            self.resolver.deadline)
+
+    def _diff_interfaces(self, session: Session, machine: Machine, stored_interfaces: list, discovery_data: dict,
+                         pending: list):
+        """
+        Apply the difference between the stored interfaces and the reported ones, keyed by MAC
+        The chassis ports of the removed interfaces are removed with them, the new interfaces are bulk inserted
+        The fqdn not verified yet are left as is and the interfaces are added to pending
+        :param session: a DB session
+        :param machine:
+        :param stored_interfaces: list of MachineInterface
+        :param discovery_data:
+        :param pending: list of the interfaces to verify in background
+        :return: dict name -> (interface id, stored chassis ports, stored MachineInterface or None)
+        """
+        interfaces = [i for i in discovery_data["interfaces"] if i["mac"]]
+        if self.resolver.deferred:
+            fqdns, late = [None] * len(interfaces), set(range(len(interfaces)))
+        else:
+            # the lookups are already done or in flight since _prefetch_fqdn
+            fqdns, late = self.resolver.verify_many(interfaces, 0)
+
+        stored = {i.mac: i for i in stored_interfaces}
+        machine_interfaces, inserts = dict(), []
+        for n, i in enumerate(interfaces):
+            fields = {
+                "name": i["name"],
+                "netmask": i["netmask"],
+                "ipv4": i["ipv4"],
+                "cidrv4": i["cidrv4"],
+                "as_boot": i["mac"] == discovery_data["boot-info"]["mac"],
+                "gateway": i["gateway"],
+            }
+            if n in late:
+                pending.append(i)
+            else:
+                fields["fqdn"] = fqdns[n]
+            machine_interface = stored.pop(i["mac"], None)
+            if machine_interface is None:
+                # validated by the model, inserted without the unit of work
+                inserts.append(MachineInterface(mac=i["mac"], machine_id=machine.id, **fields))
+                continue
+            for k, v in fields.items():
+                if getattr(machine_interface, k) != v:
+                    setattr(machine_interface, k, v)
+            # track machine interfaces to get them after during the LLDP section
+            machine_interfaces[machine_interface.name] = (
+                machine_interface.id, list(machine_interface.chassis_port), machine_interface)
+
+        for machine_interface in stored.values():
+            for port in machine_interface.chassis_port:
+                session.delete(port)
+            session.delete(machine_interface)
+
+        if inserts:
+            session.bulk_save_objects(inserts)
+            new_names = {i.name for i in inserts}
+            ids = dict()
+            if any(i["name"] in new_names for i in self._lldp_interfaces(discovery_data)):
+                # the chassis ports of the new interfaces need their id
+                ids = {mac: interface_id for mac, interface_id in session.query(
+                    MachineInterface.mac, MachineInterface.id).filter(
+                    MachineInterface.mac.in_([i.mac for i in inserts]))}
+            for i in inserts:
+                machine_interfaces[i.name] = (ids.get(i.mac), [], None)
+
+        return machine_interfaces
 
     @staticmethod
-    def _insert_network(session: Session, machine: Machine, discovery_data: dict):
-        machine_interfaces = dict()
-        for i in discovery_data["interfaces"]:
-            if i["mac"]:
-                machine_interface = MachineInterface(
-                    mac=i["mac"],
-                    name=i["name"],
-                    netmask=i["netmask"],
-                    ipv4=i["ipv4"],
-                    cidrv4=i["cidrv4"],
-                    as_boot=i["mac"] == discovery_data["boot-info"]["mac"],
-                    gateway=i["gateway"],
-                    fqdn=tools.get_verified_dns_query(i),
-                    machine_id=machine.id
-                )
-                # track machine interfaces to get them after during the LLDP section
-                machine_interfaces[machine_interface.name] = machine_interface
-                session.add(machine_interface)
+    def _lldp_interfaces(discovery_data: dict):
+        if discovery_data["lldp"]["is_file"] and discovery_data["lldp"]["data"]["interfaces"]:
+            return discovery_data["lldp"]["data"]["interfaces"]
+        return []
+
+    def _get_chassis(self, session: Session, discovery_list: list):
+        """
+        Get the chassis reported by the LLDP of the discovery data in one query
+        :return: dict (mac, name) -> Chassis
+        """
+        keys = {(i["chassis"]["id"], i["chassis"]["name"]) for d in discovery_list for i in self._lldp_interfaces(d)}
+        if not keys:
+            return dict()
+        return {(c.mac, c.name): c for c in session.query(Chassis)
+                .filter(Chassis.mac.in_(list({mac for mac, _ in keys}))) if (c.mac, c.name) in keys}
+
+    def _diff_chassis_ports(self, session: Session, machine_interfaces: dict, discovery_data: dict, chassis: dict):
+        """
+        Apply the difference between the stored chassis ports and the LLDP report, keyed by interface, port and chassis
+        The missing chassis are created in a single flush, the ports are bulk inserted
+        :param session: a DB session
+        :param machine_interfaces: dict name -> (interface id, stored chassis ports, stored MachineInterface or None)
+        :param discovery_data:
+        :param chassis: dict (mac, name) -> Chassis already known in this session, updated with the new chassis
+        :return: None
+        """
+        lldp_interfaces = self._lldp_interfaces(discovery_data)
+        for lldp_interface in lldp_interfaces:
+            key = (lldp_interface["chassis"]["id"], lldp_interface["chassis"]["name"])
+            if key not in chassis:
+                chassis[key] = Chassis(mac=key[0], name=key[1])
+                session.add(chassis[key])
 
+        # the new chassis need an id for the chassis ports
         session.flush()
 
-        if discovery_data["lldp"]["is_file"] and discovery_data["lldp"]["data"]["interfaces"]:
-            for lldp_interface in discovery_data["lldp"]["data"]["interfaces"]:
-                chassis = session.query(Chassis) \
-                    .filter(Chassis.name == lldp_interface["chassis"]["name"] and
-                            Chassis.name == lldp_interface["chassis"]["id"]) \
-                    .first()
-                if not chassis:
-                    chassis = Chassis(
-                        name=lldp_interface["chassis"]["name"],
-                        mac=lldp_interface["chassis"]["id"],
-                    )
-                session.add(chassis)
-                session.flush()
-                machine_interface_id = machine_interfaces[lldp_interface["name"]].id
-                session.add(
-                    ChassisPort(
-                        # TODO on some vendor it's not a MAC but a string like Ethernet1/22
-                        mac=lldp_interface["port"]["id"],
-                        machine_interface=machine_interface_id,
-                        chassis_id=chassis.id
-                    )
-                )
+        reported = {name: set() for name in machine_interfaces}
+        for lldp_interface in lldp_interfaces:
+            key = (lldp_interface["chassis"]["id"], lldp_interface["chassis"]["name"])
+            # TODO on some vendor it's not a MAC but a string like Ethernet1/22
+            reported[lldp_interface["name"]].add((lldp_interface["port"]["id"], chassis[key].id))
+
+        inserts = []
+        for name, (interface_id, ports, machine_interface) in machine_interfaces.items():
+            wanted = reported[name]
+            for port in ports:
+                key = (port.mac, port.chassis_id)
+                if key in wanted:
+                    wanted.discard(key)
+                else:
+                    session.delete(port)
+            for mac, chassis_id in wanted:
+                inserts.append({"mac": mac, "machine_interface": interface_id, "chassis_id": chassis_id})
+            if wanted and machine_interface is not None:
+                session.expire(machine_interface, ["chassis_port"])
+
+        if inserts:
+            session.bulk_insert_mappings(ChassisPort, inserts)
+
+    def _patch_fqdn(self, interfaces: list):
+        """
+        Verify the fqdn of the interfaces without deadline and update the stored ones
+        :param interfaces: list of the interfaces of the discovery data
+        :return: number of updated interfaces
+        """
+        fqdns, _ = self.resolver.verify_many(interfaces, None)
+        updated = 0
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            for i, fqdn in zip(interfaces, fqdns):
+                query = session.query(MachineInterface).filter(MachineInterface.mac == i["mac"])
+                if fqdn is None:
+                    query = query.filter(MachineInterface.fqdn.isnot(None))
+                else:
+                    query = query.filter(or_(MachineInterface.fqdn.is_(None), MachineInterface.fqdn != fqdn))
+                updated += query.update({MachineInterface.fqdn: fqdn}, synchronize_session=False)
+            if updated:
+                machine_overview.refresh(session, macs=[i["mac"] for i in interfaces])
+
+        logger.info("patched fqdn of %d/%d interfaces" % (updated, len(interfaces)))
+        return updated
+
+    def _defer_fqdn(self, pending: list):
+        if pending:
+            self.resolver.defer(self._patch_fqdn, pending)
+
+    @staticmethod
+    def _get_machines(session: Session, uuids: list):
+        """
+        Get the machines of the given uuids with their disks, interfaces and chassis ports in one query
+        :return: dict uuid -> Machine
+        """
+        if not uuids:
+            return dict()
+        return {m.uuid: m for m in session.query(Machine)
+                .options(joinedload("disks"))
+                .options(joinedload("interfaces").joinedload("chassis_port"))
+                .filter(Machine.uuid.in_(uuids))}
+
+    def _upsert(self, session: Session, discovery_data: dict, digest: str, now: datetime.datetime, machines: dict,
+                chassis: dict, pending: list):
+        """
+        Upsert the discovery data of one machine inside the given session, nothing is committed
+        The discovery data is the reference of the reality: only the difference with the stored disks, interfaces and
+        chassis ports is written, an identical report only updates the machine updated_date
+        :param session: a DB session
+        :param discovery_data: linted discovery data
+        :param digest: digest of the discovery data
+        :param now: date of the update
+        :param machines: dict uuid -> Machine already known in this session, updated with the new machine
+        :param chassis: dict (mac, name) -> Chassis already known in this session, updated with the new chassis
+        :param pending: list of the interfaces to verify in background
+        :return: True if the machine is new
+        """
+        uuid = discovery_data["boot-info"]["uuid"]
+        machine = machines.get(uuid)
+        new = machine is None
+        if not new:
+            machine.updated_date = now
+            machine.discovery_digest = digest
+            stored_disks, stored_interfaces = machine.disks, machine.interfaces
+        else:
+            machine = Machine(uuid=uuid, created_date=now, updated_date=now, discovery_digest=digest)
+            session.add(machine)
+            session.flush()
+            machines[uuid] = machine
+            stored_disks, stored_interfaces = [], []
+
+        self._diff_disks(session, machine, stored_disks, discovery_data)
+        machine_interfaces = self._diff_interfaces(session, machine, stored_interfaces, discovery_data, pending)
+        self._diff_chassis_ports(session, machine_interfaces, discovery_data, chassis)
+        # the bulk inserts bypass the relationships, reload them if the same machine is reported again
+        session.expire(machine, ["disks", "interfaces"])
+        return new
 
     def upsert(self, discovery_data: dict):
         discovery_data = self._lint_discovery_data(discovery_data)
+        uuid = discovery_data["boot-info"]["uuid"]
+        digest = self._digest(discovery_data)
         now = datetime.datetime.utcnow()
 
-        new = True
         with session_commit(sess_maker=self.__sess_maker) as session:
+            if self._touch_unchanged(session, {uuid: digest}, now, self._named_macs([discovery_data])):
+                SHORT_CIRCUITED_COUNT.inc()
+                return False
 
-            machine = session.query(Machine) \
-                .filter(Machine.uuid == discovery_data["boot-info"]["uuid"]) \
-                .first()
+        # no transaction is open while waiting the reverse DNS
+        self._prefetch_fqdn([discovery_data])
+        pending = []
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            machines = self._get_machines(session, [uuid])
+            chassis = self._get_chassis(session, [discovery_data])
+            new = self._upsert(session, discovery_data, digest, now, machines, chassis, pending)
+            machine_overview.refresh(session, machine_ids=[machines[uuid].id], now=now)
 
-            if machine:
-                new = False
-                machine.updated_date = now
-                self._delete_all_attached(session, machine)
-            else:
-                machine = Machine(
-                    uuid=discovery_data["boot-info"]["uuid"],
-                    created_date=now, updated_date=now
-                )
-                session.add(machine)
-                session.flush()
-
-            for d in discovery_data["disks"]:
-                session.add(MachineDisk(path=d["path"], size=d["size-bytes"], machine_id=machine.id))
-
-            self._insert_network(session, machine, discovery_data)
-            session.commit()
+        self._defer_fqdn(pending)
         return new
 
+    def _upsert_chunk(self, chunk: list, now: datetime.datetime):
+        """
+        Upsert the chunk in one transaction, the unchanged machines are touched in a previous one
+        :param chunk: list of (index, linted discovery data, digest)
+        :return: list of (index, result)
+        """
+        uuids = [d["boot-info"]["uuid"] for _, d, _ in chunk]
+        # a machine reported twice in the chunk cannot be short-circuited by its stored digest
+        digests = {d["boot-info"]["uuid"]: digest for _, d, digest in chunk
+                   if uuids.count(d["boot-info"]["uuid"]) == 1}
+
+        unchanged = set()
+        if digests:
+            with session_commit(sess_maker=self.__sess_maker) as session:
+                unchanged = self._touch_unchanged(session, digests, now, self._named_macs([d for _, d, _ in chunk]))
+        changed = [d for _, d, _ in chunk if d["boot-info"]["uuid"] not in unchanged]
+
+        # no transaction is open while waiting the reverse DNS
+        self._prefetch_fqdn(changed)
+        results, pending = [], []
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            machines = self._get_machines(session, list(set(uuids) - unchanged))
+            chassis = self._get_chassis(session, changed)
+            for i, d, digest in chunk:
+                if d["boot-info"]["uuid"] in unchanged:
+                    results.append((i, "updated"))
+                else:
+                    new = self._upsert(session, d, digest, now, machines, chassis, pending)
+                    results.append((i, "new" if new else "updated"))
+            changed_ids = {machines[d["boot-info"]["uuid"]].id for d in changed}
+            machine_overview.refresh(session, machine_ids=list(changed_ids), now=now)
+
+        SHORT_CIRCUITED_COUNT.inc(len(unchanged))
+        self._defer_fqdn(pending)
+        return results
+
+    def upsert_many(self, discovery_list: list, chunk_size: int):
+        """
+        Upsert the discovery data of many machines, each chunk is stored in one transaction
+        If a chunk fails, its items are stored one by one to isolate the faulty ones
+        :param discovery_list: list of discovery data
+        :param chunk_size: number of machines by transaction, 0 for a single transaction
+        :return: list of dict with the index, the uuid, the boot mac and the result: new, updated or error, the errors
+            are logged and reported with a generic message
+        """
+        now = datetime.datetime.utcnow()
+        results = [{"index": i, "uuid": None, "mac": None, "result": "error"} for i in range(len(discovery_list))]
+        valid = []
+        for i, discovery_data in enumerate(discovery_list):
+            try:
+                discovery_data = self._lint_discovery_data(discovery_data)
+                results[i]["uuid"] = discovery_data["boot-info"]["uuid"]
+                results[i]["mac"] = discovery_data["boot-info"]["mac"]
+                valid.append((i, discovery_data, self._digest(discovery_data)))
+            except (AttributeError, KeyError, TypeError) as e:
+                logger.error("invalid discovery data at index %d: %s" % (i, e))
+                results[i]["error"] = "invalid discovery data"
+
+        if chunk_size <= 0:
+            chunk_size = max(len(valid), 1)
+
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            try:
+                done = self._upsert_chunk(chunk, now)
+            except Exception as e:
+                logger.error("fail to upsert chunk of %d machines, retrying one by one: %s" % (len(chunk), e))
+                done = []
+                for item in chunk:
+                    try:
+                        done.extend(self._upsert_chunk([item], now))
+                    except Exception as e:
+                        logger.error("fail to upsert machine %s: %s" % (item[1]["boot-info"]["uuid"], e))
+                        results[item[0]]["error"] = "fail to store the discovery data"
+
+            for i, result in done:
+                results[i]["result"] = result
+
+        return results
+
     def fetch_all_discovery(self):
         """
         Get discovery data of interfaces, disks and the boot-info
         :return:
         """
-        machines = []
         with session_commit(sess_maker=self.__sess_maker) as session:
-            for m in session.query(Machine) \
-                    .options(joinedload("interfaces")) \
-                    .options(joinedload("disks")) \
-                    .join(MachineInterface):
-
-                boot_interface = None
-                interfaces = []
-                for i in m.interfaces:
-                    if i.as_boot:
-                        boot_interface = i
-                    interfaces.append({
-                        "as_boot": i.as_boot,
-                        "cidrv4": i.cidrv4,
-                        "fqdn": i.fqdn,
-                        "gateway": i.gateway,
-                        "ipv4": i.ipv4,
-                        "mac": i.mac,
-                        "name": i.name,
-                        "netmask": i.netmask
-                    })
-
-                machines.append({
-                    "boot-info": {
-                        "uuid": m.uuid,
-                        "created-date": m.created_date,
-                        "updated-date": m.updated_date,
-                        "mac": boot_interface.mac
-                    },
-                    "interfaces": interfaces,
-                    "disks": [{"size-bytes": d.size, "path": d.path} for d in m.disks]
-                })
-            return machines
+            return list(read_models.discovery(session))
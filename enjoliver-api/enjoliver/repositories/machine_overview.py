@@ -0,0 +1,197 @@
+"""
+Incremental refresh of the machine_overview table read by the User Interface
+Each write path refreshes the rows of the machines it touched inside its own transaction
+"""
+import datetime
+import logging
+
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from enjoliver.model import (
+    LifecycleIgnition,
+    LifecycleRolling,
+    Machine,
+    MachineCurrentState,
+    MachineDisk,
+    MachineInterface,
+    MachineOverview,
+    Schedule,
+)
+from enjoliver.repositories import fleet_generation
+
+logger = logging.getLogger(__name__)
+
+# rows by upsert statement
+chunk_size = 500
+
+machine = Machine.__table__
+boot_interface = MachineInterface.__table__.alias("boot_interface")
+state = MachineCurrentState.__table__
+ignition = LifecycleIgnition.__table__
+rolling = LifecycleRolling.__table__
+overview = MachineOverview.__table__
+# the revisions aren't locked: a transaction can commit after a greater revision, see UserInterfaceRepository
+revision_sequence = overview.c.revision.default
+
+
+def _machines_filter(machine_ids, macs):
+    if machine_ids is not None:
+        return machine.c.id.in_(list(machine_ids))
+    if macs is not None:
+        return machine.c.id.in_(select([MachineInterface.machine_id]).where(MachineInterface.mac.in_(list(macs))))
+    return None
+
+
+def compute(session: Session, machine_ids=None, macs=None, now: datetime.datetime = None):
+    """
+    Compute the overview rows from the normalized tables
+    :param session: the session of the transaction
+    :param machine_ids: the machines to compute
+    :param macs: the machines having an interface with one of these MAC, if machine_ids is None
+    :param now: date of the refresh
+    :return: list of dict, the machine_overview rows
+    """
+    now = now if now else datetime.datetime.utcnow()
+    joined = machine \
+        .outerjoin(boot_interface, and_(boot_interface.c.machine_id == machine.c.id,
+                                        boot_interface.c.as_boot == True)) \
+        .outerjoin(state, state.c.machine_mac == boot_interface.c.mac) \
+        .outerjoin(ignition, ignition.c.machine_id == machine.c.id) \
+        .outerjoin(rolling, rolling.c.machine_id == machine.c.id)
+    query = select([
+        machine.c.id,
+        boot_interface.c.mac,
+        boot_interface.c.fqdn,
+        boot_interface.c.cidrv4,
+        state.c.state_name,
+        ignition.c.updated_date,
+        ignition.c.up_to_date,
+        ignition.c.last_change_date,
+        rolling.c.enable,
+        rolling.c.strategy,
+    ]).select_from(joined).order_by(machine.c.id)
+
+    where = _machines_filter(machine_ids, macs)
+    if where is not None:
+        query = query.where(where)
+    rows = session.execute(query).fetchall()
+    if not rows:
+        return []
+
+    ids = [row.id for row in rows]
+    disks_gb = dict()
+    for disk in session.execute(select([MachineDisk.machine_id, MachineDisk.size])
+                                .where(MachineDisk.machine_id.in_(ids))):
+        disks_gb[disk.machine_id] = disks_gb.get(disk.machine_id, 0) + (disk.size >> 30)
+    roles = dict()
+    for schedule in session.execute(select([Schedule.machine_id, Schedule.role])
+                                    .where(Schedule.machine_id.in_(ids))
+                                    .order_by(Schedule.id)):
+        roles.setdefault(schedule.machine_id, []).append(schedule.role)
+
+    return [{
+        "machine_id": row.id,
+        "mac": row.mac,
+        "fqdn": row.fqdn,
+        "cidrv4": row.cidrv4,
+        "last_state": row.state_name,
+        "roles": ",".join(roles.get(row.id, [])),
+        "disks_gb": disks_gb.get(row.id),
+        "last_report": row.updated_date,
+        "up_to_date": row.up_to_date,
+        "last_change": row.last_change_date,
+        "update_strategy": row.strategy if row.enable else "Disable",
+        "updated_date": now,
+    } for row in rows]
+
+
+def next_revisions(session: Session, count: int):
+    """
+    Take the revisions of the overview rows written by the transaction of the session
+    :param session: the session of the transaction
+    :param count: number of revisions
+    :return: list of revisions, the nextval of the sequence evaluated by the statement on the dialects with sequences
+    """
+    if session.get_bind().dialect.supports_sequences:
+        return [revision_sequence.next_value()] * count
+    # the writers of the dialects without sequences are serialized by the database lock
+    last = session.execute(select([func.max(overview.c.revision)])).scalar() or 0
+    return [last + n + 1 for n in range(count)]
+
+
+def _upsert(session: Session, rows: list):
+    dialect = session.get_bind().dialect.name
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        if dialect in ("postgresql", "cockroachdb"):
+            stmt = postgresql.insert(overview).values(chunk)
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=[overview.c.machine_id],
+                set_={c.name: stmt.excluded[c.name] for c in overview.c if c.name != "machine_id"}))
+        else:
+            session.execute(overview.delete().where(overview.c.machine_id.in_([r["machine_id"] for r in chunk])))
+            session.execute(overview.insert(), chunk)
+
+
+def refresh(session: Session, machine_ids=None, macs=None, now: datetime.datetime = None):
+    """
+    Refresh the overview of the given machines inside the transaction of the session, nothing is committed
+    Without machine_ids and macs the whole table is rebuilt
+    :param session: the session of the transaction
+    :param machine_ids: the machines to refresh
+    :param macs: the machines having an interface with one of these MAC, if machine_ids is None
+    :param now: date of the refresh
+    :return: number of refreshed machines
+    """
+    if (machine_ids is not None and not machine_ids) or (macs is not None and not macs):
+        return 0
+    # the pending ORM changes are read by the Core select
+    session.flush()
+    rows = compute(session, machine_ids, macs, now)
+    if rows:
+        for row, revision in zip(rows, next_revisions(session, len(rows))):
+            row["revision"] = revision
+    _upsert(session, rows)
+    if rows:
+        # the refreshed machines changed their discovery data or their schedules, the inputs of the sync
+        fleet_generation.mark(session)
+    logger.debug("refreshed the overview of %d machines" % len(rows))
+    return len(rows)
+
+
+def update(session: Session, machine_id: int, now: datetime.datetime = None, **values):
+    """
+    Update some columns of the overview of a machine, for the writes not changing the other ones
+    :param session: the session of the transaction
+    :param machine_id: the machine to update
+    :param now: date of the refresh
+    :param values: the machine_overview columns
+    :return: None
+    """
+    values["updated_date"] = now if now else datetime.datetime.utcnow()
+    values["revision"] = next_revisions(session, 1)[0]
+    session.execute(overview.update().where(overview.c.machine_id == machine_id).values(**values))
+
+
+def update_states(session: Session, states: dict, now: datetime.datetime = None):
+    """
+    Update the last_state of the machines booting with the given MAC
+    The machines without overview are refreshed with their state on their first discovery
+    :param session: the session of the transaction
+    :param states: dict mac -> state name
+    :param now: date of the refresh
+    :return: None
+    """
+    if not states:
+        return
+    machine_ids = sorted(machine_id for machine_id, in session.execute(
+        select([overview.c.machine_id]).where(overview.c.mac.in_(list(states)))))
+    if not machine_ids:
+        return
+    session.execute(overview.update().where(overview.c.machine_id.in_(machine_ids)).values(
+        last_state=case(states, value=overview.c.mac),
+        revision=case(dict(zip(machine_ids, next_revisions(session, len(machine_ids)))),
+                      value=overview.c.machine_id),
+        updated_date=now if now else datetime.datetime.utcnow()))
@@ -1,9 +1,12 @@
+import datetime
 import logging
 
+from sqlalchemy import exists
 from sqlalchemy.orm import joinedload, sessionmaker
 
 from enjoliver.db import session_commit
-from enjoliver.model import Machine, Schedule, MachineInterface
+from enjoliver.model import Machine, Schedule, MachineInterface, ScheduleRoles
+from enjoliver.repositories import fleet_generation, machine_overview, read_models
 
 logger = logging.getLogger(__name__)
 
@@ -51,13 +54,65 @@ class MachineScheduleRepository:
                         "scheduling machine mac %s as role %s",
                         schedule_data["selector"]["mac"], role
                     )
+                machine_overview.refresh(session, machine_ids=[machine.id])
+
+    def allocate(self, roles: list, count=None):
+        """
+        Schedule the roles on available machines in one transaction, the machines are taken by MAC order
+        On PostgreSQL the machines locked by a concurrent allocation are skipped, the ones allocated by a concurrent
+        allocation committed before the lock are checked again
+        :param roles: list of ScheduleRoles
+        :param count: number of machines to allocate, all or nothing, None for all the available machines
+        :return: list of the allocated MAC
+        """
+        for role in roles:
+            if role not in ScheduleRoles.roles:
+                raise LookupError("%s not in %s" % (role, ScheduleRoles.roles))
+
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            query = session.query(Machine.id, MachineInterface.mac) \
+                .join(MachineInterface) \
+                .filter(MachineInterface.as_boot == True) \
+                .filter(~exists().where(Schedule.machine_id == Machine.id)) \
+                .order_by(MachineInterface.mac)
+            if count is not None:
+                query = query.limit(count)
+
+            dialect = session.get_bind().dialect.name
+            if dialect == "postgresql":
+                query = query.with_for_update(of=Machine, skip_locked=True)
+            elif dialect == "cockroachdb":
+                query = query.with_for_update(of=Machine)
+
+            available = query.all()
+            if available and dialect in ("postgresql", "cockroachdb"):
+                # the snapshot of the query is older than its locks: a concurrent allocation committed meanwhile
+                scheduled = {machine_id for machine_id, in session.query(Schedule.machine_id)
+                             .filter(Schedule.machine_id.in_([machine_id for machine_id, _ in available]))
+                             .distinct()}
+                available = [(machine_id, mac) for machine_id, mac in available if machine_id not in scheduled]
+            if count is not None and len(available) < count:
+                logger.info("not enough available machines %d/%d for roles %s" % (len(available), count, roles))
+                return []
+
+            if available:
+                session.execute(Schedule.__table__.insert().values([
+                    {"machine_id": machine_id, "role": role, "created_date": datetime.datetime.utcnow()}
+                    for machine_id, _ in available for role in roles
+                ]))
+                machine_overview.refresh(session, machine_ids=[machine_id for machine_id, _ in available])
+            allocated = [mac for _, mac in available]
+            logger.info("scheduling machines mac %s as roles %s" % (",".join(allocated), roles))
+            return allocated
 
     def get_all_schedules(self):
         result = dict()
         with session_commit(sess_maker=self.__sess_maker) as session:
-            for machine in session.query(Machine):
-                if machine.schedules:
-                    result[machine.boot_interface.mac] = [k.role for k in machine.schedules]
+            for machine in session.query(Machine) \
+                    .options(joinedload("schedules")) \
+                    .options(joinedload("boot_interface")) \
+                    .filter(Machine.schedules.any()):
+                result[machine.boot_interface.mac] = [k.role for k in machine.schedules]
 
         return result
 
@@ -71,77 +126,33 @@ class MachineScheduleRepository:
             ]
 
     def get_available_machines(self):
-        available_machines = []
-        with session_commit(sess_maker=self.__sess_maker) as session:
-            for m in session.query(Machine) \
-                    .join(MachineInterface) \
-                    .options(joinedload("schedules")) \
-                    .options(joinedload("interfaces")) \
-                    .options(joinedload("disks")) \
-                    .filter(MachineInterface.as_boot == True):
-                # TODO find a way to support cockroach and SQLite without this if
-                if not m.schedules:
-                    available_machines.append({
-                        "mac": m.interfaces[0].mac,
-                        "ipv4": m.interfaces[0].ipv4,
-                        "cidrv4": m.interfaces[0].cidrv4,
-                        "as_boot": m.interfaces[0].as_boot,
-                        "name": m.interfaces[0].name,
-                        "fqdn": m.interfaces[0].fqdn,
-                        "netmask": m.interfaces[0].netmask,
-                        "created_date": m.created_date,
-                        "disks": [{"path": k.path, "size-bytes": k.size} for k in m.disks],
-                    })
-
-        return available_machines
-
-    def _construct_machine_dict(self, machine: Machine, role):
-        return {
-            "mac": machine.boot_interface.mac,
-            "ipv4": machine.boot_interface.ipv4,
-            "cidrv4": machine.boot_interface.cidrv4,
-            "gateway": machine.boot_interface.gateway,
-            "as_boot": machine.boot_interface.as_boot,
-            "name": machine.boot_interface.name,
-            "netmask": machine.boot_interface.netmask,
-            "roles": role,
-            "created_date": machine.created_date,
-            "fqdn": machine.boot_interface.fqdn,
-            "disks": [{"path": k.path, "size-bytes": k.size} for k in machine.disks],
-        }
-
-    def get_machines_by_role(self, role: str):
-        machines = []
         with session_commit(sess_maker=self.__sess_maker) as session:
-            for machine in session.query(Machine) \
-                    .join(Schedule) \
-                    .filter(Schedule.role == role):
-                machines.append(self._construct_machine_dict(machine, role))
-
-        return machines
-
-    def get_machines_by_roles(self, *roles):
-        if len(roles) == 1:
-            return self.get_machines_by_role(roles[0])
-        machines = []
-        roles = list(roles)
-
+            return list(read_models.available_machines(session))
+
+    def get_machines_by_role(self, role: str, page: read_models.Page = None):
+        """
+        :param role: the scheduled role
+        :param page: the page of machines, None for all
+        :return: list of dict
+        """
+        return self.get_machines_by_roles(role, page=page)
+
+    def get_machines_by_roles(self, *roles, page: read_models.Page = None):
+        """
+        :param roles: the exact set of scheduled roles
+        :param page: the page of machines, None for all
+        :return: list of dict
+        """
         with session_commit(sess_maker=self.__sess_maker) as session:
-            for machine in session.query(Machine):
-                # TODO Maybe do this with a sqlalchemy filter func
-                if set(k.role for k in machine.schedules) == set(roles):
-                    machines.append(self._construct_machine_dict(machine, roles))
-
-        return machines
+            return list(read_models.scheduled_machines(session, list(roles), page))
 
     def get_role_ip_list(self, role: str):
-        ips = []
         with session_commit(sess_maker=self.__sess_maker) as session:
-            for machine in session.query(Machine) \
-                    .options(joinedload("interfaces")) \
-                    .join(MachineInterface) \
-                    .join(Schedule) \
-                    .filter(Schedule.role == role, MachineInterface.as_boot == True):
-                ips.append(machine.interfaces[0].ipv4)
+            return read_models.role_ips(session, role)
 
-        return ips
+    def get_fleet_generation(self):
+        """
+        :return: int, incremented by each change of the discovery data or the schedules of the machines
+        """
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            return fleet_generation.current(session)
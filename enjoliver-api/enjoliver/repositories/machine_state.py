@@ -1,17 +1,41 @@
+import atexit
 import datetime
 import logging
+import threading
+import time
 
+from prometheus_client import Gauge
+from sqlalchemy import and_, case, func, select, text
 from sqlalchemy.orm import joinedload, sessionmaker, Session
 
 from enjoliver.db import session_commit
-from enjoliver.model import MachineCurrentState, MachineInterface
+from enjoliver.model import MachineCurrentState, MachineInterface, MachineStates, MachineStateTransition
+from enjoliver.repositories import machine_overview
 
 logger = logging.getLogger(__name__)
 
+PENDING_STATES = Gauge("enjoliver_machine_state_pending", "Machine states waiting in the write-behind buffer",
+                       multiprocess_mode="livesum")
+
 
 class MachineStateRepository:
-    def __init__(self, sess_maker: sessionmaker):
+    # seconds between two expirations of the state transitions
+    history_expire_interval = 3600
+
+    def __init__(self, sess_maker: sessionmaker, flush_interval: float = 0, flush_size: int = 500,
+                 history_days: int = 30):
+        """
+        :param sess_maker: the DB session factory
+        :param flush_interval: seconds of the write-behind buffer, 0 to write each update in its own transaction
+        :param flush_size: number of pending MAC triggering a flush of the write-behind buffer
+        :param history_days: days of state transitions kept, 0 to keep them forever
+        """
         self.__sess_maker = sess_maker
+        self.history_days = history_days
+        self._expired_at = 0
+        self.buffer = None
+        if flush_interval > 0:
+            self.buffer = MachineStateBuffer(self.update_states, flush_interval, flush_size)
 
     def _update_state(self, session: Session, machine_current_state: MachineCurrentState):
         try:
@@ -22,6 +46,14 @@ class MachineStateRepository:
                 machine_current_state.machine_mac, machine_current_state.state_name, e))
 
     def fetch(self, finished_in_less_than_min: int):
+        """
+        The states reported in the last minutes
+        Only the buffer of this process is flushed: with a flush_interval the states pending in the buffers of the
+        other API workers are missing, they are read after their next flush, at most flush_interval seconds later
+        :param finished_in_less_than_min: minutes since the last report of the machines
+        :return: list of dict, the most recent report first
+        """
+        self.flush()
         time_limit = datetime.datetime.utcnow() - datetime.timedelta(minutes=finished_in_less_than_min)
         results = []
         with session_commit(sess_maker=self.__sess_maker) as session:
@@ -37,34 +69,362 @@ class MachineStateRepository:
                 })
             return results
 
-    def update(self, mac: str, state: str):
-        with session_commit(sess_maker=self.__sess_maker) as session:
-            state_machine = session.query(MachineCurrentState) \
-                .filter(MachineCurrentState.machine_mac == mac) \
-                .one_or_none()
+    # SQLite >= 3.24 has the same upsert clause as PostgreSQL, not yet compiled by SQLAlchemy for this dialect
+    sqlite_upsert = text(
+        "INSERT INTO machine_current_state "
+        "(machine_mac, state_name, machine_id, created_date, updated_date, state_date) "
+        "VALUES (:mac, :state, (SELECT machine_id FROM machine_interface WHERE mac = :mac), :date, :date, :state_date) "
+        "ON CONFLICT (machine_mac) DO UPDATE SET state_name = excluded.state_name, machine_id = excluded.machine_id, "
+        "updated_date = excluded.updated_date, state_date = excluded.state_date "
+        "WHERE machine_current_state.updated_date IS NULL OR machine_current_state.updated_date <= excluded.updated_date"
+    )
+
+    # One statement: the stored states are locked and read before the upsert, the transitions are the upserted rows
+    # starting a new state_date. A concurrent first report of the same state is serialized by the ON CONFLICT clause
+    # which keeps the state_date of the row written meanwhile: only one of the reports logs the transition
+    # The revisions of the updated machine_overview rows are taken as in machine_overview.next_revisions
+    pg_upsert = text(
+        "WITH input AS ("
+        "SELECT * FROM unnest(CAST(:macs AS VARCHAR[]), CAST(:states AS VARCHAR[]), CAST(:dates AS TIMESTAMP[])) "
+        "AS i (mac, state, date)), "
+        "old AS ("
+        "SELECT machine_mac, state_name, COALESCE(state_date, created_date) AS state_date FROM machine_current_state "
+        "WHERE machine_mac IN (SELECT mac FROM input) FOR UPDATE), "
+        "up AS ("
+        "INSERT INTO machine_current_state "
+        "(machine_mac, state_name, machine_id, created_date, updated_date, state_date) "
+        "SELECT input.mac, input.state, (SELECT machine_id FROM machine_interface WHERE mac = input.mac), "
+        "input.date, input.date, CASE WHEN old.state_name = input.state THEN old.state_date ELSE input.date END "
+        "FROM input LEFT JOIN old ON old.machine_mac = input.mac "
+        "ON CONFLICT (machine_mac) DO UPDATE SET state_name = excluded.state_name, machine_id = excluded.machine_id, "
+        "updated_date = excluded.updated_date, state_date = CASE "
+        "WHEN machine_current_state.state_name = excluded.state_name "
+        "THEN COALESCE(machine_current_state.state_date, machine_current_state.created_date) "
+        "ELSE excluded.updated_date END "
+        "WHERE machine_current_state.updated_date IS NULL OR machine_current_state.updated_date <= excluded.updated_date "
+        "RETURNING machine_mac, state_name, updated_date, state_date), "
+        "transition AS ("
+        "INSERT INTO machine_state_transition (machine_mac, from_state, to_state, date, duration, day) "
+        "SELECT up.machine_mac, old.state_name, up.state_name, up.state_date, "
+        "EXTRACT(EPOCH FROM up.state_date - old.state_date), CAST(up.state_date AS DATE) "
+        "FROM up LEFT JOIN old ON old.machine_mac = up.machine_mac "
+        "WHERE up.state_date = up.updated_date AND old.state_name IS DISTINCT FROM up.state_name) "
+        "UPDATE machine_overview SET last_state = up.state_name, updated_date = :now, "
+        "revision = nextval('machine_overview_revision_seq') "
+        "FROM up WHERE machine_overview.mac = up.machine_mac"
+    )
+
+    def _pg_upsert(self, session: Session, states: dict):
+        macs = list(states)
+        session.execute(self.pg_upsert, {
+            "macs": macs,
+            "states": [states[mac][0] for mac in macs],
+            "dates": [states[mac][1] for mac in macs],
+            "now": datetime.datetime.utcnow(),
+        })
 
-            machine_interface = session.query(MachineInterface) \
-                .filter(MachineInterface.mac == mac) \
-                .one_or_none()
+    def _sqlite_upsert(self, session: Session, rows: dict):
+        session.execute(self.sqlite_upsert, [
+            {"mac": mac, "state": state, "date": date, "state_date": state_date}
+            for mac, (state, date, state_date) in rows.items()
+        ])
 
-            now = datetime.datetime.utcnow()
-            machine_id = None
-            if machine_interface is not None:
-                machine_id = machine_interface.machine_id
+    def _orm_upsert(self, session: Session, rows: dict, stored: dict):
+        """
+        Insert or update the selected states, for the dialects without upsert
+        """
+        machine_ids = {mac: machine_id for mac, machine_id in session.query(
+            MachineInterface.mac, MachineInterface.machine_id).filter(MachineInterface.mac.in_(list(rows)))}
 
+        for mac, (state, date, state_date) in rows.items():
+            state_machine = stored.get(mac)
             if not state_machine:
                 logger.debug(
                     "machine with mac: %s doesn't exist in table %s: creating with state %s" % (
                         mac, MachineCurrentState.__tablename__, state))
                 self._update_state(session, MachineCurrentState(
-                    machine_id=machine_id,
+                    machine_id=machine_ids.get(mac),
                     state_name=state,
                     machine_mac=mac,
-                    created_date=now,
-                    updated_date=now,
+                    created_date=date,
+                    updated_date=date,
+                    state_date=state_date,
                 ))
-            else:
+            elif state_machine.updated_date is None or state_machine.updated_date <= date:
                 state_machine.state_name = state
-                state_machine.machine_id = machine_id
-                state_machine.updated_date = now
+                state_machine.machine_id = machine_ids.get(mac)
+                state_machine.updated_date = date
+                state_machine.state_date = state_date
                 self._update_state(session, state_machine)
+
+    @staticmethod
+    def _transitions(states: dict, stored: dict):
+        """
+        Compare the new states to the stored ones
+        :param states: dict mac -> (state name, date)
+        :param stored: dict mac -> MachineCurrentState
+        :return: (dict mac -> (state name, date, state_date), list of the MachineStateTransition rows)
+        """
+        rows, transitions = dict(), []
+        for mac, (state, date) in states.items():
+            previous = stored.get(mac)
+            if previous is None:
+                rows[mac] = (state, date, date)
+                transitions.append({"machine_mac": mac, "from_state": None, "to_state": state, "date": date,
+                                    "duration": None, "day": date.date()})
+                continue
+
+            since = previous.state_date or previous.created_date
+            if previous.updated_date is not None and previous.updated_date > date:
+                # older than the stored one, ignored by the upsert
+                rows[mac] = (state, date, since)
+            elif previous.state_name == state:
+                rows[mac] = (state, date, since)
+            else:
+                rows[mac] = (state, date, date)
+                transitions.append({
+                    "machine_mac": mac, "from_state": previous.state_name, "to_state": state, "date": date,
+                    "duration": (date - since).total_seconds() if since else None, "day": date.date()})
+        return rows, transitions
+
+    @staticmethod
+    def _current_states(rows: dict, stored: dict):
+        """
+        :param rows: dict mac -> (state name, date, state_date) of the upsert
+        :param stored: dict mac -> MachineCurrentState
+        :return: dict mac -> state name after the upsert, a stored state more recent than the new one is kept
+        """
+        current = dict()
+        for mac, (state, date, _) in rows.items():
+            previous = stored.get(mac)
+            if previous is not None and previous.updated_date is not None and previous.updated_date > date:
+                state = previous.state_name
+            current[mac] = state
+        return current
+
+    def update_states(self, states: dict):
+        """
+        Write the states of many machines and log their transitions
+        On PostgreSQL the states, the transitions and the machine_overview are written by one statement
+        A state never replaces a more recent one
+        :param states: dict mac -> (state name, date of the state)
+        :return: None
+        """
+        if not states:
+            return
+        for state, _ in states.values():
+            if state not in MachineStates.states:
+                raise LookupError("%s not in %s" % (state, MachineStates.states))
+
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            dialect = session.get_bind().dialect.name
+            # CockroachDB has the ON CONFLICT clause too, its UPSERT would replace the created_date
+            if dialect in ("postgresql", "cockroachdb"):
+                self._pg_upsert(session, states)
+            else:
+                stored = {s.machine_mac: s for s in session.query(MachineCurrentState)
+                          .filter(MachineCurrentState.machine_mac.in_(list(states)))}
+                rows, transitions = self._transitions(states, stored)
+                if transitions:
+                    session.execute(MachineStateTransition.__table__.insert().values(transitions))
+                if dialect == "sqlite":
+                    self._sqlite_upsert(session, rows)
+                else:
+                    self._orm_upsert(session, rows, stored)
+                machine_overview.update_states(session, self._current_states(rows, stored))
+
+        self._expire_history()
+
+    def _expire_history(self):
+        now = time.time()
+        if self.history_days <= 0 or now - self._expired_at < self.history_expire_interval:
+            return
+        self._expired_at = now
+        try:
+            self.expire_history(datetime.datetime.utcnow().date())
+        except Exception as e:
+            logger.error("fail to expire the state transitions: %s" % e)
+
+    def expire_history(self, today: datetime.date):
+        """
+        Drop the days of state transitions older than the retention
+        :param today: the current day
+        :return: number of deleted transitions
+        """
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            deleted = session.query(MachineStateTransition) \
+                .filter(MachineStateTransition.day < today - datetime.timedelta(days=self.history_days)) \
+                .delete(synchronize_session=False)
+        logger.info("expired %d state transitions older than %d days" % (deleted, self.history_days))
+        return deleted
+
+    def transitions_percentiles(self, since_days: int):
+        """
+        Time spent in a state before each transition, computed by the database with the nearest-rank method
+        :param since_days: number of days of transitions
+        :return: list of dict with the from and to states, the count and the p50 / p95 / p99 in seconds
+        """
+        self.flush()
+        t = MachineStateTransition.__table__
+        since = datetime.datetime.utcnow().date() - datetime.timedelta(days=since_days)
+        ranked = select([
+            t.c.from_state,
+            t.c.to_state,
+            t.c.duration,
+            func.row_number().over(partition_by=[t.c.from_state, t.c.to_state], order_by=t.c.duration).label("rn"),
+            func.count().over(partition_by=[t.c.from_state, t.c.to_state]).label("cnt"),
+        ]).where(and_(t.c.duration.isnot(None), t.c.day >= since)).alias("ranked")
+
+        def percentile(p):
+            return func.min(case([(ranked.c.rn >= p * ranked.c.cnt, ranked.c.duration)]))
+
+        query = select([
+            ranked.c.from_state,
+            ranked.c.to_state,
+            func.max(ranked.c.cnt),
+            percentile(0.50),
+            percentile(0.95),
+            percentile(0.99),
+        ]).group_by(ranked.c.from_state, ranked.c.to_state).order_by(ranked.c.from_state, ranked.c.to_state)
+
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            return [{
+                "from": from_state,
+                "to": to_state,
+                "count": count,
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+            } for from_state, to_state, count, p50, p95, p99 in session.execute(query)]
+
+    def flush(self):
+        """
+        Write the states recorded by the write-behind buffer
+        :return: number of written states
+        """
+        if self.buffer is None:
+            return 0
+        return self.buffer.flush()
+
+    def update(self, mac: str, state: str):
+        """
+        Set the state of a machine, through the write-behind buffer if enabled
+        :param mac: MAC address
+        :param state: the state name
+        :return: None
+        """
+        if self.buffer is not None:
+            return self.buffer.record(mac, state)
+        self.update_states({mac: (state, datetime.datetime.utcnow())})
+
+    def update_many(self, macs: list, state: str):
+        """
+        Set the same state to many machines in one transaction
+        :param macs: list of MAC addresses
+        :param state: the state name
+        :return: None
+        """
+        now = datetime.datetime.utcnow()
+        if self.buffer is not None:
+            for mac in macs:
+                self.buffer.record(mac, state, now)
+            return
+        self.update_states({mac: (state, now) for mac in macs})
+
+
+class MachineStateBuffer:
+    """
+    Write-behind buffer of the machine states
+    The states of each MAC are kept in memory in their order, with the date they were recorded. The buffer is written
+    by a background thread every flush_interval seconds, or as soon as flush_size MAC are pending
+
+    Transitions: a MAC changing of state between two flushes keeps each of its states, they are written in rounds, one
+    transaction by round, so the transitions log every change. The consecutive records of the same state are coalesced
+    into the first one, the date of the change
+
+    Crash semantics: the states are bookkeeping, not a source of truth
+    - the pending states are written at the normal exit of the process
+    - a killed process loses at most the states recorded since the last flush: flush_interval seconds or flush_size MAC
+    - a failed flush keeps the states not written yet, they are retried at the next flush before the ones recorded
+      meanwhile
+    - a state never replaces a more recent one flushed by another process: the dates are the ones of the record
+    """
+
+    def __init__(self, write, flush_interval: float, flush_size: int):
+        """
+        :param write: function taking a dict mac -> (state name, date)
+        :param flush_interval: seconds between two flushes
+        :param flush_size: number of pending MAC triggering a flush
+        """
+        self.write = write
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # mac -> list of (state name, date) in the record order
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        atexit.register(self.flush)
+
+    def _start(self):
+        # started lazily to be owned by the process recording, the gunicorn workers are forked
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="machine-state-buffer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def record(self, mac: str, state: str, date: datetime.datetime = None):
+        """
+        Record the state of a machine after its pending ones
+        :param mac: MAC address
+        :param state: the state name
+        :param date: date of the state, now by default
+        :return: None
+        """
+        with self._lock:
+            states = self._pending.setdefault(mac, [])
+            if not states or states[-1][0] != state:
+                states.append((state, date if date else datetime.datetime.utcnow()))
+            depth = len(self._pending)
+            self._start()
+
+        PENDING_STATES.set(depth)
+        if depth >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Write the pending states, one transaction by round of states
+        :return: number of written states
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, dict()
+            PENDING_STATES.set(0)
+            if not pending:
+                return 0
+
+            written = 0
+            for n in range(max(len(states) for states in pending.values())):
+                states = {mac: states[n] for mac, states in pending.items() if len(states) > n}
+                try:
+                    self.write(states)
+                    written += len(states)
+                except Exception as e:
+                    logger.error("fail to flush %d states: %s" % (len(states), e))
+                    with self._lock:
+                        for mac, states in pending.items():
+                            if len(states) > n:
+                                self._pending[mac] = states[n:] + self._pending.get(mac, [])
+                        PENDING_STATES.set(len(self._pending))
+                    break
+
+            logger.debug("flushed %d states" % written)
+            return written
@@ -0,0 +1,367 @@
+"""
+Read models of the list endpoints
+Core select() statements projecting only the columns of the responses, the rows are turned into dicts without
+loading the ORM entities in the identity map of the session
+The machines are ordered by id, the key of the pagination
+The dicts are yielded by batches of rows read from a server-side cursor
+"""
+from sqlalchemy import and_, case, distinct, exists, func, select
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql import Select
+
+from enjoliver.db import session_commit
+from enjoliver.model import (
+    LifecycleCoreosInstall,
+    LifecycleIgnition,
+    LifecycleRolling,
+    Machine,
+    MachineDisk,
+    MachineInterface,
+    Schedule,
+)
+
+machine = Machine.__table__
+interface = MachineInterface.__table__
+disk = MachineDisk.__table__
+schedule = Schedule.__table__
+
+boot_interface = interface.alias("boot_interface")
+# the boot interface of each machine
+machine_boot = machine.join(boot_interface, and_(
+    boot_interface.c.machine_id == machine.c.id,
+    boot_interface.c.as_boot == True))
+
+# rows fetched at once from the server-side cursor
+batch_size = 500
+
+
+def stream(sess_maker: sessionmaker, read_model, *args, **kwargs):
+    """
+    Run the read model in its own transaction, closed when the generator is exhausted or closed
+    :param sess_maker: the DB session factory
+    :param read_model: one of the read model functions of this module
+    :return: generator of dict
+    """
+    with session_commit(sess_maker=sess_maker) as session:
+        yield from read_model(session, *args, **kwargs)
+
+
+class Page:
+    """
+    Keyset pagination of the machines by id
+    """
+
+    def __init__(self, limit: int = None, after: int = None):
+        """
+        :param limit: max number of machines, None for all
+        :param after: id of the last machine of the previous page, None for the first page
+        """
+        self.limit = limit
+        self.after = after
+        self.count = 0
+        self.last = None
+
+    def apply(self, query, key):
+        """
+        :param query: select or ORM query of machines
+        :param key: the machine id column
+        :return: the query of the page ordered by machine id
+        """
+        if self.after is not None:
+            query = query.where(key > self.after) if isinstance(query, Select) else query.filter(key > self.after)
+        return query.order_by(key).limit(self.limit)
+
+    def track(self, machine_id: int):
+        self.count += 1
+        self.last = machine_id
+
+    @property
+    def next_after(self):
+        """
+        :return: the after of the next page, None if this page is the last one
+        """
+        if self.limit is not None and self.count == self.limit:
+            return self.last
+        return None
+
+
+def _batches(session: Session, query, page: Page):
+    """
+    :param query: select of machines, the first column is the machine id
+    :return: generator of lists of at most batch_size rows of the page
+    """
+    page = page if page else Page()
+    result = session.execute(page.apply(query, machine.c.id).execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                page.track(row[0])
+            yield rows
+    finally:
+        result.close()
+
+
+def disks_by_machine(session: Session, machine_ids=None):
+    """
+    :param session: the session of the transaction
+    :param machine_ids: list of the machines, None for all
+    :return: dict machine_id -> list of {"path", "size-bytes"}
+    """
+    query = select([disk.c.machine_id, disk.c.path, disk.c.size]).order_by(disk.c.id)
+    if machine_ids is not None:
+        query = query.where(disk.c.machine_id.in_(machine_ids))
+
+    disks = dict()
+    for row in session.execute(query):
+        disks.setdefault(row.machine_id, []).append({"path": row.path, "size-bytes": row.size})
+    return disks
+
+
+def available_machines(session: Session, page: Page = None):
+    """
+    The machines with a boot interface and without any schedule
+    :param session: the session of the transaction
+    :param page: the page of machines, None for all
+    :return: generator of dict
+    """
+    unscheduled = ~exists().where(schedule.c.machine_id == machine.c.id)
+    query = select([
+        machine.c.id,
+        machine.c.created_date,
+        boot_interface.c.mac,
+        boot_interface.c.ipv4,
+        boot_interface.c.cidrv4,
+        boot_interface.c.as_boot,
+        boot_interface.c.name,
+        boot_interface.c.fqdn,
+        boot_interface.c.netmask,
+    ]).select_from(machine_boot).where(unscheduled)
+
+    for rows in _batches(session, query, page):
+        disks = disks_by_machine(session, [row.id for row in rows])
+        for row in rows:
+            yield {
+                "mac": row.mac,
+                "ipv4": row.ipv4,
+                "cidrv4": row.cidrv4,
+                "as_boot": row.as_boot,
+                "name": row.name,
+                "fqdn": row.fqdn,
+                "netmask": row.netmask,
+                "created_date": row.created_date,
+                "disks": disks.get(row.id, []),
+            }
+
+
+def scheduled_machines(session: Session, roles: list, page: Page = None):
+    """
+    The machines scheduled with a role, or with exactly the given set of roles
+    :param session: the session of the transaction
+    :param roles: list of the scheduled roles
+    :param page: the page of machines, None for all
+    :return: generator of dict, their roles are the role if only one is given
+    """
+    if len(roles) == 1:
+        scheduled = select([schedule.c.machine_id]).where(schedule.c.role == roles[0])
+    else:
+        role_set = list(set(roles))
+        scheduled = select([schedule.c.machine_id]) \
+            .group_by(schedule.c.machine_id) \
+            .having(func.count(distinct(schedule.c.role)) == len(role_set)) \
+            .having(func.sum(case([(schedule.c.role.in_(role_set), 0)], else_=1)) == 0)
+    query = select([
+        machine.c.id,
+        machine.c.created_date,
+        boot_interface.c.mac,
+        boot_interface.c.ipv4,
+        boot_interface.c.cidrv4,
+        boot_interface.c.gateway,
+        boot_interface.c.as_boot,
+        boot_interface.c.name,
+        boot_interface.c.fqdn,
+        boot_interface.c.netmask,
+    ]).select_from(machine_boot).where(machine.c.id.in_(scheduled))
+
+    for rows in _batches(session, query, page):
+        disks = disks_by_machine(session, [row.id for row in rows])
+        for row in rows:
+            yield {
+                "mac": row.mac,
+                "ipv4": row.ipv4,
+                "cidrv4": row.cidrv4,
+                "gateway": row.gateway,
+                "as_boot": row.as_boot,
+                "name": row.name,
+                "netmask": row.netmask,
+                "roles": roles[0] if len(roles) == 1 else roles,
+                "created_date": row.created_date,
+                "fqdn": row.fqdn,
+                "disks": disks.get(row.id, []),
+            }
+
+
+def role_ips(session: Session, role: str):
+    """
+    :param session: the session of the transaction
+    :param role: the scheduled role
+    :return: list of the IPv4 of the boot interfaces
+    """
+    query = select([boot_interface.c.ipv4]) \
+        .select_from(machine_boot.join(schedule, schedule.c.machine_id == machine.c.id)) \
+        .where(schedule.c.role == role)
+    return [row.ipv4 for row in session.execute(query.order_by(machine.c.id))]
+
+
+def ignition_status(session: Session, page: Page = None):
+    """
+    :param session: the session of the transaction
+    :param page: the page of machines, None for all
+    :return: generator of dict, one by machine reporting its ignition
+    """
+    lifecycle = LifecycleIgnition.__table__
+    query = select([
+        machine.c.id,
+        lifecycle.c.up_to_date,
+        boot_interface.c.fqdn,
+        boot_interface.c.mac,
+        boot_interface.c.cidrv4,
+        machine.c.created_date,
+        machine.c.updated_date,
+        lifecycle.c.last_change_date,
+    ]).select_from(machine_boot.join(lifecycle, lifecycle.c.machine_id == machine.c.id))
+
+    for rows in _batches(session, query, page):
+        for row in rows:
+            yield {
+                "up-to-date": row.up_to_date,
+                "fqdn": row.fqdn,
+                "mac": row.mac,
+                "cidrv4": row.cidrv4,
+                "created_date": row.created_date,
+                "updated_date": row.updated_date,
+                "last_change_date": row.last_change_date,
+            }
+
+
+def coreos_install_status(session: Session, page: Page = None):
+    """
+    :param session: the session of the transaction
+    :param page: the page of machines, None for all
+    :return: generator of dict, one by machine reporting its coreos-install
+    """
+    lifecycle = LifecycleCoreosInstall.__table__
+    query = select([
+        machine.c.id,
+        boot_interface.c.mac,
+        boot_interface.c.fqdn,
+        boot_interface.c.cidrv4,
+        lifecycle.c.success,
+        lifecycle.c.created_date,
+        lifecycle.c.updated_date,
+    ]).select_from(machine_boot.join(lifecycle, lifecycle.c.machine_id == machine.c.id))
+
+    for rows in _batches(session, query, page):
+        for row in rows:
+            yield {
+                "mac": row.mac,
+                "fqdn": row.fqdn,
+                "cidrv4": row.cidrv4,
+                "success": row.success,
+                "created_date": row.created_date,
+                "updated_date": row.updated_date,
+            }
+
+
+def rolling_status(session: Session, page: Page = None):
+    """
+    :param session: the session of the transaction
+    :param page: the page of machines, None for all
+    :return: generator of dict, one by machine with a rolling policy
+    """
+    lifecycle = LifecycleRolling.__table__
+    query = select([
+        machine.c.id,
+        boot_interface.c.mac,
+        boot_interface.c.fqdn,
+        boot_interface.c.cidrv4,
+        lifecycle.c.enable,
+        lifecycle.c.created_date,
+        lifecycle.c.updated_date,
+    ]).select_from(machine_boot.join(lifecycle, lifecycle.c.machine_id == machine.c.id))
+
+    for rows in _batches(session, query, page):
+        for row in rows:
+            yield {
+                "mac": row.mac,
+                "fqdn": row.fqdn,
+                "cidrv4": row.cidrv4,
+                "enable": bool(row.enable),
+                "created_date": row.created_date,
+                "updated_date": row.updated_date,
+            }
+
+
+def _interfaces_by_machine(session: Session, machine_ids: list):
+    """
+    :param session: the session of the transaction
+    :param machine_ids: the machines
+    :return: dict machine_id -> list of the interfaces as reported by the discovery
+    """
+    interfaces = dict()
+    for row in session.execute(select([
+        interface.c.machine_id,
+        interface.c.as_boot,
+        interface.c.cidrv4,
+        interface.c.fqdn,
+        interface.c.gateway,
+        interface.c.ipv4,
+        interface.c.mac,
+        interface.c.name,
+        interface.c.netmask,
+    ]).where(interface.c.machine_id.in_(machine_ids)).order_by(interface.c.id)):
+        interfaces.setdefault(row.machine_id, []).append({
+            "as_boot": row.as_boot,
+            "cidrv4": row.cidrv4,
+            "fqdn": row.fqdn,
+            "gateway": row.gateway,
+            "ipv4": row.ipv4,
+            "mac": row.mac,
+            "name": row.name,
+            "netmask": row.netmask
+        })
+    return interfaces
+
+
+def discovery(session: Session, page: Page = None):
+    """
+    The discovery data of the machines with a boot interface
+    :param session: the session of the transaction
+    :param page: the page of machines, None for all
+    :return: generator of dict with the boot-info, the interfaces and the disks
+    """
+    query = select([
+        machine.c.id,
+        machine.c.uuid,
+        machine.c.created_date,
+        machine.c.updated_date,
+        boot_interface.c.mac,
+    ]).select_from(machine_boot)
+
+    for rows in _batches(session, query, page):
+        machine_ids = [row.id for row in rows]
+        interfaces = _interfaces_by_machine(session, machine_ids)
+        disks = disks_by_machine(session, machine_ids)
+        for row in rows:
+            yield {
+                "boot-info": {
+                    "uuid": row.uuid,
+                    "created-date": row.created_date,
+                    "updated-date": row.updated_date,
+                    "mac": row.mac
+                },
+                "interfaces": interfaces.get(row.id, []),
+                "disks": disks.get(row.id, [])
+            }
@@ -12,8 +12,10 @@ class RepositoryRegistry:
     The only dependency is the DB session factory: sess_maker.
     """
     # TODO: add other dependencies here (config, cache, ...)
-    def __init__(self, sess_maker: sessionmaker):
+    def __init__(self, sess_maker: sessionmaker, state_flush_interval: float = 0, state_flush_size: int = 500,
+                 state_history_days: int = 30, overview_delta_overlap: float = 30):
         self.discovery = MachineDiscoveryRepository(sess_maker)
-        self.machine_state = MachineStateRepository(sess_maker)
-        self.user_interface = UserInterfaceRepository(sess_maker)
+        self.machine_state = MachineStateRepository(sess_maker, state_flush_interval, state_flush_size,
+                                                    state_history_days)
+        self.user_interface = UserInterfaceRepository(sess_maker, overview_delta_overlap)
         self.machine_schedule = MachineScheduleRepository(sess_maker)
@@ -1,81 +1,160 @@
+import datetime
+
+from sqlalchemy import func, select
 from sqlalchemy.orm import sessionmaker
 
 from enjoliver import sync
 from enjoliver.db import session_commit
-from enjoliver.model import (
-    Machine,
-    MachineInterface,
-    Schedule, MachineDisk,
-    MachineCurrentState,
-    LifecycleIgnition,
-    LifecycleRolling,
-)
+from enjoliver.model import MachineOverview
+from enjoliver.repositories import machine_overview, read_models
 
 
 class UserInterfaceRepository:
     """
     Get the data for the User Interface View
     """
+    overview = MachineOverview.__table__
+
+    # the fields of the overview sortable in SQL
+    sort_columns = {
+        "MAC": overview.c.mac,
+        "FQDN": overview.c.fqdn,
+        "CIDR": overview.c.cidrv4,
+        "LastState": overview.c.last_state,
+        "Roles": overview.c.roles,
+        "DiskProfile": overview.c.disks_gb,
+        "LastReport": overview.c.last_report,
+        "LastChange": overview.c.last_change,
+        "UpToDate": overview.c.up_to_date,
+        "UpdateStrategy": overview.c.update_strategy,
+    }
 
-    def __init__(self, sess_maker: sessionmaker):
+    def __init__(self, sess_maker: sessionmaker, delta_overlap: float = 30):
+        """
+        :param sess_maker: the DB session factory
+        :param delta_overlap: seconds between the refresh date of an overview row and the commit of its transaction
+        """
         self.__sess_maker = sess_maker
+        self.delta_overlap = delta_overlap
+
+    def _overview_query(self, sort: str):
+        """
+        :param sort: a key of sort_columns, prefixed by '-' for the descending order, None for the machine id
+        :return: select of the machine_overview rows
+        """
+        order_by = []
+        if sort:
+            column = self.sort_columns.get(sort.lstrip("-"))
+            if column is None:
+                raise ValueError("sort %s not in [%s]" % (sort, " ".join(sorted(self.sort_columns))))
+            order_by.append(column.desc() if sort[0] == "-" else column.asc())
+        order_by.append(self.overview.c.machine_id)
 
-    def get_machines_overview(self):
+        return select([self.overview]).order_by(*order_by)
+
+    def rebuild_overview(self):
         """
-        TODO refactor this ugly stuff
-        :return:
+        Compute the overview of all the machines, used to fill the table of an existing fleet
+        :return: number of machines
         """
         with session_commit(sess_maker=self.__sess_maker) as session:
-            # Fetching data
-            mis = session.query(MachineInterface).filter(MachineInterface.as_boot == True).all()
-            mds = session.query(MachineDisk).all()
-            mss = session.query(MachineCurrentState).all()
-            lis = session.query(LifecycleIgnition).all()
-            lrs = session.query(LifecycleRolling).all()
-            srs = session.query(Schedule).all()
-
-            data = list()
-            for machine in session.query(Machine):
-                row = dict()
-
-                # Filtering data
-                machine_disks = [md for md in mds if md.machine_id == machine.id]
-                machine_interfaces = [mi for mi in mis if mi.machine_id == machine.id]
-
-                # MachineInterface
-                booting_mac = ""
-                for i in mis:
-                    if i.as_boot is True:
-                        machine_interfaces.append(i)
-                        booting_mac = i.mac
-
-                machine_states = [ms for ms in mss if ms.machine_mac == booting_mac]
-                lifecycle_ignition = [li for li in lis if li.machine_id == machine.id]
-                lifecycle_rolling = [lr for lr in lrs if lr.machine_id == machine.id]
-                machine_schedules = [sr for sr in srs if sr.machine_id == machine.id]
-
-                # Processing data
-                disks = list()
-                if machine_disks:
-                    for disk in machine_disks:
-                        disks.append({
-                            "path": disk.path,
-                            "size-bytes": disk.size
-                        })
-
-                # Adding data
-                row['LastState'] = machine_states[0].state_name if machine_states else None
-                row['FQDN'] = machine_interfaces[0].fqdn if machine_interfaces else None
-                row['CIDR'] = machine_interfaces[0].cidrv4 if machine_interfaces else None
-                row['MAC'] = machine_interfaces[0].mac if machine_interfaces else None
-                row['Roles'] = ",".join([r.role for r in machine_schedules])
-                row['DiskProfile'] = sync.ConfigSyncSchedules.compute_disks_size(disks)
-                row['LastReport'] = lifecycle_ignition[0].updated_date if lifecycle_ignition else None
-                row['UpToDate'] = lifecycle_ignition[0].up_to_date if lifecycle_ignition else None
-                row['LastChange'] = lifecycle_ignition[0].last_change_date if lifecycle_ignition else None
-                row['UpdateStrategy'] = lifecycle_rolling[0].strategy if lifecycle_rolling and lifecycle_rolling[
-                    0].enable else "Disable"
-
-                data.append(row)
-
-        return data
+            return machine_overview.refresh(session)
+
+    def _overview_revision(self, session, since: int = None):
+        """
+        The revisions come from a sequence: a transaction can commit after a greater revision
+        The rows refreshed before the overlap committed, all the lower revisions are visible
+        :return: the since of the next delta, the delta after it overlaps the changes of the last delta_overlap seconds
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.delta_overlap)
+        last_date = select([func.max(self.overview.c.updated_date)]) \
+            .where(self.overview.c.updated_date <= cutoff).as_scalar()
+        revision = session.execute(select([func.max(self.overview.c.revision)])
+                                   .where(self.overview.c.updated_date == last_date)).scalar()
+        return max(revision or 0, since or 0)
+
+    def _delta_query(self, offset: int, sort: str, since: int, page: read_models.Page):
+        """
+        :return: select of the machine_overview rows written after the since revision, paged by revision
+        """
+        if sort or offset:
+            raise ValueError("the delta since a revision can't be sorted or offset")
+        return page.apply(select([self.overview]).where(self.overview.c.revision > since), self.overview.c.revision)
+
+    def _iter_overview(self, session, limit: int = None, offset: int = 0, sort: str = None,
+                       since: int = None, page: read_models.Page = None):
+        if since is not None:
+            page = page if page is not None else read_models.Page(limit)
+            query = self._delta_query(offset, sort, since, page)
+        elif page is not None:
+            if sort:
+                raise ValueError("the pages by machine id can't be sorted by %s" % sort)
+            query = page.apply(select([self.overview]), self.overview.c.machine_id)
+        else:
+            query = self._overview_query(sort).limit(limit).offset(offset)
+
+        result = session.execute(query.execution_options(stream_results=True))
+        try:
+            while True:
+                rows = result.fetchmany(read_models.batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    if page is not None:
+                        page.track(row.revision if since is not None else row.machine_id)
+                    yield {
+                        'LastState': row.last_state,
+                        'FQDN': row.fqdn,
+                        'CIDR': row.cidrv4,
+                        'MAC': row.mac,
+                        'Roles': row.roles,
+                        'DiskProfile': sync.ConfigSyncSchedules.compute_disks_size(
+                            [{"size-bytes": row.disks_gb << 30}] if row.disks_gb is not None else []),
+                        'LastReport': row.last_report,
+                        'UpToDate': row.up_to_date,
+                        'LastChange': row.last_change,
+                        'UpdateStrategy': row.update_strategy,
+                    }
+        finally:
+            result.close()
+
+    def fetch_overview(self, limit: int = None, offset: int = 0, sort: str = None, since: int = None,
+                       page: read_models.Page = None):
+        """
+        Scan the machine_overview table
+        :param limit: max number of machines, None for all
+        :param offset: number of machines to skip
+        :param sort: a key of sort_columns, prefixed by '-' for the descending order, None for the machine id
+        :param since: only the machines written after this revision in the revision order, None for all
+        :param page: keyset page by machine id replacing limit and offset, can't be sorted, by revision with since
+        :return: (list of dict, revision) the revision is the since of the next delta
+        """
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            # read first: the rows up to this revision are visible to the scan
+            revision = self._overview_revision(session, since)
+            return list(self._iter_overview(session, limit, offset, sort, since, page)), revision
+
+    def stream_overview(self, limit: int = None, offset: int = 0, sort: str = None, since: int = None,
+                        page: read_models.Page = None):
+        """
+        Same as fetch_overview without limit, the rows are read from a server-side cursor while the generator is
+        consumed
+        :return: (generator of dict, revision)
+        """
+        if limit is not None or (page is not None and page.limit is not None):
+            raise ValueError("the streamed overview can't be limited")
+        if since is not None:
+            self._delta_query(offset, sort, since, read_models.Page())
+        elif page is not None and sort:
+            raise ValueError("the pages by machine id can't be sorted by %s" % sort)
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            # all the rows up to this revision are visible to the scan
+            revision = self._overview_revision(session, since)
+        return read_models.stream(self.__sess_maker, self._iter_overview, limit, offset, sort, since,
+                                  page), revision
+
+    def get_machines_overview(self, limit: int = None, offset: int = 0, sort: str = None, since: int = None):
+        """
+        :return: list of dict, one by machine
+        """
+        return self.fetch_overview(limit, offset, sort, since)[0]
@@ -0,0 +1,211 @@
+"""
+Reverse DNS resolution used to verify the FQDN reported by the discovery
+"""
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from enjoliver.configs import EnjoliverConfig
+
+logger = logging.getLogger(__name__)
+
+
+class ReverseResolver:
+    """
+    Resolve the IPv4 to their first name with socket.gethostbyaddr through a thread pool
+    The names are kept ttl seconds and the failures negative_ttl seconds
+    Each IPv4 is resolved once at a time, the concurrent callers are waiting the same lookup
+    A lookup not finished before the deadline of the caller keeps running and fills the cache for the next ones
+    """
+    # above this number of entries the expired ones are dropped
+    max_entries = 65536
+
+    def __init__(self, ttl: int, negative_ttl: int, workers: int, deadline: float, tries: int, verify_fqdn: bool,
+                 deferred: bool):
+        """
+        :param ttl: seconds to keep a resolved name
+        :param negative_ttl: seconds to keep a failure
+        :param workers: number of concurrent lookups
+        :param deadline: seconds to wait the lookups of a discovery report
+        :param tries: number of gethostbyaddr by lookup
+        :param verify_fqdn: if False, the reported names are trusted
+        :param deferred: if True, the names are only verified in background
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.deadline = deadline
+        self.tries = tries
+        self.verify_fqdn = verify_fqdn
+        self.deferred = deferred
+
+        # ipv4 -> (expiration, name or None)
+        self._cache = dict()
+        # ipv4 -> Future
+        self._inflight = dict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._background = ThreadPoolExecutor(max_workers=1)
+
+    def _lookup(self, ipv4: str, delay: float = 0):
+        name = None
+        try:
+            time.sleep(delay)
+            for i in range(self.tries):
+                if i > 0:
+                    time.sleep(i / 10)
+                try:
+                    name = socket.gethostbyaddr(ipv4)[0]
+                    logger.debug("succeed to make dns request for %s:%s" % (ipv4, name))
+                    break
+                except (OSError, TypeError, UnicodeError) as e:
+                    logger.error("%d/%d fail to resolve %s err: %s" % (i + 1, self.tries, ipv4, e))
+        finally:
+            # an unexpected error is cached as a failure, the next callers don't wait this lookup
+            with self._lock:
+                self._cache[ipv4] = (time.time() + (self.ttl if name else self.negative_ttl), name)
+                self._inflight.pop(ipv4, None)
+        return name
+
+    def _prune(self, now: float):
+        for ipv4 in [k for k, v in self._cache.items() if v[0] <= now]:
+            del self._cache[ipv4]
+
+    def resolve_many(self, ipv4s, timeout, fresh: bool = False, delay: float = 0):
+        """
+        Resolve the IPv4 concurrently
+        :param ipv4s: iterable of IPv4
+        :param timeout: seconds to wait the lookups, None to wait until they are all finished
+        :param fresh: if True, the cached names are looked up again
+        :param delay: seconds to wait before the new lookups
+        :return: dict ipv4 -> name or None, the IPv4 not resolved in time are missing
+        """
+        resolved = dict()
+        futures = dict()
+        now = time.time()
+        with self._lock:
+            if len(self._cache) > self.max_entries:
+                self._prune(now)
+            for ipv4 in set(ipv4s):
+                entry = self._cache.get(ipv4)
+                if entry is not None and entry[0] > now and not fresh:
+                    resolved[ipv4] = entry[1]
+                    continue
+                future = self._inflight.get(ipv4)
+                if future is None:
+                    future = self._pool.submit(self._lookup, ipv4, delay)
+                    self._inflight[ipv4] = future
+                futures[ipv4] = future
+
+        if futures:
+            wait(list(futures.values()), timeout=timeout)
+            for ipv4, future in futures.items():
+                if future.done() and future.exception() is not None:
+                    logger.error("fail to resolve %s err: %s" % (ipv4, future.exception()))
+                    resolved[ipv4] = None
+                elif future.done():
+                    resolved[ipv4] = future.result()
+                else:
+                    logger.warning("deadline of %ss exceeded to resolve %s" % (timeout, ipv4))
+        return resolved
+
+    @staticmethod
+    def _reported_names(interface: dict):
+        try:
+            return list(interface["fqdn"])
+        except (KeyError, TypeError):
+            logger.warning("No fqdn for %s returning None" % interface.get("ipv4"))
+            return []
+
+    def verify_many(self, interfaces: list, timeout):
+        """
+        Verify the names reported for each interface match the reverse DNS of its IPv4
+        :param interfaces: list of the interfaces of the discovery data
+        :param timeout: seconds to wait the lookups, None to wait until they are all finished
+        :return: (list of fqdn or None, set of the indexes of the interfaces not verified in time)
+        """
+        reported = [self._reported_names(i) for i in interfaces]
+        resolved = dict()
+        if self.verify_fqdn:
+            start = time.time()
+            resolved = self.resolve_many([i["ipv4"] for n, i in enumerate(interfaces) if reported[n]], timeout)
+            # the first name of an IPv4 having several PTR records changes between the lookups
+            for i in range(1, self.tries):
+                mismatched = {interface["ipv4"] for n, interface in enumerate(interfaces)
+                              if resolved.get(interface["ipv4"]) and
+                              resolved[interface["ipv4"]] not in [name.rstrip(".") for name in reported[n]]}
+                if not mismatched:
+                    break
+                remaining = None if timeout is None else max(0, timeout - (time.time() - start))
+                logger.warning("%d/%d fail to verify the domain names of %s" % (i, self.tries, " ".join(mismatched)))
+                retried = self.resolve_many(mismatched, remaining, fresh=True, delay=i / 10)
+                for ipv4 in mismatched:
+                    if ipv4 in retried:
+                        resolved[ipv4] = retried[ipv4]
+                    else:
+                        del resolved[ipv4]
+
+        fqdns, late = [], set()
+        for n, interface in enumerate(interfaces):
+            fqdn_list = []
+            for name in reported[n]:
+                if self.verify_fqdn is False:
+                    logger.warning("Adding a non verified fqdn entry: %s" % name)
+                    fqdn_list.append(name)
+                    continue
+                if interface["ipv4"] not in resolved:
+                    late.add(n)
+                    break
+                if name[-1] == ".":
+                    name = name[:-1]
+                if name == resolved[interface["ipv4"]]:
+                    fqdn_list.append(name)
+                else:
+                    logger.warning("fail to verify domain name discoveryC %s != %s socket.gethostbyaddr for %s %s" % (
+                        name, resolved[interface["ipv4"]], interface["ipv4"], interface["mac"]))
+
+            if len(fqdn_list) > 1:
+                raise AttributeError("Should be only one: %s" % fqdn_list)
+            fqdns.append(fqdn_list[0] if fqdn_list else None)
+
+        return fqdns, late
+
+    def verify(self, interface: dict):
+        """
+        Verify the names reported for the interface within the deadline
+        :param interface: an interface of the discovery data
+        :return: fqdn or None
+        """
+        fqdns, _ = self.verify_many([interface], self.deadline)
+        return fqdns[0]
+
+    def defer(self, fn, *args):
+        """
+        Run the function in the background thread of the resolver
+        """
+
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("fail to run deferred %s: %s" % (fn.__name__, e))
+
+        return self._background.submit(run)
+
+
+def new_resolver(ec: EnjoliverConfig) -> ReverseResolver:
+    """
+    Create the resolver of the current process
+    :param ec: the EnjoliverConfig instance used to get config values
+    :return: ReverseResolver
+    """
+    return ReverseResolver(
+        ttl=ec.discovery_dns_ttl,
+        negative_ttl=ec.discovery_dns_negative_ttl,
+        workers=ec.discovery_dns_workers,
+        deadline=ec.discovery_dns_deadline,
+        tries=ec.discovery_dns_tries,
+        verify_fqdn=ec.discovery_fqdn_verify,
+        deferred=ec.discovery_fqdn_deferred,
+    )
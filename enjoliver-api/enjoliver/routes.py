@@ -2,25 +2,89 @@ import logging
 import time
 
 import requests
-from flask import Flask, request, json, jsonify, render_template, Response, make_response
+from flask import Flask, current_app, request, json, jsonify, render_template, Response, make_response
 from sqlalchemy.orm import sessionmaker
 from werkzeug.contrib.cache import BaseCache
 
 from enjoliver import crud, ops, tools
+from enjoliver.assets import AssetCache, stream_upstream
 from enjoliver.configs import EnjoliverConfig
 from enjoliver.db import session_commit
+from enjoliver.ignition import IgnitionCache, canonical_digest
 from enjoliver.model import MachineStates, ScheduleRoles
+from enjoliver.repositories import read_models
 from enjoliver.repositories.registry import RepositoryRegistry
 
 logger = logging.getLogger(__name__)
 
+# streamed formats of the list routes
+stream_mimetypes = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _list_args(paginated=True):
+    """
+    Parse the query parameters shared by the list routes
+    :param paginated: if the route accepts the limit and after parameters
+    :return: (read_models.Page, streamed format or None)
+    """
+    limit = int(request.args["limit"]) if request.args.get("limit") else None
+    after = int(request.args["after"]) if request.args.get("after") else None
+    if not paginated and (limit is not None or after is not None):
+        raise ValueError("limit and after not supported by %s" % request.path)
+    if limit is not None and limit < 0:
+        raise ValueError("negative limit")
+    stream = request.args.get("stream")
+    if stream is not None and stream not in stream_mimetypes:
+        raise ValueError("stream %s not in [%s]" % (stream, " ".join(sorted(stream_mimetypes))))
+    return read_models.Page(limit=limit, after=after), stream
+
+
+def _serialize(rows, stream: str, encoder, sort_keys: bool):
+    """
+    The generator runs after the request context is gone, the encoder of the app is given by the caller
+    """
+    if stream == "ndjson":
+        for row in rows:
+            yield json.dumps(row, cls=encoder, sort_keys=sort_keys) + "\n"
+        return
+    yield "["
+    for i, row in enumerate(rows):
+        yield ("," if i else "") + json.dumps(row, cls=encoder, sort_keys=sort_keys)
+    yield "]"
+
+
+def _list_response(rows, page: read_models.Page, stream: str = None):
+    """
+    Response of a list route, the X-Next-After header is the after of the next page
+    :param rows: iterable of dict
+    :param page: the page of the rows, filled while they are consumed
+    :param stream: None to jsonify the list, json or ndjson to serialize the rows while they are read
+    :return: flask.Response
+    """
+    if stream is None:
+        resp = make_response(jsonify(list(rows)))
+    else:
+        if page.limit is not None:
+            # the header is sent before the body, the page is read first
+            rows = list(rows)
+        # the dates are serialized by the encoder of jsonify
+        resp = Response(_serialize(rows, stream, current_app.json_encoder, current_app.config["JSON_SORT_KEYS"]),
+                        mimetype=stream_mimetypes[stream])
+    if page.next_after is not None:
+        resp.headers["X-Next-After"] = str(page.next_after)
+    return resp
+
 
 def register_routes(
         app: Flask,
         ec: EnjoliverConfig,
         cache: BaseCache,
         sess_maker: sessionmaker,
-        registry: RepositoryRegistry):
+        registry: RepositoryRegistry,
+        matchbox_session: requests.Session):
     """
     Register all of the routes. Functions are sorted by alphabetical order, uri of the route being the key.
 
@@ -29,7 +93,23 @@ def register_routes(
     :param cache: the werkzeug cache instance
     :param sess_maker: the DB session factory
     :param registry: the service registry
+    :param matchbox_session: the HTTP session to matchbox, keeping alive a pool of connections
     """
+    ignition_cache = IgnitionCache(
+        cache=cache,
+        matchbox_session=matchbox_session,
+        matchbox_uri=ec.matchbox_uri,
+        timeout=ec.ignition_cache_ttl,
+    )
+    asset_cache = None
+    if ec.assets_cache_max_bytes > 0:
+        asset_cache = AssetCache(
+            matchbox_session=matchbox_session,
+            cache_dir=ec.assets_cache_dir,
+            max_bytes=ec.assets_cache_max_bytes,
+            revalidate_seconds=ec.assets_cache_revalidate_sec,
+            chunk_size=ec.assets_chunk_size,
+        )
 
     @app.errorhandler(404)
     def not_found(error):
@@ -67,6 +147,10 @@ def register_routes(
         responses:
           200:
             description: Content of the asset
+          206:
+            description: Partial content of the asset
+          304:
+            description: Not modified
           404:
             description: Not valid
             schema:
@@ -76,10 +160,13 @@ def register_routes(
         matchbox_uri = app.config.get("MATCHBOX_URI")
         if matchbox_uri:
             url = "%s/assets/%s" % (matchbox_uri, path)
-            matchbox_resp = requests.get(url)
-            resp = matchbox_resp.content
-            matchbox_resp.close()
-            return Response(response=resp, mimetype="application/octet-stream")
+            try:
+                if asset_cache is not None:
+                    return asset_cache.serve(path, url, request)
+                return stream_upstream(matchbox_session, url, request.headers, ec.assets_chunk_size)
+            except requests.RequestException as e:
+                app.logger.error("fail to query matchbox assets %s" % e)
+                return Response("matchbox doesn't respond", status=502, mimetype="text/plain")
 
         return Response("matchbox=%s" % matchbox_uri, status=404, mimetype="text/plain")
 
@@ -92,13 +179,27 @@ def register_routes(
         ---
         tags:
           - ops
+        parameters:
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the entries while they are read
         responses:
           200:
             description: Backup playbook
             schema:
                 type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
         """
-        return jsonify(crud.BackupExport(sess_maker=sess_maker).get_playbook())
+        try:
+            page, stream = _list_args(paginated=False)
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        return _list_response(crud.BackupExport(sess_maker=sess_maker).iter_playbook(), page, stream)
 
     @app.route('/boot.ipxe', methods=['GET'])
     @app.route('/boot.ipxe.0', methods=['GET'])
@@ -187,6 +288,54 @@ def register_routes(
             logger.error("fail to store discovery data: %s -> %s" % (request.get_data(), e))
             return err
 
+    @app.route('/discovery/batch', methods=['POST'])
+    def record_discovery_batch():
+        """
+        Discovery
+        Report the current facts of many machines as a JSON list or as NDJSON, one machine by line
+        ---
+        tags:
+          - discovery
+        responses:
+          200:
+            description: Count of new, updated and error and the result of each machine
+            schema:
+                type: dict
+          406:
+            description: The body isn't a JSON list nor NDJSON
+        """
+        app.logger.info("%s %s" % (request.method, request.url))
+        body = request.get_data(as_text=True)
+        try:
+            discovery_list = json.loads(body)
+            if not isinstance(discovery_list, list):
+                discovery_list = [discovery_list]
+        except ValueError:
+            discovery_list = []
+            for line in body.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    discovery_list.append(json.loads(line))
+                except ValueError:
+                    # keep its index, reported as an error by the repository
+                    discovery_list.append(None)
+
+        if not discovery_list:
+            logger.error("fail to parse discovery batch: %s" % body[:1024])
+            return jsonify({"total": 0, "new": 0, "updated": 0, "error": 0, "results": []}), 406
+
+        results = registry.discovery.upsert_many(discovery_list, ec.discovery_batch_chunk_size)
+        registry.machine_state.update_many(
+            [r["mac"] for r in results if r["result"] != "error"],
+            MachineStates.discovery)
+        cache.delete("/discovery")
+
+        summary = {"total": len(results), "new": 0, "updated": 0, "error": 0, "results": results}
+        for r in results:
+            summary[r["result"]] += 1
+        return jsonify(summary), 200
+
     @app.route('/discovery', methods=['GET'])
     def get_discovery_data():
         """
@@ -195,18 +344,59 @@ def register_routes(
         ---
         tags:
           - discovery
+        parameters:
+          - name: limit
+            in: query
+            type: integer
+            description: max number of machines, the X-Next-After header is set if there are more
+          - name: after
+            in: query
+            type: integer
+            description: the X-Next-After header of the previous page
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the rows while they are read
         responses:
           200:
             description: Discovery data
             schema:
                 type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
         """
+        try:
+            page, stream = _list_args()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        if request.args:
+            return _list_response(read_models.stream(sess_maker, read_models.discovery, page), page, stream)
+
         all_data = cache.get(request.path)
         if not all_data:
             all_data = registry.discovery.fetch_all_discovery()
             cache.set(request.path, all_data, timeout=30)
         return jsonify(all_data)
 
+    @app.route('/fleet-generation', methods=['GET'])
+    def fleet_generation():
+        """
+        Fleet generation
+        Incremented by each change of the discovery data or the schedules of the machines
+        ---
+        tags:
+          - scheduler
+        responses:
+          200:
+            description: The current fleet generation
+            schema:
+                type: dict
+        """
+        return jsonify({"fleet-generation": registry.machine_schedule.get_fleet_generation()})
+
     @app.route('/healthz', methods=['GET'])
     def healthz():
         """
@@ -221,7 +411,7 @@ def register_routes(
             schema:
                 type: dict
         """
-        data = ops.healthz(app, sess_maker, request)
+        data = ops.healthz(app, sess_maker, request, matchbox_session)
         res = jsonify(data), 503 if data["global"] is False else 200
         resp = make_response(res)
         resp.headers['Access-Control-Allow-Origin'] = '*'
@@ -241,6 +431,8 @@ def register_routes(
             description: Ignition configuration
             schema:
                 type: dict
+          304:
+            description: Ignition configuration not modified since the given ETag
           403:
             description: Matchbox unavailable
             schema:
@@ -267,10 +459,14 @@ def register_routes(
             try:
                 # remove the -pxe from the path because matchbox only serve /ignition
                 path = request.full_path.replace("/ignition-pxe?", "/ignition?")
-                matchbox_resp = requests.get("%s%s" % (matchbox_uri, path))
-                resp = matchbox_resp.content
-                matchbox_resp.close()
-                return Response(resp, status=matchbox_resp.status_code, mimetype="text/plain")
+                status, content, etag = ignition_cache.get(path)
+                if etag is not None and etag in request.if_none_match:
+                    resp = Response(status=304)
+                else:
+                    resp = Response(content, status=status, mimetype="text/plain")
+                if etag is not None:
+                    resp.set_etag(etag)
+                return resp
             except requests.RequestException as e:
                 app.logger.error("fail to query matchbox ignition %s" % e)
                 return Response("matchbox doesn't respond", status=502, mimetype="text/plain")
@@ -315,6 +511,7 @@ def register_routes(
         data = json.loads(request.data)
         versions.update({filename: data[filename]})
         cache.set("ignition-version", versions, timeout=0)
+        ignition_cache.set_versions(versions)
         return jsonify({"new": new_entry, "total": len(versions)})
 
     @app.route('/install-authorization/<string:request_raw_query>')
@@ -373,7 +570,7 @@ def register_routes(
         """
         app.logger.info("%s %s" % (request.method, request.url))
         try:
-            matchbox_resp = requests.get(
+            matchbox_resp = matchbox_session.get(
                 "%s%s" % (
                     app.config["MATCHBOX_URI"],
                     request.full_path))
@@ -398,13 +595,35 @@ def register_routes(
         ---
         tags:
           - lifecycle
+        parameters:
+          - name: limit
+            in: query
+            type: integer
+            description: max number of machines, the X-Next-After header is set if there are more
+          - name: after
+            in: query
+            type: integer
+            description: the X-Next-After header of the previous page
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the rows while they are read
         responses:
           200:
             description: CoreOS Install status list
             schema:
                 type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
         """
-        return jsonify(crud.FetchLifecycle(sess_maker=sess_maker).get_all_coreos_install_status())
+        try:
+            page, stream = _list_args()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        return _list_response(read_models.stream(sess_maker, read_models.coreos_install_status, page), page, stream)
 
     @app.route("/lifecycle/coreos-install/<string:status>/<string:request_raw_query>", methods=["POST"])
     def report_lifecycle_coreos_install(status, request_raw_query):
@@ -446,42 +665,75 @@ def register_routes(
         ---
         tags:
           - lifecycle
+        parameters:
+          - name: limit
+            in: query
+            type: integer
+            description: max number of machines, the X-Next-After header is set if there are more
+          - name: after
+            in: query
+            type: integer
+            description: the X-Next-After header of the previous page
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the rows while they are read
         responses:
           200:
             description: Ignition Update status
             schema:
                 type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
         """
-        return jsonify(crud.FetchLifecycle(sess_maker=sess_maker).get_all_updated_status())
+        try:
+            page, stream = _list_args()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        return _list_response(read_models.stream(sess_maker, read_models.ignition_status, page), page, stream)
 
     @app.route("/lifecycle/ignition/<string:request_raw_query>", methods=["POST"])
     def submit_lifecycle_ignition(request_raw_query):
         """
         Lifecycle Ignition
+        The body is the ignition of the machine or only its canonical digest as {"digest": "<sha256>"}
         ---
         tags:
           - lifecycle
         responses:
           200:
             description: A JSON of the ignition status
+          210:
+            description: Outdated, only stored when the full ignition is posted
         """
         try:
             machine_ignition = json.loads(request.get_data())
         except ValueError:
             app.logger.error("%s have incorrect content" % request.path)
             return jsonify({"message": "FlaskValueError"}), 406
-        req = requests.get("%s/ignition?%s" % (ec.matchbox_uri, request_raw_query))
-        try:
-            matchbox_ignition = json.loads(req.content)
-            req.close()
-        except ValueError:
+
+        digest_only = isinstance(machine_ignition, dict) and list(machine_ignition.keys()) == ["digest"]
+        if digest_only:
+            machine_digest = machine_ignition["digest"]
+        else:
+            machine_digest = canonical_digest(machine_ignition)
+
+        matchbox_digest = ignition_cache.get_digest("/ignition?%s" % request_raw_query)
+        if matchbox_digest is None:
             app.logger.error("%s have incorrect matchbox return" % request.path)
             return jsonify({"message": "MatchboxValueError"}), 406
 
+        if digest_only and machine_digest != matchbox_digest:
+            # the full ignition is compared before storing the machine as outdated
+            return jsonify({"message": "Outdated"}), 210
+
         with session_commit(sess_maker=sess_maker) as session:
             try:
                 inject = crud.InjectLifecycle(session, request_raw_query=request_raw_query)
-                if json.dumps(machine_ignition, sort_keys=True) == json.dumps(matchbox_ignition, sort_keys=True):
+                if machine_digest == matchbox_digest:
                     inject.refresh_lifecycle_ignition(True)
                     return jsonify({"message": "Up-to-date"}), 200
                 else:
@@ -498,13 +750,35 @@ def register_routes(
         ---
         tags:
           - lifecycle
+        parameters:
+          - name: limit
+            in: query
+            type: integer
+            description: max number of machines, the X-Next-After header is set if there are more
+          - name: after
+            in: query
+            type: integer
+            description: the X-Next-After header of the previous page
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the rows while they are read
         responses:
           200:
             description: Rolling Update status
             schema:
                 type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
         """
-        return jsonify(crud.FetchLifecycle(sess_maker=sess_maker).get_all_rolling_status())
+        try:
+            page, stream = _list_args()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        return _list_response(read_models.stream(sess_maker, read_models.rolling_status, page), page, stream)
 
     @app.route("/lifecycle/rolling/<string:request_raw_query>", methods=["GET"])
     def report_lifecycle_rolling(request_raw_query):
@@ -634,7 +908,7 @@ def register_routes(
         """
         matchbox_uri = app.config.get("MATCHBOX_URI")
         if matchbox_uri:
-            matchbox_resp = requests.get("%s%s" % (matchbox_uri, request.full_path))
+            matchbox_resp = matchbox_session.get("%s%s" % (matchbox_uri, request.full_path))
             resp = matchbox_resp.content
             matchbox_resp.close()
             return Response(resp, status=matchbox_resp.status_code, mimetype="text/plain")
@@ -695,6 +969,45 @@ def register_routes(
         cache.delete(request.path)
         return jsonify(req)
 
+    @app.route('/scheduler/allocate', methods=['POST'])
+    def scheduler_allocate():
+        """
+        Scheduler
+        Affect the roles to a number of available machines in one transaction
+        ---
+        tags:
+          - scheduler
+        responses:
+          406:
+            description: Incorrect body content
+            schema:
+                type: dict
+          200:
+            description: The roles and the allocated MAC, empty if there is not enough available machines
+            schema:
+                type: dict
+        """
+        err = jsonify({u"roles": ScheduleRoles.roles, u"count": "all"}), 406
+        try:
+            req = json.loads(request.get_data())
+            roles, count = req["roles"], req["count"]
+        except (KeyError, TypeError, ValueError):
+            return err
+
+        if count == "all":
+            count = None
+        elif not isinstance(count, int) or isinstance(count, bool) or count < 1:
+            return err
+
+        try:
+            allocated = registry.machine_schedule.allocate(roles, count)
+        except (LookupError, TypeError) as e:
+            logger.error("fail to allocate %s: %s" % (req, e))
+            return err
+
+        cache.delete("/scheduler")
+        return jsonify({"roles": roles, "allocated": allocated})
+
     @app.route('/scheduler/<string:role>', methods=['GET'])
     def get_schedule_by_role(role):
         """
@@ -709,15 +1022,36 @@ def register_routes(
             description: name of the role
             required: true
             type: string
+          - name: limit
+            in: query
+            type: integer
+            description: max number of machines, the X-Next-After header is set if there are more
+          - name: after
+            in: query
+            type: integer
+            description: the X-Next-After header of the previous page
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the rows while they are read
         responses:
           200:
             description: Current schedules for a given role
             schema:
                 type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
         """
+        try:
+            page, stream = _list_args()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
         multi = role.split("&")
-        data = registry.machine_schedule.get_machines_by_roles(*multi)
-        return jsonify(data)
+        return _list_response(read_models.stream(sess_maker, read_models.scheduled_machines, multi, page), page,
+                              stream)
 
     @app.route('/scheduler/available', methods=['GET'])
     def get_available_machine():
@@ -727,14 +1061,35 @@ def register_routes(
         ---
         tags:
           - scheduler
+        parameters:
+          - name: limit
+            in: query
+            type: integer
+            description: max number of machines, the X-Next-After header is set if there are more
+          - name: after
+            in: query
+            type: integer
+            description: the X-Next-After header of the previous page
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the rows while they are read
         responses:
           200:
             description: Current machine available for a schedule
             schema:
                 type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
         """
-        data = registry.machine_schedule.get_available_machines()
-        return jsonify(data)
+        try:
+            page, stream = _list_args()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        return _list_response(read_models.stream(sess_maker, read_models.available_machines, page), page, stream)
 
     @app.route('/scheduler/ip-list/<string:role>', methods=['GET'])
     def get_schedule_role_ip_list(role):
@@ -778,6 +1133,8 @@ def register_routes(
     def sync_notify():
         """
         Sync process notify POST to this route to tell everything is synced for matchbox
+        The body can carry the generation of the synced data as {"generation": "<digest>"}
+        The response carries the fleet-generation, the sync compares it to skip the unchanged fleet
         ---
         tags:
           - matchbox
@@ -788,8 +1145,19 @@ def register_routes(
                 type: dict
         """
         ts = time.time()
+        try:
+            generation = json.loads(request.get_data())["generation"]
+        except (KeyError, TypeError, ValueError):
+            # without generation, every notify invalidates the rendered ignition
+            generation = "%s" % ts
         cache.set("sync-notify", ts, timeout=ec.sync_notify_ttl)
-        return jsonify({"ts": ts, "ttl": ec.sync_notify_ttl}), 200
+        ignition_cache.set_generation(generation)
+        return jsonify({
+            "ts": ts,
+            "ttl": ec.sync_notify_ttl,
+            "generation": generation,
+            "fleet-generation": registry.machine_schedule.get_fleet_generation(),
+        }), 200
 
     @app.route("/sync-notify", methods=["GET"])
     def sync_notify_status():
@@ -817,7 +1185,107 @@ def register_routes(
 
     @app.route('/ui/view/machine', methods=['GET'])
     def user_view_machine():
-        res = jsonify(registry.user_interface.get_machines_overview())
+        """
+        User Interface
+        Overview of the machines
+        ---
+        tags:
+          - ui
+        parameters:
+          - name: limit
+            in: query
+            type: integer
+          - name: offset
+            in: query
+            type: integer
+            default: 0
+          - name: sort
+            in: query
+            type: string
+            description: MAC, FQDN, CIDR, LastState, Roles, DiskProfile, LastReport, LastChange, UpToDate or
+              UpdateStrategy, prefixed by - to reverse
+          - name: since
+            in: query
+            type: integer
+            description: the X-Overview-Revision of a previous response, to only get the machines changed after it
+              by revision, can't be combined with sort or offset
+          - name: after
+            in: query
+            type: integer
+            description: the X-Next-After header of the previous page, can't be combined with sort or offset,
+              the next delta starts at the X-Overview-Revision of the first page
+          - name: stream
+            in: query
+            type: string
+            description: json or ndjson to stream the rows while they are read
+        responses:
+          200:
+            description: One row by machine, the X-Overview-Revision header is the since of the next delta, the
+              machines changed in the last overview_delta_overlap seconds are sent again
+            schema:
+                type: list
+          406:
+            description: Incorrect query parameters
+            schema:
+                type: dict
+        """
+        try:
+            page, stream = _list_args()
+            offset = int(request.args["offset"]) if request.args.get("offset") else 0
+            if offset < 0:
+                raise ValueError("negative offset")
+            since = int(request.args["since"]) if request.args.get("since") else None
+            sort = request.args.get("sort")
+            kwargs = dict(since=since)
+            if since is not None:
+                if sort or offset:
+                    raise ValueError("since can't be combined with sort or offset")
+                kwargs["page"] = page
+            elif sort or offset:
+                if page.after is not None:
+                    raise ValueError("after can't be combined with sort or offset")
+                kwargs.update(limit=page.limit, offset=offset, sort=sort)
+                page = read_models.Page()
+            else:
+                kwargs["page"] = page
+            if stream is None or kwargs.get("limit") is not None or page.limit is not None:
+                overview, revision = registry.user_interface.fetch_overview(**kwargs)
+            else:
+                overview, revision = registry.user_interface.stream_overview(**kwargs)
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        resp = _list_response(overview, page, stream)
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        resp.headers['Access-Control-Expose-Headers'] = 'X-Overview-Revision, X-Next-After'
+        resp.headers['X-Overview-Revision'] = "%d" % revision
+
+        return resp
+
+    @app.route('/ui/view/states/transitions', methods=['GET'])
+    def user_view_state_transitions():
+        """
+        States
+        Time spent in each state before a transition, percentiles in seconds
+        ---
+        tags:
+          - states
+        parameters:
+          - name: since_days
+            in: query
+            type: integer
+            default: 7
+        responses:
+          200:
+            description: List of transitions with the count, p50, p95 and p99
+            schema:
+                type: list
+        """
+        try:
+            since_days = int(request.args.get('since_days', 7))
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+        res = jsonify(registry.machine_state.transitions_percentiles(since_days=since_days))
         resp = make_response(res)
         resp.headers['Access-Control-Allow-Origin'] = '*'
 
@@ -62,32 +62,37 @@ class CommonScheduler:
         raise RuntimeError("timeout after %d" % (
             self.apply_deps_delay * self.apply_deps_tries))
 
-    def _affect(self, available: dict):
-        mac = available["mac"]
-        r = requests.post("%s/scheduler" % self.api_uri, data=json.dumps(
+    def _allocate(self, count):
+        """
+        HTTP Post to the <api_uri>/scheduler/allocate
+        The API takes the available machines and schedules them in one transaction
+        :param count: number of machines, all or nothing, or "all" for every available machine
+        :return: list of the allocated MAC, empty if the API refused the allocation
+        """
+        r = requests.post("%s/scheduler/allocate" % self.api_uri, data=json.dumps(
             {
                 "roles": self.roles,
-                "selector": {
-                    "mac": mac,
-                }
+                "count": count,
             }
         ))
+        content = r.content.decode()
         r.close()
-        logger.info("mac:%s roles:%s" % (mac, str(self.roles)))
-        return 1
-
-    def __apply_available_budget(self):
-        available_list = self.fetch_available(self.api_uri)
-        if len(available_list) >= self.expected_nb:
-            logger.info("starting...")
-            available_list.sort(key=lambda k: k["mac"])
-            for i in range(self.expected_nb):
-                self._affect(available_list[i])
+        if r.status_code != 200:
+            logger.error("fail to allocate %s roles:%s status:%d %s" % (count, self.roles, r.status_code, content))
+            return []
+        allocated = json.loads(content)["allocated"]
+        for mac in allocated:
+            logger.info("mac:%s roles:%s" % (mac, str(self.roles)))
+        return allocated
+
+    def __apply_available_budget(self, done: int):
+        allocated = self._allocate(self.expected_nb - done)
+        if allocated:
+            logger.info("allocated %d/%d" % (len(allocated), self.expected_nb - done))
             return True
 
-        else:
-            logger.info("not enough item %d/%d" % (len(available_list), self.expected_nb))
-            return False
+        logger.info("not enough item to allocate %d/%d" % (self.expected_nb - done, self.expected_nb))
+        return False
 
     def _apply_budget(self):
         url = "%s/scheduler/%s" % (self.api_uri, "&".join(self.roles))
@@ -99,7 +104,7 @@ class CommonScheduler:
                 logger.info("%s -> done:%d expected:%d" % ("&".join(self.roles), len(done), self.expected_nb))
             if len(done) < self.expected_nb:
                 logger.debug("%d < %d" % (len(done), self.expected_nb))
-                return self.__apply_available_budget()
+                return self.__apply_available_budget(len(done))
 
             return True
         except (requests.exceptions.ConnectionError, ValueError):
@@ -112,14 +117,11 @@ class CommonScheduler:
             r = requests.get(url)
             done = len(json.loads(r.content.decode()))
             r.close()
-            available_list = self.fetch_available(self.api_uri)
-            available_list.sort(key=lambda k: k["mac"])
-            if available_list:
-                logger.info("%s -> done:%d available:%d" % ("&".join(self.roles), done, len(available_list)))
-            for available in available_list:
-                done += self._affect(available)
-
-            return done
+            allocated = self._allocate("all")
+            if allocated:
+                logger.info("%s -> done:%d allocated:%d" % ("&".join(self.roles), done, len(allocated)))
+
+            return done + len(allocated)
         except requests.exceptions.ConnectionError:
             logger.error("ConnectionError %s" % url)
             return 0
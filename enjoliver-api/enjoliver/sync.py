@@ -1,11 +1,14 @@
 """
 Sync the matchbox configuration
 """
+import datetime
+import hashlib
 import json
 import logging
 import os
 import re
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from ipaddress import IPv4Interface
 
 import requests
@@ -19,17 +22,81 @@ EC = EnjoliverConfig(importer=__file__)
 logger = logging.getLogger(__name__)
 
 
+def dump_group(kwargs: dict):
+    """
+    Render and write the group of a machine, run by the workers of the sync
+    :param kwargs: the arguments of generator.GenerateGroup
+    :return: the digest of the group
+    """
+    group = generator.GenerateGroup(**kwargs)
+    group.dump()
+    return group.digest
+
+
+class FleetSnapshot(object):
+    """
+    State of the fleet queried once by ConfigSyncSchedules.apply
+    Every machine of a sync cycle is generated from the same snapshot, the metadata shared by the machines are
+    computed once
+    """
+
+    def __init__(self, etcd_member_ip_list: list, control_plane_machines: list, node_machines: list):
+        """
+        :param etcd_member_ip_list: the IPs of the etcd members
+        :param control_plane_machines: the machines scheduled as etcd member and kubernetes control plane
+        :param node_machines: the machines scheduled as kubernetes node
+        """
+        self.etcd_member_ip_list = tuple(sorted(etcd_member_ip_list))
+        self.control_plane_machines = tuple(control_plane_machines)
+        self.node_machines = tuple(node_machines)
+
+        ips = list(self.etcd_member_ip_list)
+        # the metadata of all the machines
+        self.metadata = {
+            "kubernetes_etcd_initial_cluster": ConfigSyncSchedules.order_etcd_named(
+                ips, EC.kubernetes_etcd_peer_port, secure=True),
+            "vault_etcd_initial_cluster": ConfigSyncSchedules.order_etcd_named(
+                ips, EC.vault_etcd_peer_port, secure=True),
+            "fleet_etcd_initial_cluster": ConfigSyncSchedules.order_etcd_named(
+                ips, EC.fleet_etcd_peer_port, secure=True),
+
+            "kubernetes_etcd_member_client_uri_list": ",".join(ConfigSyncSchedules.order_http_uri(
+                ips, EC.kubernetes_etcd_client_port, secure=True)),
+            "vault_etcd_member_client_uri_list": ",".join(ConfigSyncSchedules.order_http_uri(
+                ips, EC.vault_etcd_client_port, secure=True)),
+            "fleet_etcd_member_client_uri_list": ",".join(ConfigSyncSchedules.order_http_uri(
+                ips, EC.fleet_etcd_client_port, secure=True)),
+
+            "vault_ip_list": ",".join(ips),
+            "etcd_member_kubernetes_control_plane_ip_list": ",".join(ips),
+            "etcd_member_kubernetes_control_plane_ip": ips,
+        }
+        # the metadata of the control plane machines
+        self.control_plane_metadata = {
+            "kubernetes_etcd_member_peer_uri_list": ",".join(ConfigSyncSchedules.order_http_uri(
+                ips, EC.kubernetes_etcd_peer_port, secure=True)),
+            "vault_etcd_member_peer_uri_list": ",".join(ConfigSyncSchedules.order_http_uri(
+                ips, EC.vault_etcd_peer_port, secure=True)),
+            "fleet_etcd_member_peer_uri_list": ",".join(ConfigSyncSchedules.order_http_uri(
+                ips, EC.fleet_etcd_peer_port, secure=True)),
+            "kubernetes_apiserver_count": len(self.control_plane_machines),
+        }
+
+
 class ConfigSyncSchedules(object):
     __name__ = "ConfigSyncSchedules"
     sub_ips = EC.sub_ips
     range_nb_ips = EC.range_nb_ips
     skip_ips = EC.skip_ips
 
-    def __init__(self, api_uri: str, matchbox_path: str, ignition_dict: dict, extra_selector_dict=None):
+    def __init__(self, api_uri: str, matchbox_path: str, ignition_dict: dict, extra_selector_dict=None,
+                 workers: int = None, processes: bool = None):
         """
         :param api_uri: http://1.1.1.1:5000
         :param matchbox_path: /var/lib/matchbox
         :param ignition_dict: ignition.yaml
+        :param workers: number of groups written concurrently, default to EC.sync_workers
+        :param processes: use processes instead of threads, default to EC.sync_workers_processes
         """
         self.api_uri = api_uri
         os.environ["API_URI"] = self.api_uri
@@ -37,6 +104,25 @@ class ConfigSyncSchedules(object):
         self.ignition_dict = ignition_dict
         self._reporting_ignitions()
         self.extra_selector = extra_selector_dict if extra_selector_dict else {}
+        # digest of all the groups / profiles dumped during an apply
+        self._generation = hashlib.sha256()
+        self.workers = workers if workers is not None else EC.sync_workers
+        self.processes = processes if processes is not None else EC.sync_workers_processes
+        # pool of the workers during an apply
+        self._pool = None
+        # seconds spent by the last apply in each step
+        self.timings = {}
+        # fleet generation and local inputs of the last full pass, None to run a full pass
+        self._synced_fleet_generation = None
+        self._synced_local = None
+        self._synced_nb = 0
+        # id of the profiles / groups -> (fingerprint of their arguments, digest on disk) as of the last pass
+        self._fingerprints = {}
+        # groups written during the current pass
+        self._written = 0
+        self._store = generator.MatchboxStore.of(matchbox_path)
+        # files of the current pass -> digest, listed in the generation manifest
+        self._manifest_files = {}
         # inMemory cache for http queries
         if EC.sync_cache_ttl > 0:
             self._cache_query = SimpleCache(default_timeout=EC.sync_cache_ttl)
@@ -231,14 +317,31 @@ class ConfigSyncSchedules(object):
 
         return ladder[-1][0]
 
-    def produce_matchbox_data(
+    def snapshot(self):
+        """
+        Query the state of the fleet, the number of queries doesn't depend on the number of machines
+        :return: FleetSnapshot
+        """
+        return FleetSnapshot(
+            etcd_member_ip_list=self.etcd_member_ip_list,
+            control_plane_machines=self._query_roles(*schedulerv2.EtcdMemberKubernetesControlPlane.roles),
+            node_machines=self._query_roles(*schedulerv2.KubernetesNode.roles),
+        )
+
+    def matchbox_data(
             self,
             marker: str,
             i: int,
             m: dict,
             automatic_name: str,
-            update_extra_metadata=None
+            update_extra_metadata=None,
+            snapshot: FleetSnapshot = None,
     ):
+        """
+        Compute the group of a machine
+        :return: dict, the arguments of generator.GenerateGroup
+        """
+        snapshot = snapshot if snapshot else self.snapshot()
         fqdn = automatic_name
         try:
             if m["fqdn"]:
@@ -250,15 +353,12 @@ class ConfigSyncSchedules(object):
         dns_attr = self.get_dns_attr(fqdn)
         etc_hosts.append("127.0.1.1 %s %s" % (fqdn, dns_attr["shortname"]))
         cni_attr = self._cni_ipam(m["cidrv4"], m["gateway"])
-        extra_metadata = {
+        extra_metadata = dict(snapshot.metadata)
+        extra_metadata.update({
             "etc_hosts": etc_hosts,
             # Etcd
             "etcd_name": m["ipv4"],
 
-            "kubernetes_etcd_initial_cluster": self.kubernetes_etcd_initial_cluster,
-            "vault_etcd_initial_cluster": self.vault_etcd_initial_cluster,
-            "fleet_etcd_initial_cluster": self.fleet_etcd_initial_cluster,
-
             "kubernetes_etcd_initial_advertise_peer_urls": "https://%s:%d" % (
                 m["ipv4"], EC.kubernetes_etcd_peer_port),
             "vault_etcd_initial_advertise_peer_urls": "https://%s:%d" % (
@@ -266,10 +366,6 @@ class ConfigSyncSchedules(object):
             "fleet_etcd_initial_advertise_peer_urls": "https://%s:%d" % (
                 m["ipv4"], EC.fleet_etcd_peer_port),
 
-            "kubernetes_etcd_member_client_uri_list": ",".join(self.kubernetes_etcd_member_client_uri_list),
-            "vault_etcd_member_client_uri_list": ",".join(self.vault_etcd_member_client_uri_list),
-            "fleet_etcd_member_client_uri_list": ",".join(self.fleet_etcd_member_client_uri_list),
-
             "kubernetes_etcd_data_dir": EC.kubernetes_etcd_data_dir,
             "vault_etcd_data_dir": EC.vault_etcd_data_dir,
             "fleet_etcd_data_dir": EC.fleet_etcd_data_dir,
@@ -292,14 +388,10 @@ class ConfigSyncSchedules(object):
             "kubernetes_service_cluster_ip_range": EC.kubernetes_service_cluster_ip_range,
 
             # Vault are located with the etcd members
-            "vault_ip_list": ",".join(self.etcd_member_ip_list),
             "vault_port": EC.vault_port,
 
             "kubelet_healthz_port": EC.kubelet_healthz_port,
 
-            "etcd_member_kubernetes_control_plane_ip_list": ",".join(self.etcd_member_ip_list),
-            "etcd_member_kubernetes_control_plane_ip": self.etcd_member_ip_list,
-
             "hyperkube_image_url": EC.hyperkube_image_url,
             "cephtools_image_url": EC.cephtools_image_url,
             # IPAM
@@ -322,94 +414,278 @@ class ConfigSyncSchedules(object):
             "lifecycle_update_polling_sec": EC.lifecycle_update_polling_sec,
             "disk_profile": self.compute_disks_size(m["disks"]),
 
-        }
+        })
         selector = {"mac": m["mac"]}
         selector.update(self.get_extra_selectors(self.extra_selector))
         if update_extra_metadata:
             extra_metadata.update(update_extra_metadata)
-        gen = generator.Generator(
-            api_uri=self.api_uri,
-            group_id="%s-%d" % (marker, i),  # one per machine
-            profile_id=marker,  # link to ignition
-            name=marker,
-            ignition_id="%s.yaml" % self.ignition_dict[marker],
-            matchbox_path=self.matchbox_path,
-            selector=selector,
-            extra_metadata=extra_metadata,
-        )
-        gen.dumps()
+        return {
+            "api_uri": self.api_uri,
+            "_id": "%s-%d" % (marker, i),  # one per machine
+            "name": marker,
+            "profile": marker,  # link to ignition
+            "matchbox_path": self.matchbox_path,
+            "selector": selector,
+            "metadata": extra_metadata,
+        }
+
+    def produce_matchbox_data(
+            self,
+            marker: str,
+            i: int,
+            m: dict,
+            automatic_name: str,
+            update_extra_metadata=None,
+            snapshot: FleetSnapshot = None,
+    ):
+        self.dump_role(marker, [self.matchbox_data(marker, i, m, automatic_name, update_extra_metadata, snapshot)])
 
-    def etcd_member_kubernetes_control_plane(self):
+    @staticmethod
+    def fingerprint(kwargs: dict):
+        """
+        :param kwargs: the arguments of a generator.GenerateGroup or generator.GenerateProfile
+        :return: sha256 of the arguments
+        """
+        return hashlib.sha256(json.dumps(kwargs, sort_keys=True).encode()).hexdigest()
+
+    def _local_fingerprint(self):
+        """
+        The inputs of the groups / profiles outside of the API: the ignition files and the ssh authorized keys
+        :return: sha256 of the inputs
+        """
+        files = []
+        for directory in ("ignition", "ssh_authorized_keys"):
+            path = "%s/%s" % (self.matchbox_path, directory)
+            if os.path.isdir(path) is False:
+                continue
+            for f in sorted(os.listdir(path)):
+                st = os.stat("%s/%s" % (path, f))
+                files.append([directory, f, st.st_mtime, st.st_size])
+        return self.fingerprint({"files": files, "ignition_dict": self.ignition_dict})
+
+    def dump_role(self, marker: str, groups: list):
+        """
+        Write the profile of the role and the groups of its machines changed since the last pass
+        The groups are written by the pool of workers during an apply, the generation is updated in the order
+        of the machines whatever the order of the writes
+        :param marker: the profile of the role
+        :param groups: list of the generator.GenerateGroup arguments, one by machine
+        :return: None
+        """
+        if not groups:
+            return
+        profile_kwargs = {
+            "api_uri": self.api_uri,
+            "_id": marker,
+            "name": marker,
+            "ignition_id": "%s.yaml" % self.ignition_dict[marker],
+            "matchbox_path": self.matchbox_path,
+        }
+        fingerprint = self.fingerprint(profile_kwargs)
+        known = self._fingerprints.get("profiles/%s" % marker)
+        if known and known[0] == fingerprint:
+            profile_digest = known[1]
+        else:
+            profile = generator.GenerateProfile(**profile_kwargs)
+            profile.dump()
+            profile_digest = profile.digest
+            self._fingerprints["profiles/%s" % marker] = fingerprint, profile_digest
+        self._manifest_files["profiles/%s.json" % marker] = profile_digest
+
+        # the machines with the same arguments as the last pass are neither rendered nor written
+        fingerprints = [self.fingerprint(k) for k in groups]
+        digests, changed = [], []
+        for n, fingerprint in enumerate(fingerprints):
+            known = self._fingerprints.get("groups/%s" % groups[n]["_id"])
+            if known and known[0] == fingerprint:
+                digests.append(known[1])
+            else:
+                digests.append(None)
+                changed.append(n)
+
+        to_dump = [groups[n] for n in changed]
+        if self._pool is None:
+            dumped = [dump_group(k) for k in to_dump]
+        else:
+            dumped = self._pool.map(dump_group, to_dump)
+        for n, digest in zip(changed, dumped):
+            digests[n] = digest
+            self._fingerprints["groups/%s" % groups[n]["_id"]] = fingerprints[n], digest
+            # written by another process with the processes workers
+            self._store.track("%s/groups/%s.json" % (self.matchbox_path, groups[n]["_id"]))
+        self._written += len(changed)
+        for n, digest in enumerate(digests):
+            self._manifest_files["groups/%s.json" % groups[n]["_id"]] = digest
+
+        for digest in digests:
+            self._generation.update(profile_digest.encode())
+            self._generation.update(digest.encode())
+
+    def etcd_member_kubernetes_control_plane(self, snapshot: FleetSnapshot = None):
         marker = self.etcd_member_kubernetes_control_plane.__name__
         roles = schedulerv2.EtcdMemberKubernetesControlPlane.roles
 
-        machine_roles = self._query_roles(*roles)
+        snapshot = snapshot if snapshot else self.snapshot()
+        machine_roles = snapshot.control_plane_machines
+        groups = []
         for i, m in enumerate(machine_roles):
-            update_md = {
+            update_md = dict(snapshot.control_plane_metadata)
+            update_md.update({
                 # Roles
                 "roles": ",".join(roles),
-                # Etcd Members
-                "kubernetes_etcd_member_peer_uri_list": ",".join(self.kubernetes_etcd_member_peer_uri_list),
-                "vault_etcd_member_peer_uri_list": ",".join(self.vault_etcd_member_peer_uri_list),
-                "fleet_etcd_member_peer_uri_list": ",".join(self.fleet_etcd_member_peer_uri_list),
 
                 "kubernetes_etcd_peer_port": EC.kubernetes_etcd_peer_port,
                 "vault_etcd_peer_port": EC.vault_etcd_peer_port,
                 "fleet_etcd_peer_port": EC.fleet_etcd_peer_port,
 
                 # K8s Control Plane
-                "kubernetes_apiserver_count": len(machine_roles),
                 "kubernetes_apiserver_insecure_bind_address": EC.kubernetes_apiserver_insecure_bind_address,
-            }
-            self.produce_matchbox_data(
+            })
+            groups.append(self.matchbox_data(
                 marker=marker,
                 i=i,
                 m=m,
                 automatic_name="cp-%d-%s" % (i, m["ipv4"].replace(".", "-")),
                 update_extra_metadata=update_md,
-            )
+                snapshot=snapshot,
+            ))
+        self.dump_role(marker, groups)
         logger.info("synced %d" % len(machine_roles))
         return len(machine_roles)
 
-    def kubernetes_nodes(self):
+    def kubernetes_nodes(self, snapshot: FleetSnapshot = None):
         marker = self.kubernetes_nodes.__name__
         roles = schedulerv2.KubernetesNode.roles
 
-        machine_roles = self._query_roles(*roles)
+        snapshot = snapshot if snapshot else self.snapshot()
+        machine_roles = snapshot.node_machines
+        groups = []
         for i, m in enumerate(machine_roles):
             update_md = {
                 # Roles
                 "roles": ",".join(roles),
             }
-            self.produce_matchbox_data(
+            groups.append(self.matchbox_data(
                 marker=marker,
                 i=i,
                 m=m,
                 automatic_name="no-%d-%s" % (i, m["ipv4"].replace(".", "-")),
                 update_extra_metadata=update_md,
-            )
+                snapshot=snapshot,
+            ))
+        self.dump_role(marker, groups)
         logger.info("synced %d" % len(machine_roles))
         return len(machine_roles)
 
     def notify(self):
         """
-        TODO if we need to notify the API for any reason
-        :return:
+        Notify the API that matchbox is synced with the generation of the dumped groups / profiles
+        :return: the fleet generation of the API, None if the API doesn't have one
         """
-        req = requests.post("%s/sync-notify" % self.api_uri)
+        generation = self._generation.hexdigest()
+        req = requests.post("%s/sync-notify" % self.api_uri, data=json.dumps({"generation": generation}))
         req.close()
-        logger.debug("notified API")
+        logger.debug("notified API with generation %s" % generation)
+        try:
+            return json.loads(req.content.decode()).get("fleet-generation")
+        except (ValueError, AttributeError):
+            return None
+
+    def fleet_generation(self):
+        """
+        Query the fleet generation of the API, incremented by each change of the discovery data or the schedules
+        :return: int, None if the API doesn't have one
+        """
+        req = requests.get("%s/fleet-generation" % self.api_uri)
+        req.close()
+        try:
+            return json.loads(req.content.decode()).get("fleet-generation")
+        except (ValueError, AttributeError):
+            return None
+
+    def _executor(self):
+        if self.workers <= 1:
+            return None
+        if self.processes:
+            return ProcessPoolExecutor(max_workers=self.workers)
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def _cycle(self):
+        timings = {}
+        start = time.time()
+        fleet_generation = None
+        local = self._local_fingerprint()
+        if local != self._synced_local:
+            self._fingerprints = {}
+        elif self._synced_fleet_generation is not None:
+            # nothing was written since the last notify, the API returns its fleet generation
+            fleet_generation = self.notify()
+            timings["notify"] = time.time() - start
+            if fleet_generation == self._synced_fleet_generation:
+                timings["total"] = time.time() - start
+                self.timings = timings
+                logger.info("fleet generation %d unchanged: %d machines synced in %.3fs" % (
+                    fleet_generation, self._synced_nb, timings["total"]))
+                return self._synced_nb
+
+        step = time.time()
+        if fleet_generation is None:
+            fleet_generation = self.fleet_generation()
+        # the queries of the pass are read after the fleet generation
+        self._cache_query.clear()
+        self._generation = hashlib.sha256()
+        self._written = 0
+        self._manifest_files = {}
+        snapshot = self.snapshot()
+        timings["snapshot"] = time.time() - step
+
+        step = time.time()
+        nb = self.etcd_member_kubernetes_control_plane(snapshot)
+        timings["etcd_member_kubernetes_control_plane"] = time.time() - step
+
+        step = time.time()
+        nb += self.kubernetes_nodes(snapshot)
+        timings["kubernetes_nodes"] = time.time() - step
+
+        step = time.time()
+        self._store.commit({
+            "generation": self._generation.hexdigest(),
+            "fleet-generation": fleet_generation,
+            "date": datetime.datetime.utcnow().isoformat(),
+            "files": self._manifest_files,
+        })
+        timings["commit"] = time.time() - step
+
+        step = time.time()
+        self.notify()
+        timings["notify"] = timings.get("notify", 0) + time.time() - step
+
+        self._synced_fleet_generation = fleet_generation
+        self._synced_local = local
+        self._synced_nb = nb
+        timings["total"] = time.time() - start
+        self.timings = timings
+        logger.info("synced %d machines, %d written, in %.3fs with %d workers: %s" % (
+            nb, self._written, timings["total"], max(self.workers, 1),
+            " ".join("%s=%.3fs" % (k, timings[k]) for k in sorted(timings) if k != "total")))
+        return nb
 
     def apply(self, nb_try=2, seconds_sleep=0):
         logger.info("start syncing...")
         for i in range(nb_try):
             try:
-                nb = self.etcd_member_kubernetes_control_plane()
-                nb += self.kubernetes_nodes()
-                self.notify()
-                return nb
+                self._pool = self._executor()
+                try:
+                    return self._cycle()
+                finally:
+                    if self._pool is not None:
+                        self._pool.shutdown()
+                    self._pool = None
             except Exception as e:
                 logger.error("fail to apply the sync %s %s" % (type(e), e))
+                # the files on disk are unknown, the next pass writes everything
+                self._synced_fleet_generation = None
+                self._fingerprints = {}
                 if i + 1 == nb_try:
                     raise
 
@@ -1,11 +1,11 @@
 import logging
-import socket
-import time
 
+from enjoliver import resolver
 from enjoliver.configs import EnjoliverConfig
 
 logger = logging.getLogger(__name__)
 EC = EnjoliverConfig()
+_resolver = None
 
 
 def get_mac_from_raw_query(request_raw_query: str):
@@ -25,46 +25,21 @@ def get_mac_from_raw_query(request_raw_query: str):
     return mac.replace("-", ":")
 
 
+def get_resolver():
+    """
+    The reverse DNS resolver shared by the current process
+    :return: resolver.ReverseResolver
+    """
+    global _resolver
+    if _resolver is None:
+        _resolver = resolver.new_resolver(EC)
+    return _resolver
+
+
 def get_verified_dns_query(interface: dict):
     """
     A discovery machine give a FQDN. This method will do the resolution before insert in the db
     :param interface:
     :return:
     """
-    fqdn_list = []
-    try:
-        for name in interface["fqdn"]:
-            if EC.discovery_fqdn_verify is False:
-                logger.warning("Adding a non verified fqdn entry: %s" % name)
-                fqdn_list.append(name)
-                continue
-
-            # Do 5 tries
-            max_tries = 5
-            for i in range(max_tries):
-                if i > 0:
-                    time.sleep(i / 10)
-                try:
-                    first_name = socket.gethostbyaddr(interface["ipv4"])[0]
-                    logger.debug("succeed to make dns request for %s:%s" % (interface["ipv4"], first_name))
-
-                    if name[-1] == ".":
-                        name = name[:-1]
-
-                    if name == first_name:
-                        fqdn_list.append(name)
-                        break
-                    else:
-                        logger.warning(
-                            "%d/%d fail to verify domain name discoveryC %s != %s socket.gethostbyaddr for %s %s"
-                            % (i + 1, max_tries, name, first_name, interface["ipv4"], interface["mac"]))
-                except socket.herror as e:
-                    logger.error(
-                        "%d/%d fail to verify name:%s ipv4:%s err: %s" % (i + 1, max_tries, name, interface["ipv4"], e))
-
-    except (KeyError, TypeError):
-        logger.warning("No fqdn for %s returning None" % interface["ipv4"])
-
-    if fqdn_list and len(fqdn_list) > 1:
-        raise AttributeError("Should be only one: %s" % fqdn_list)
-    return fqdn_list[0] if fqdn_list else None
+    return get_resolver().verify(interface)
@@ -18,7 +18,6 @@ setup(
     zip_safe=False,
     install_requires=[
         'boto3',
-        'deepdiff',
         'flasgger',
         'flask',
         'prometheus_client',
@@ -1,12 +1,15 @@
 import copy
 import unittest
+from unittest.mock import patch
 
-from sqlalchemy import create_engine
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 
 from enjoliver.db import session_commit
 from enjoliver.model import MachineInterface, Machine, MachineDisk, Chassis, ChassisPort, Base
 from enjoliver.repositories.machine_discovery import MachineDiscoveryRepository
+from enjoliver.resolver import ReverseResolver
 
 from tests.fixtures import posts
 
@@ -22,6 +25,11 @@ class TestMachineStateRepo(unittest.TestCase):
         Base.metadata.drop_all(bind=self.engine)
         Base.metadata.create_all(bind=self.engine)
 
+    @staticmethod
+    def resolver():
+        return ReverseResolver(ttl=60, negative_ttl=60, workers=1, deadline=1, tries=1, verify_fqdn=True,
+                               deferred=False)
+
     def test_bad_content(self):
         mdr = MachineDiscoveryRepository(self.sess_maker)
         with self.assertRaises(TypeError):
@@ -97,6 +105,196 @@ class TestMachineStateRepo(unittest.TestCase):
             self.assertEqual(1, session.query(Chassis).count())
             self.assertEqual(1, session.query(ChassisPort).count())
 
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_readd_same_only_updates_machine(self, gethostbyaddr):
+        gethostbyaddr.return_value = ("1.host.enjoliver.local", [], ["172.20.0.65"])
+        mdr = MachineDiscoveryRepository(self.sess_maker, resolver=self.resolver())
+        mdr.upsert(posts.M01)
+        short_circuited = REGISTRY.get_sample_value("enjoliver_discovery_short_circuited_total")
+        with session_commit(sess_maker=self.sess_maker) as session:
+            ids = [i.id for i in session.query(MachineInterface)] + [d.id for d in session.query(MachineDisk)]
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            self.assertFalse(mdr.upsert(posts.M01))
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual(["UPDATE"], statements)
+        self.assertEqual(short_circuited + 1, REGISTRY.get_sample_value("enjoliver_discovery_short_circuited_total"))
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(
+                ids, [i.id for i in session.query(MachineInterface)] + [d.id for d in session.query(MachineDisk)])
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_readd_same_unverified_fqdn(self, gethostbyaddr):
+        gethostbyaddr.side_effect = OSError("unknown host")
+        mdr = MachineDiscoveryRepository(self.sess_maker, resolver=self.resolver())
+        mdr.upsert(posts.M01)
+        short_circuited = REGISTRY.get_sample_value("enjoliver_discovery_short_circuited_total")
+
+        gethostbyaddr.side_effect = None
+        gethostbyaddr.return_value = ("1.host.enjoliver.local", [], ["172.20.0.65"])
+        mdr = MachineDiscoveryRepository(self.sess_maker, resolver=self.resolver())
+        mdr.upsert(posts.M01)
+
+        self.assertEqual(short_circuited, REGISTRY.get_sample_value("enjoliver_discovery_short_circuited_total"))
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(["1.host.enjoliver.local"], [i.fqdn for i in session.query(MachineInterface)])
+
+    def test_prefetch_fqdn_outside_transaction(self):
+        # without verification no lookup is deferred to a background transaction
+        resolver = ReverseResolver(ttl=60, negative_ttl=60, workers=1, deadline=1, tries=1, verify_fqdn=False,
+                                   deferred=False)
+        mdr = MachineDiscoveryRepository(self.sess_maker, resolver=resolver)
+        checked_out = []
+        with patch.object(mdr, "_prefetch_fqdn", lambda d: checked_out.append(self.engine.pool.checkedout())):
+            mdr.upsert(posts.M01)
+            mdr.upsert_many([posts.M02, posts.M03], chunk_size=0)
+        self.assertEqual([0, 0], checked_out)
+
+    def test_interfaces_bulk_inserted(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        many_interfaces = copy.deepcopy(posts.M01)
+        for n in range(1, 4):
+            interface = copy.deepcopy(many_interfaces["interfaces"][1])
+            interface.update({"mac": "52:54:00:e8:32:6%d" % n, "name": "eth%d" % n, "ipv4": "172.20.0.%d" % n})
+            many_interfaces["interfaces"].append(interface)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            mdr.upsert(many_interfaces)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual(1, len([k for k in statements if k.startswith("INSERT INTO machine_interface")]))
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(4, session.query(MachineInterface).count())
+            self.assertEqual(["eth0"], [session.query(MachineInterface).get(p.machine_interface).name
+                                        for p in session.query(ChassisPort)])
+
+    def test_readd_diff(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        mdr.upsert(posts.M01)
+
+        changed = copy.deepcopy(posts.M01)
+        changed["disks"] = [{'size-bytes': 1, 'path': '/dev/sda'}, {'size-bytes': 2, 'path': '/dev/sdb'}]
+        changed["interfaces"][1]["ipv4"] = "172.20.0.66"
+        changed["lldp"]["data"]["interfaces"][0]["port"]["id"] = "fe:54:00:e8:32:5c"
+        mdr.upsert(changed)
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual({("/dev/sda", 1), ("/dev/sdb", 2)}, {(d.path, d.size) for d in session.query(MachineDisk)})
+            self.assertEqual(["172.20.0.66"], [i.ipv4 for i in session.query(MachineInterface)])
+            self.assertEqual(["fe:54:00:e8:32:5c"], [p.mac for p in session.query(ChassisPort)])
+
+        changed["interfaces"] = [changed["interfaces"][0]]
+        changed["lldp"]["data"]["interfaces"] = []
+        mdr.upsert(changed)
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(0, session.query(MachineInterface).count())
+            self.assertEqual(0, session.query(ChassisPort).count())
+            self.assertEqual(1, session.query(Chassis).count())
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_deferred_fqdn(self, gethostbyaddr):
+        gethostbyaddr.return_value = ("1.host.enjoliver.local", [], ["172.20.0.65"])
+        resolver = ReverseResolver(ttl=60, negative_ttl=60, workers=1, deadline=1, tries=1, verify_fqdn=True,
+                                   deferred=True)
+        mdr = MachineDiscoveryRepository(self.sess_maker, resolver=resolver)
+        mdr.upsert(posts.M01)
+        # wait the background verification
+        resolver.defer(lambda: None).result()
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(["1.host.enjoliver.local"], [i.fqdn for i in session.query(MachineInterface)])
+        gethostbyaddr.assert_called_once_with("172.20.0.65")
+
+    def test_upsert_many(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        mdr.upsert(posts.M01)
+
+        results = mdr.upsert_many([posts.M01, {"lldp": ""}, posts.M02, posts.M03], chunk_size=2)
+        self.assertEqual(["updated", "error", "new", "new"], [r["result"] for r in results])
+        self.assertEqual(posts.M02["boot-info"]["uuid"], results[2]["uuid"])
+        self.assertEqual(posts.M02["boot-info"]["mac"], results[2]["mac"])
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(3, session.query(Machine).count())
+            self.assertEqual(3, session.query(MachineInterface).count())
+            self.assertEqual(3, session.query(MachineDisk).count())
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_upsert_many_short_circuit(self, gethostbyaddr):
+        gethostbyaddr.return_value = ("1.host.enjoliver.local", [], ["172.20.0.65"])
+        mdr = MachineDiscoveryRepository(self.sess_maker, resolver=self.resolver())
+        mdr.upsert_many([posts.M01, posts.M02], chunk_size=0)
+        short_circuited = REGISTRY.get_sample_value("enjoliver_discovery_short_circuited_total")
+
+        with_new_disk = copy.deepcopy(posts.M02)
+        with_new_disk["disks"].append({'size-bytes': 21474836481, 'path': '/dev/sdb'})
+        results = mdr.upsert_many([posts.M01, with_new_disk, posts.M03, posts.M03], chunk_size=0)
+        self.assertEqual(["updated", "updated", "new", "updated"], [r["result"] for r in results])
+        self.assertEqual(short_circuited + 1, REGISTRY.get_sample_value("enjoliver_discovery_short_circuited_total"))
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(3, session.query(Machine).count())
+            self.assertEqual(4, session.query(MachineDisk).count())
+
+    def test_upsert_many_shared_chassis(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            mdr.upsert_many([posts.M01, posts.M02, posts.M03], chunk_size=0)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
+        self.assertEqual(1, len([k for k in statements if k.startswith("SELECT") and "FROM chassis" in k]))
+        # M01 and M02 are on the same chassis
+        self.assertEqual(2, len([k for k in statements if k.startswith("INSERT INTO chassis ")]))
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(2, session.query(Chassis).count())
+            self.assertEqual(3, session.query(ChassisPort).count())
+
+    def test_chassis_same_name_other_mac(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        other_chassis = copy.deepcopy(posts.M02)
+        other_chassis["lldp"]["data"]["interfaces"][0]["chassis"]["id"] = "28:f1:0e:12:20:01"
+        mdr.upsert(posts.M01)
+        mdr.upsert(other_chassis)
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(2, session.query(Chassis).count())
+            self.assertEqual(2, session.query(ChassisPort).count())
+
+    def test_upsert_many_isolate_failure(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        bad_mac = copy.deepcopy(posts.M02)
+        bad_mac["interfaces"][1]["mac"] = "not a mac"
+
+        results = mdr.upsert_many([posts.M01, bad_mac, posts.M03, {"lldp": ""}], chunk_size=0)
+        self.assertEqual(["new", "error", "new", "error"], [r["result"] for r in results])
+        self.assertEqual(["fail to store the discovery data", "invalid discovery data"],
+                         [results[1]["error"], results[3]["error"]])
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(2, session.query(Machine).count())
+
     def test_fetch_one_machine(self):
         mdr = MachineDiscoveryRepository(self.sess_maker)
         mdr.upsert(posts.M01)
@@ -1,6 +1,6 @@
 import unittest
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine import Engine
 
@@ -8,6 +8,8 @@ from enjoliver.db import session_commit
 from enjoliver.model import Base, Machine, MachineInterface, Schedule, ScheduleRoles
 from enjoliver.repositories.machine_discovery import MachineDiscoveryRepository
 from enjoliver.repositories.machine_schedule import MachineScheduleRepository
+from enjoliver.repositories import fleet_generation, machine_overview, read_models
+from enjoliver.resolver import ReverseResolver
 
 from tests.fixtures import posts
 
@@ -32,6 +34,18 @@ class TestMachineScheduleRepo(unittest.TestCase):
     def setUp(self):
         self.init_db()
 
+    def count_statements(self, fn, *args, **kwargs):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *a):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            return fn(*args, **kwargs), len(statements)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
     def test_one_machine(self):
         mac = "00:00:00:00:00:00"
         with session_commit(sess_maker=self.sess_maker) as session:
@@ -291,3 +305,135 @@ class TestMachineScheduleRepo(unittest.TestCase):
 
         # verify the scheduled machine is indexed by its boot-interface, the 3rd one in this case
         self.assertIn(mac.format(3), s)
+
+    def test_allocate(self):
+        mdr = MachineDiscoveryRepository(sess_maker=self.sess_maker)
+        for m in (posts.M01, posts.M02, posts.M03):
+            mdr.upsert(m)
+
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        cp = [ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane]
+        self.assertEqual([], ms.allocate(cp, 4))
+        self.assertEqual(3, len(ms.get_available_machines()))
+
+        allocated = ms.allocate(cp, 2)
+        self.assertEqual(sorted(m["boot-info"]["mac"] for m in (posts.M01, posts.M02, posts.M03))[:2], allocated)
+        self.assertEqual(sorted(allocated), sorted(m["mac"] for m in ms.get_machines_by_roles(*cp)))
+
+        allocated = ms.allocate([ScheduleRoles.kubernetes_node])
+        self.assertEqual(1, len(allocated))
+        self.assertEqual(allocated, [m["mac"] for m in ms.get_machines_by_role(ScheduleRoles.kubernetes_node)])
+        self.assertEqual([], ms.allocate([ScheduleRoles.kubernetes_node]))
+        self.assertEqual([], ms.get_available_machines())
+
+        with self.assertRaises(LookupError):
+            ms.allocate(["not-a-role"], 1)
+
+    def test_get_machines_by_roles_exact_set(self):
+        mdr = MachineDiscoveryRepository(sess_maker=self.sess_maker)
+        for m in (posts.M01, posts.M02, posts.M03, posts.M04):
+            mdr.upsert(m)
+
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        cp = [ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane]
+        ms.allocate(cp, 2)
+        ms.allocate(cp + [ScheduleRoles.kubernetes_node], 1)
+        ms.allocate([ScheduleRoles.etcd_member], 1)
+
+        machines, statements = self.count_statements(ms.get_machines_by_roles, *cp)
+        self.assertEqual(2, len(machines))
+        # the machines and their disks
+        self.assertEqual(2, statements)
+        for m in machines:
+            self.assertEqual(cp, m["roles"])
+            self.assertEqual(1, len(m["disks"]))
+            self.assertTrue(m["as_boot"])
+
+    def test_statements_independent_of_fleet_size(self):
+        mdr = MachineDiscoveryRepository(sess_maker=self.sess_maker)
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        for m in (posts.M01, posts.M02, posts.M03, posts.M04, posts.M05, posts.M06):
+            mdr.upsert(m)
+        ms.allocate([ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane], 3)
+        ms.allocate([ScheduleRoles.kubernetes_node])
+
+        schedules, statements = self.count_statements(ms.get_all_schedules)
+        self.assertEqual(6, len(schedules))
+        self.assertLessEqual(statements, 1)
+
+        for role, nb in [(ScheduleRoles.etcd_member, 3), (ScheduleRoles.kubernetes_node, 3)]:
+            machines, statements = self.count_statements(ms.get_machines_by_role, role)
+            self.assertEqual(nb, len(machines))
+            self.assertLessEqual(statements, 2)
+            for m in machines:
+                self.assertEqual(1, len(m["disks"]))
+                self.assertTrue(m["as_boot"])
+
+    def test_machines_by_roles_pages(self):
+        mdr = MachineDiscoveryRepository(sess_maker=self.sess_maker)
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        for m in (posts.M01, posts.M02, posts.M03, posts.M04, posts.M05):
+            mdr.upsert(m)
+        cp = [ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane]
+        ms.allocate(cp, 5)
+        expected = ms.get_machines_by_roles(*cp)
+
+        machines, after = [], None
+        while True:
+            page = read_models.Page(limit=2, after=after)
+            ret, statements = self.count_statements(ms.get_machines_by_roles, *cp, page=page)
+            self.assertLessEqual(len(ret), 2)
+            self.assertLessEqual(statements, 2)
+            machines.extend(ret)
+            after = page.next_after
+            if after is None:
+                break
+        self.assertEqual(expected, machines)
+
+        page = read_models.Page(limit=3)
+        self.assertEqual([m["mac"] for m in expected[:3]],
+                         [m["mac"] for m in ms.get_machines_by_role(ScheduleRoles.etcd_member, page=page)])
+        self.assertEqual(3, page.count)
+
+    def test_fleet_generation(self):
+        # the fqdn are stored as reported, an unverified one would not be short-circuited
+        resolver = ReverseResolver(ttl=60, negative_ttl=60, workers=1, deadline=1, tries=1, verify_fqdn=False,
+                                   deferred=False)
+        mdr = MachineDiscoveryRepository(sess_maker=self.sess_maker, resolver=resolver)
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        self.assertEqual(0, ms.get_fleet_generation())
+
+        mdr.upsert(posts.M01)
+        mdr.upsert(posts.M02)
+        generation = ms.get_fleet_generation()
+        self.assertEqual(2, generation)
+
+        # an identical report doesn't change the inputs of the sync
+        mdr.upsert(posts.M01)
+        self.assertEqual(generation, ms.get_fleet_generation())
+
+        ms.allocate([ScheduleRoles.kubernetes_node], 1)
+        self.assertEqual(generation + 1, ms.get_fleet_generation())
+        ms.allocate([ScheduleRoles.kubernetes_node], 4)
+        self.assertEqual(generation + 1, ms.get_fleet_generation())
+
+    def test_fleet_generation_once_by_commit(self):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            session.add(Machine(uuid="b7f5f93a-b029-475f-b3a4-479ba198cb8a"))
+            session.commit()
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        generation = ms.get_fleet_generation()
+        # the overview of the machine is refreshed twice in the same transaction
+        with session_commit(sess_maker=self.sess_maker) as session:
+            machine_overview.refresh(session)
+            machine_overview.refresh(session)
+            self.assertEqual(generation, fleet_generation.current(session))
+        self.assertEqual(generation + 1, ms.get_fleet_generation())
+
+        session = self.sess_maker()
+        try:
+            machine_overview.refresh(session)
+            session.rollback()
+        finally:
+            session.close()
+        self.assertEqual(generation + 1, ms.get_fleet_generation())
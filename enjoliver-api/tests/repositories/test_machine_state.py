@@ -1,12 +1,15 @@
+import datetime
+import threading
 import unittest
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 
 from enjoliver.db import session_commit
-from enjoliver.model import Base, Machine, MachineCurrentState, MachineInterface, MachineStates
-from enjoliver.repositories.machine_state import MachineStateRepository
+from enjoliver.model import Base, Machine, MachineCurrentState, MachineInterface, MachineStates, \
+    MachineStateTransition
+from enjoliver.repositories.machine_state import MachineStateBuffer, MachineStateRepository
 
 
 class TestMachineStateRepo(unittest.TestCase):
@@ -98,3 +101,150 @@ class TestMachineStateRepo(unittest.TestCase):
             "state": new_state,
             "date": updated_date
         }], ret)
+
+    def test_write_behind(self):
+        msr = MachineStateRepository(sess_maker=self.sess_maker, flush_interval=3600, flush_size=3)
+        msr.update("00:00:00:00:00:01", MachineStates.booting)
+        msr.update("00:00:00:00:00:01", MachineStates.discovery)
+        msr.update_many(["00:00:00:00:00:02"], MachineStates.booting)
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(0, session.query(MachineCurrentState).count())
+
+        self.assertEqual(3, msr.flush())
+        self.assertEqual(0, msr.flush())
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(
+                [("00:00:00:00:00:01", MachineStates.discovery), ("00:00:00:00:00:02", MachineStates.booting)],
+                [(s.machine_mac, s.state_name) for s in
+                 session.query(MachineCurrentState).order_by(MachineCurrentState.machine_mac)])
+
+    def test_write_behind_transitions(self):
+        msr = MachineStateRepository(sess_maker=self.sess_maker, flush_interval=3600)
+        start = datetime.datetime.utcnow()
+        for n, state in enumerate([MachineStates.booting, MachineStates.booting, MachineStates.discovery,
+                                   MachineStates.booting]):
+            msr.buffer.record("00:00:00:00:00:01", state, start + datetime.timedelta(seconds=n))
+
+        self.assertEqual(3, msr.flush())
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(
+                [(None, MachineStates.booting, 0), (MachineStates.booting, MachineStates.discovery, 2),
+                 (MachineStates.discovery, MachineStates.booting, 3)],
+                [(t.from_state, t.to_state, (t.date - start).seconds) for t in
+                 session.query(MachineStateTransition).order_by(MachineStateTransition.date)])
+
+    def test_write_behind_failure_keeps_order(self):
+        written = []
+
+        def write(states):
+            if len(written) == 1:
+                written.append(None)
+                raise RuntimeError("database unavailable")
+            written.append(states)
+
+        buffer = MachineStateBuffer(write, flush_interval=3600, flush_size=100)
+        buffer.record("00:00:00:00:00:01", MachineStates.booting)
+        buffer.record("00:00:00:00:00:01", MachineStates.discovery)
+        self.assertEqual(1, buffer.flush())
+        buffer.record("00:00:00:00:00:01", MachineStates.booting)
+        self.assertEqual(2, buffer.flush())
+        self.assertEqual([MachineStates.booting, MachineStates.discovery, MachineStates.booting],
+                         [states["00:00:00:00:00:01"][0] for states in written if states])
+
+    def test_write_behind_keeps_most_recent(self):
+        other_process = MachineStateRepository(sess_maker=self.sess_maker, flush_interval=3600)
+        msr = MachineStateRepository(sess_maker=self.sess_maker, flush_interval=3600)
+        other_process.update("00:00:00:00:00:01", MachineStates.booting)
+        msr.update("00:00:00:00:00:01", MachineStates.discovery)
+        msr.flush()
+        other_process.flush()
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(MachineStates.discovery, session.query(MachineCurrentState).one().state_name)
+
+    def test_single_upsert_statement(self):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            machine = Machine(uuid="b7f5f93a-b029-475f-b3a4-479ba198cb8a")
+            session.add(machine)
+            session.flush()
+            session.add(
+                MachineInterface(machine_id=machine.id, mac="00:00:00:00:00:01", netmask=1, ipv4="10.10.10.10",
+                                 cidrv4="127.0.0.1/8", as_boot=True, gateway="1.1.1.1", name="lol"))
+            machine_id = machine.id
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        msr = MachineStateRepository(sess_maker=self.sess_maker, history_days=0)
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            msr.update_many(["00:00:00:00:00:01", "00:00:00:00:00:02"], MachineStates.booting)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+
+        # the states, the transitions and the machine_overview in one statement
+        self.assertEqual(1, len(statements))
+        self.assertIn("INSERT INTO machine_current_state", statements[0])
+        self.assertIn("ON CONFLICT (machine_mac) DO UPDATE", statements[0])
+        self.assertIn("INSERT INTO machine_state_transition", statements[0])
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(
+                [("00:00:00:00:00:01", machine_id), ("00:00:00:00:00:02", None)],
+                [(s.machine_mac, s.machine_id) for s in
+                 session.query(MachineCurrentState).order_by(MachineCurrentState.machine_mac)])
+
+    def test_concurrent_first_reports(self):
+        msr = MachineStateRepository(sess_maker=self.sess_maker)
+        now = datetime.datetime.utcnow()
+        session = self.sess_maker()
+        try:
+            msr._pg_upsert(session, {"00:00:00:00:00:01": (MachineStates.booting, now)})
+            # blocked on the uncommitted row until the commit
+            other = threading.Thread(target=msr.update_states, args=(
+                {"00:00:00:00:00:01": (MachineStates.booting, now + datetime.timedelta(seconds=1))},))
+            other.start()
+            other.join(0.5)
+            self.assertTrue(other.is_alive())
+            session.commit()
+        finally:
+            session.close()
+        other.join()
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(1, session.query(MachineStateTransition).count())
+            state = session.query(MachineCurrentState).one()
+            self.assertEqual(now, state.state_date)
+            self.assertEqual(now + datetime.timedelta(seconds=1), state.updated_date)
+
+    def test_sqlite_upsert(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(bind=engine)
+        msr = MachineStateRepository(sess_maker=sessionmaker(bind=engine))
+        msr.update("00:00:00:00:00:01", MachineStates.booting)
+        msr.update("00:00:00:00:00:01", MachineStates.discovery)
+
+        self.assertEqual(1, len(msr.fetch(finished_in_less_than_min=10)))
+        self.assertEqual(MachineStates.discovery, msr.fetch(finished_in_less_than_min=10)[0]["state"])
+
+    def test_transitions(self):
+        msr = MachineStateRepository(sess_maker=self.sess_maker)
+        start = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        for i in range(10):
+            mac = "00:00:00:00:00:%02d" % i
+            msr.update_states({mac: (MachineStates.booting, start)})
+            msr.update_states({mac: (MachineStates.booting, start + datetime.timedelta(seconds=1))})
+            msr.update_states({mac: (MachineStates.discovery, start + datetime.timedelta(seconds=10 * (i + 1)))})
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(20, session.query(MachineStateTransition).count())
+
+        percentiles = msr.transitions_percentiles(since_days=7)
+        self.assertEqual([{"from": MachineStates.booting, "to": MachineStates.discovery, "count": 10,
+                           "p50": 50.0, "p95": 100.0, "p99": 100.0}], percentiles)
+
+        self.assertEqual(0, msr.expire_history(start.date()))
+        self.assertEqual(20, msr.expire_history(start.date() + datetime.timedelta(days=31)))
+        self.assertEqual([], msr.transitions_percentiles(since_days=7))
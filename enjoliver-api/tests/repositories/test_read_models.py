@@ -0,0 +1,320 @@
+import datetime
+import logging
+import os
+import time
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, sessionmaker
+
+from enjoliver.db import session_commit
+from enjoliver.model import (
+    Base,
+    LifecycleCoreosInstall,
+    LifecycleIgnition,
+    LifecycleRolling,
+    Machine,
+    MachineDisk,
+    MachineInterface,
+    Schedule,
+    ScheduleRoles,
+)
+from enjoliver.repositories import read_models
+
+logger = logging.getLogger(__name__)
+
+
+# The ORM implementations replaced by the read models, kept as reference of the expected output
+
+def orm_available_machines(session):
+    available_machines = []
+    for m in session.query(Machine) \
+            .join(MachineInterface) \
+            .options(joinedload("schedules")) \
+            .options(joinedload("interfaces")) \
+            .options(joinedload("disks")) \
+            .filter(MachineInterface.as_boot == True):
+        if not m.schedules:
+            available_machines.append({
+                "mac": m.interfaces[0].mac,
+                "ipv4": m.interfaces[0].ipv4,
+                "cidrv4": m.interfaces[0].cidrv4,
+                "as_boot": m.interfaces[0].as_boot,
+                "name": m.interfaces[0].name,
+                "fqdn": m.interfaces[0].fqdn,
+                "netmask": m.interfaces[0].netmask,
+                "created_date": m.created_date,
+                "disks": [{"path": k.path, "size-bytes": k.size} for k in m.disks],
+            })
+    return available_machines
+
+
+def orm_role_ips(session, role):
+    ips = []
+    for machine in session.query(Machine) \
+            .options(joinedload("interfaces")) \
+            .join(MachineInterface) \
+            .join(Schedule) \
+            .filter(Schedule.role == role, MachineInterface.as_boot == True):
+        ips.append(machine.interfaces[0].ipv4)
+    return ips
+
+
+def orm_ignition_status(session):
+    status = []
+    for machine in session.query(Machine) \
+            .join(LifecycleIgnition) \
+            .join(MachineInterface) \
+            .filter(MachineInterface.as_boot == True):
+        status.append({
+            "up-to-date": machine.lifecycle_ignition[0].up_to_date,
+            "fqdn": machine.interfaces[0].fqdn,
+            "mac": machine.interfaces[0].mac,
+            "cidrv4": machine.interfaces[0].cidrv4,
+            "created_date": machine.created_date,
+            "updated_date": machine.updated_date,
+            "last_change_date": machine.lifecycle_ignition[0].last_change_date,
+        })
+    return status
+
+
+def orm_coreos_install_status(session):
+    life_status_list = []
+    for machine in session.query(Machine) \
+            .join(LifecycleCoreosInstall) \
+            .join(MachineInterface) \
+            .filter(MachineInterface.as_boot == True):
+        life_status_list.append({
+            "mac": machine.interfaces[0].mac,
+            "fqdn": machine.interfaces[0].fqdn,
+            "cidrv4": machine.interfaces[0].cidrv4,
+            "success": machine.lifecycle_coreos_install[0].success,
+            "created_date": machine.lifecycle_coreos_install[0].created_date,
+            "updated_date": machine.lifecycle_coreos_install[0].updated_date
+        })
+    return life_status_list
+
+
+def orm_rolling_status(session):
+    life_roll_list = []
+    for machine in session.query(Machine) \
+            .join(LifecycleRolling) \
+            .join(MachineInterface) \
+            .options(joinedload("interfaces")) \
+            .options(joinedload("lifecycle_rolling")) \
+            .filter(MachineInterface.as_boot == True):
+        life_roll_list.append({
+            "mac": machine.interfaces[0].mac,
+            "fqdn": machine.interfaces[0].fqdn,
+            "cidrv4": machine.interfaces[0].cidrv4,
+            "enable": bool(machine.lifecycle_rolling[0].enable),
+            "created_date": machine.lifecycle_rolling[0].created_date,
+            "updated_date": machine.lifecycle_rolling[0].updated_date
+        })
+    return life_roll_list
+
+
+def orm_discovery(session):
+    machines = []
+    for m in session.query(Machine) \
+            .options(joinedload("interfaces")) \
+            .options(joinedload("disks")) \
+            .join(MachineInterface):
+        boot_interface = None
+        interfaces = []
+        for i in m.interfaces:
+            if i.as_boot:
+                boot_interface = i
+            interfaces.append({
+                "as_boot": i.as_boot,
+                "cidrv4": i.cidrv4,
+                "fqdn": i.fqdn,
+                "gateway": i.gateway,
+                "ipv4": i.ipv4,
+                "mac": i.mac,
+                "name": i.name,
+                "netmask": i.netmask
+            })
+        machines.append({
+            "boot-info": {
+                "uuid": m.uuid,
+                "created-date": m.created_date,
+                "updated-date": m.updated_date,
+                "mac": boot_interface.mac
+            },
+            "interfaces": interfaces,
+            "disks": [{"size-bytes": d.size, "path": d.path} for d in m.disks]
+        })
+    return machines
+
+
+def by_mac(rows):
+    """
+    The ORM collections are loaded without order, the disks and the interfaces are compared as sorted lists
+    """
+    for row in rows:
+        for key, sort_key in [("disks", "path"), ("interfaces", "mac")]:
+            if key in row:
+                row[key].sort(key=lambda r: r[sort_key])
+    return sorted(rows, key=lambda r: r["boot-info"]["mac"] if "boot-info" in r else r["mac"])
+
+
+class TestReadModels(unittest.TestCase):
+    engine = None  # type: Engine
+
+    @classmethod
+    def init_db(cls):
+        if cls.engine is None:
+            raise Exception('engine is None')
+
+        Base.metadata.drop_all(bind=cls.engine)
+        Base.metadata.create_all(bind=cls.engine)
+
+    @classmethod
+    def setUpClass(cls):
+        db_uri = 'postgresql+psycopg2://localhost/enjoliver_testing'
+        cls.engine = create_engine(db_uri)
+        cls.sess_maker = sessionmaker(bind=cls.engine)
+
+    def setUp(self):
+        self.init_db()
+
+    def fill_fleet(self, nb: int, nb_interfaces=2):
+        """
+        Each machine has a boot interface, nb_interfaces - 1 other interfaces and two disks
+        One machine on two is scheduled, one on three reports its lifecycle
+        """
+        now = datetime.datetime(2017, 1, 1)
+        machines, interfaces, disks, schedules, ignitions, installs, rollings = [], [], [], [], [], [], []
+        for i in range(1, nb + 1):
+            machines.append({"id": i, "uuid": "%08x-0000-0000-0000-000000000000" % i, "created_date": now,
+                             "updated_date": now + datetime.timedelta(seconds=i)})
+            for n, as_boot in enumerate([True] + [False] * (nb_interfaces - 1)):
+                interfaces.append({
+                    "machine_id": i, "mac": "00:00:%02x:%02x:%02x:%02x" % (n, i >> 16 & 255, i >> 8 & 255, i & 255),
+                    "name": "eth%d" % n, "netmask": 16, "ipv4": "10.%d.%d.%d" % (n, i >> 8 & 255, i & 255),
+                    "cidrv4": "10.%d.%d.%d/16" % (n, i >> 8 & 255, i & 255), "as_boot": as_boot,
+                    "gateway": "10.%d.0.1" % n, "fqdn": "host-%d.enjoliver.local" % i if as_boot else None,
+                })
+            disks.extend([{"machine_id": i, "path": "/dev/sda", "size": 21474836480},
+                          {"machine_id": i, "path": "/dev/sdb", "size": 10737418240}])
+            if i % 2:
+                schedules.append({"machine_id": i, "role": ScheduleRoles.kubernetes_node})
+            if i % 3 == 0:
+                ignitions.append({"machine_id": i, "up_to_date": i % 2 == 0, "updated_date": now,
+                                  "last_change_date": now, "created_date": now})
+                installs.append({"machine_id": i, "success": True, "updated_date": now, "created_date": now})
+                rollings.append({"machine_id": i, "enable": i % 2 == 0, "strategy": "kexec", "updated_date": now,
+                                 "created_date": now})
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for model, rows in [(Machine, machines), (MachineInterface, interfaces), (MachineDisk, disks),
+                                (Schedule, schedules), (LifecycleIgnition, ignitions),
+                                (LifecycleCoreosInstall, installs), (LifecycleRolling, rollings)]:
+                session.execute(model.__table__.insert(), rows)
+            session.commit()
+
+    def cases(self):
+        return [
+            ("available_machines", orm_available_machines, read_models.available_machines),
+            ("role_ips", lambda s: orm_role_ips(s, ScheduleRoles.kubernetes_node),
+             lambda s: read_models.role_ips(s, ScheduleRoles.kubernetes_node)),
+            ("ignition_status", orm_ignition_status, read_models.ignition_status),
+            ("coreos_install_status", orm_coreos_install_status, read_models.coreos_install_status),
+            ("rolling_status", orm_rolling_status, read_models.rolling_status),
+            ("discovery", orm_discovery, read_models.discovery),
+        ]
+
+    def test_empty(self):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for name, _, core in self.cases():
+                self.assertEqual([], list(core(session)), name)
+
+    def test_identical_to_orm(self):
+        # the ORM takes machine.interfaces[0] as the boot interface, only right with a single interface
+        self.fill_fleet(30, nb_interfaces=1)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for name, orm, core in self.cases():
+                expected, result = orm(session), list(core(session))
+                self.assertEqual(len(expected), len(result), name)
+                if name == "role_ips":
+                    self.assertEqual(sorted(expected), sorted(result))
+                else:
+                    self.assertEqual(by_mac(expected), by_mac(result), name)
+
+    def test_boot_interface_not_first(self):
+        self.fill_fleet(3)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            session.query(MachineInterface).update({"as_boot": MachineInterface.name == "eth1"},
+                                                   synchronize_session=False)
+            session.commit()
+            machines = list(read_models.available_machines(session))
+            self.assertEqual(["00:00:01:00:00:02"], [m["mac"] for m in machines])
+            self.assertEqual(["10.1.0.1", "10.1.0.3"],
+                             read_models.role_ips(session, ScheduleRoles.kubernetes_node))
+            discovery = list(read_models.discovery(session))
+            self.assertEqual(["00:00:01:00:00:01", "00:00:01:00:00:02", "00:00:01:00:00:03"],
+                             [m["boot-info"]["mac"] for m in discovery])
+            self.assertEqual(["eth0", "eth1"], [i["name"] for i in discovery[0]["interfaces"]])
+
+    def test_multiple_interfaces(self):
+        self.fill_fleet(4, nb_interfaces=3)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            machines = list(read_models.available_machines(session))
+            self.assertEqual([("00:00:00:00:00:02", "10.0.0.2"), ("00:00:00:00:00:04", "10.0.0.4")],
+                             [(m["mac"], m["ipv4"]) for m in machines])
+            self.assertEqual([2, 2], [len(m["disks"]) for m in machines])
+            self.assertEqual(["10.0.0.1", "10.0.0.3"],
+                             sorted(read_models.role_ips(session, ScheduleRoles.kubernetes_node)))
+            for name, fn in [("ignition_status", read_models.ignition_status),
+                             ("coreos_install_status", read_models.coreos_install_status),
+                             ("rolling_status", read_models.rolling_status)]:
+                self.assertEqual([("00:00:00:00:00:03", "host-3.enjoliver.local")],
+                                 [(m["mac"], m["fqdn"]) for m in fn(session)], name)
+            discovery = list(read_models.discovery(session))
+            self.assertEqual(["00:00:00:00:00:0%d" % i for i in range(1, 5)],
+                             [m["boot-info"]["mac"] for m in discovery])
+            self.assertEqual([["00:00:00:00:00:01", "00:00:01:00:00:01", "00:00:02:00:00:01"]],
+                             [sorted(i["mac"] for i in m["interfaces"]) for m in discovery[:1]])
+            self.assertEqual([(3, 2)] * 4, [(len(m["interfaces"]), len(m["disks"])) for m in discovery])
+
+    def test_pages(self):
+        self.fill_fleet(7)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for name, _, core in self.cases():
+                if name == "role_ips":
+                    continue
+                expected = list(core(session))
+                result, after = [], None
+                while True:
+                    page = read_models.Page(limit=2, after=after)
+                    rows = list(core(session, page))
+                    self.assertLessEqual(len(rows), 2, name)
+                    result.extend(rows)
+                    after = page.next_after
+                    if after is None:
+                        break
+                self.assertEqual(expected, result, name)
+
+    def test_stream(self):
+        self.fill_fleet(3)
+        rows = read_models.stream(self.sess_maker, read_models.discovery, read_models.Page(limit=2))
+        self.assertEqual(["00:00:00:00:00:01", "00:00:00:00:00:02"], [m["boot-info"]["mac"] for m in rows])
+
+    @unittest.skipUnless(os.getenv("ENJOLIVER_BENCH_MACHINES"), "ENJOLIVER_BENCH_MACHINES=5000 to measure a fleet")
+    def test_benchmark(self):
+        bench_machines = int(os.getenv("ENJOLIVER_BENCH_MACHINES"))
+        self.fill_fleet(bench_machines)
+        report = ["%d machines" % bench_machines]
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for name, orm, core in self.cases():
+                timings = []
+                for fn in [orm, core]:
+                    session.expunge_all()
+                    start = time.time()
+                    list(fn(session))
+                    timings.append(time.time() - start)
+                report.append("%-22s orm %.4fs core %.4fs x%.1f" % (
+                    name, timings[0], timings[1], timings[0] / max(timings[1], 1e-6)))
+        logger.info("\n".join(report))
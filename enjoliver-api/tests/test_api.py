@@ -1,3 +1,4 @@
+import datetime
 import json
 import os
 import shutil
@@ -9,7 +10,7 @@ from werkzeug.contrib.cache import SimpleCache
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from enjoliver import configs
+from enjoliver import configs, matchbox, routes
 from enjoliver.app import create_app
 from enjoliver.model import Base
 from enjoliver.repositories.registry import RepositoryRegistry
@@ -41,9 +42,11 @@ class TestAPI(unittest.TestCase):
         cls.init_db()
 
         sess_maker = sessionmaker(bind=cls.engine)
-        registry = RepositoryRegistry(sess_maker=sess_maker)
-        register_routes(app=app, ec=cls.ec, cache=SimpleCache(), sess_maker=sess_maker, registry=registry)
+        registry = RepositoryRegistry(sess_maker=sess_maker, overview_delta_overlap=0)
+        register_routes(app=app, ec=cls.ec, cache=SimpleCache(), sess_maker=sess_maker, registry=registry,
+                        matchbox_session=matchbox.new_session(cls.ec))
 
+        cls.flask_app = app
         cls.app = app.test_client()
 
     def test_healthz_00(self):
@@ -103,6 +106,10 @@ class TestAPI(unittest.TestCase):
         result = self.app.get('/ipxe?uuid=fake?mac=fake')
         self.assertEqual(result.status_code, 404)
 
+    def test_assets(self):
+        result = self.app.get('/assets/coreos/serve/coreos_production_pxe.vmlinuz')
+        self.assertEqual(result.status_code, 502)
+
     def test_404(self):
         result = self.app.get('/fake')
         self.assertEqual(result.status_code, 404)
@@ -140,6 +147,54 @@ class TestAPI(unittest.TestCase):
             data = json.loads(r.data.decode())
             self.assertEqual(2, len(data))
 
+    def test_discovery_03_batch(self):
+        body = "\n".join([json.dumps(posts.M01), "{not json", json.dumps(posts.M02), ""])
+        r = self.app.post('/discovery/batch', data=body, content_type='application/x-ndjson')
+        self.assertEqual(200, r.status_code)
+        data = json.loads(r.data.decode())
+        self.assertEqual(3, data["total"])
+        self.assertEqual(2, data["updated"])
+        self.assertEqual(1, data["error"])
+        self.assertEqual(["updated", "error", "updated"], [k["result"] for k in data["results"]])
+        self.assertEqual("invalid discovery data", data["results"][1]["error"])
+
+        r = self.app.post('/discovery/batch', data="", content_type='application/json')
+        self.assertEqual(406, r.status_code)
+
+        r = self.app.get("/discovery")
+        self.assertEqual(2, len(json.loads(r.data.decode())))
+
+    def test_discovery_04_pages(self):
+        all_data = json.loads(self.app.get("/discovery").data.decode())
+
+        r = self.app.get("/discovery?limit=1")
+        self.assertEqual(200, r.status_code)
+        first = json.loads(r.data.decode())
+        self.assertEqual(all_data[:1], first)
+        r = self.app.get("/discovery?limit=1&after=%s" % r.headers["X-Next-After"])
+        self.assertEqual(all_data[1:], json.loads(r.data.decode()))
+        r = self.app.get("/discovery?limit=1&after=%s" % r.headers["X-Next-After"])
+        self.assertEqual([], json.loads(r.data.decode()))
+        self.assertNotIn("X-Next-After", r.headers)
+
+        r = self.app.get("/discovery?stream=ndjson")
+        self.assertEqual("application/x-ndjson", r.mimetype)
+        self.assertEqual(all_data, [json.loads(l) for l in r.data.decode().splitlines()])
+        r = self.app.get("/discovery?stream=json")
+        self.assertEqual(all_data, json.loads(r.data.decode()))
+        self.assertTrue(all_data[0]["boot-info"]["created-date"])
+
+        for query in ["limit=-1", "after=last", "stream=xml"]:
+            self.assertEqual(406, self.app.get("/discovery?%s" % query).status_code)
+
+    def test_discovery_05_stream_dates(self):
+        row = {"created-date": datetime.datetime(2017, 1, 2, 3, 4, 5), "mac": "52:54:00:a5:24:f5"}
+        with self.flask_app.test_request_context():
+            expected = json.loads(routes.jsonify([row]).data.decode())
+            stream = routes._serialize(iter([row]), "ndjson", routes.current_app.json_encoder, True)
+        # consumed outside of the request like a streamed response
+        self.assertEqual(expected, [json.loads(l) for l in "".join(stream).splitlines()])
+
     def test_scheduler_00(self):
         r = self.app.get("/scheduler")
         self.assertEqual(200, r.status_code)
@@ -209,11 +264,23 @@ class TestAPI(unittest.TestCase):
         role = "etcd-member&kubernetes-control-plane"
         r = self.app.get("/scheduler/%s" % role)
         self.assertEqual(1, len(json.loads(r.data.decode())))
+        r = self.app.get("/scheduler/%s?stream=ndjson" % role)
+        self.assertEqual([["etcd-member", "kubernetes-control-plane"]],
+                         [json.loads(line)["roles"] for line in r.data.decode().splitlines()])
 
     def test_scheduler_08(self):
         r = self.app.get("/scheduler/available")
         self.assertEqual(1, len(json.loads(r.data.decode())))
 
+    def test_scheduler_09_allocate(self):
+        r = self.app.post("/scheduler/allocate", data=json.dumps({"roles": ["kubernetes-node"]}))
+        self.assertEqual(406, r.status_code)
+        r = self.app.post("/scheduler/allocate", data=json.dumps({"roles": ["not-a-role"], "count": 1}))
+        self.assertEqual(406, r.status_code)
+        r = self.app.post("/scheduler/allocate", data=json.dumps({"roles": ["kubernetes-node"], "count": 2}))
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({"roles": ["kubernetes-node"], "allocated": []}, json.loads(r.data.decode()))
+
     def test_lifecycle_01(self):
         r = self.app.get("/lifecycle/coreos-install")
         self.assertEqual([], json.loads(r.data.decode()))
@@ -288,8 +355,63 @@ class TestAPI(unittest.TestCase):
     def test_vue_machine(self):
         # self.init_db()
         r = self.app.get("/ui/view/machine")
-        json.loads(r.data.decode())
         self.assertEqual(200, r.status_code)
+        machines = json.loads(r.data.decode())
+        # the machines discovered by the previous tests
+        self.assertLessEqual({posts.M01["boot-info"]["mac"], posts.M02["boot-info"]["mac"]},
+                             {m["MAC"] for m in machines})
+
+        r = self.app.get("/ui/view/machine?limit=1&sort=-MAC")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual([max(m["MAC"] for m in machines)], [m["MAC"] for m in json.loads(r.data.decode())])
+
+        r = self.app.get("/ui/view/machine?sort=Unknown")
+        self.assertEqual(406, r.status_code)
+
+        r = self.app.get("/ui/view/machine?since=0")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(len(machines), len(json.loads(r.data.decode())))
+        revision = r.headers["X-Overview-Revision"]
+        r = self.app.get("/ui/view/machine?since=%s" % revision)
+        self.assertEqual([], json.loads(r.data.decode()))
+        self.assertEqual(revision, r.headers["X-Overview-Revision"])
+
+        r = self.app.get("/ui/view/machine?since=0&limit=1")
+        self.assertEqual(1, len(json.loads(r.data.decode())))
+        r = self.app.get("/ui/view/machine?since=0&limit=1&after=%s" % r.headers["X-Next-After"])
+        self.assertEqual(1, len(json.loads(r.data.decode())))
+
+        r = self.app.get("/ui/view/machine?since=yesterday")
+        self.assertEqual(406, r.status_code)
+        r = self.app.get("/ui/view/machine?since=0&sort=MAC")
+        self.assertEqual(406, r.status_code)
+
+        r = self.app.get("/ui/view/machine?limit=1")
+        first = json.loads(r.data.decode())
+        r = self.app.get("/ui/view/machine?limit=%d&after=%s" % (len(machines), r.headers["X-Next-After"]))
+        self.assertEqual([m["MAC"] for m in machines], [m["MAC"] for m in first + json.loads(r.data.decode())])
+        r = self.app.get("/ui/view/machine?after=1&sort=MAC")
+        self.assertEqual(406, r.status_code)
+        r = self.app.get("/ui/view/machine?stream=ndjson")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(machines, [json.loads(line) for line in r.data.decode().splitlines()])
+
+    def test_backup_export(self):
+        r = self.app.get("/backup/export")
+        self.assertEqual(200, r.status_code)
+        playbook = json.loads(r.data.decode())
+        r = self.app.get("/backup/export?stream=json")
+        self.assertEqual(playbook, json.loads(r.data.decode()))
+        r = self.app.get("/backup/export?limit=1")
+        self.assertEqual(406, r.status_code)
+
+    def test_vue_state_transitions(self):
+        r = self.app.get("/ui/view/states/transitions?since_days=1")
+        self.assertEqual(200, r.status_code)
+        for transition in json.loads(r.data.decode()):
+            self.assertEqual({"from", "to", "count", "p50", "p95", "p99"}, set(transition))
+        r = self.app.get("/ui/view/states/transitions?since_days=week")
+        self.assertEqual(406, r.status_code)
 
     def test_sync_notify_00_outofsync(self):
         r = self.app.get("/ignition")
@@ -315,6 +437,23 @@ class TestAPI(unittest.TestCase):
         r.close()
         self.assertEqual(502, r.status_code)
 
+    def test_sync_notify_03_generation(self):
+        r = self.app.post("/sync-notify", data=json.dumps({"generation": "abc"}))
+        self.assertEqual(200, r.status_code)
+        self.assertEqual("abc", json.loads(r.data.decode())["generation"])
+        r.close()
+
+    def test_sync_notify_04_fleet_generation(self):
+        r = self.app.get("/fleet-generation")
+        self.assertEqual(200, r.status_code)
+        generation = json.loads(r.data.decode())["fleet-generation"]
+        r = self.app.post("/sync-notify", data=json.dumps({"generation": "abc"}))
+        self.assertEqual(generation, json.loads(r.data.decode())["fleet-generation"])
+
+        self.app.post('/discovery', data=json.dumps(posts.M03), content_type='application/json')
+        r = self.app.get("/fleet-generation")
+        self.assertLess(generation, json.loads(r.data.decode())["fleet-generation"])
+
     def test_install_authorization(self):
         r = self.app.get("/install-authorization/mac=01-02-03-04-05-06")
         r.close()
@@ -0,0 +1,152 @@
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest.mock import Mock
+
+from flask import Flask, request
+
+from enjoliver import assets
+
+
+class TestStreamUpstream(unittest.TestCase):
+    url = "http://127.0.0.1:8080/assets/coreos/serve/coreos_production_image.bin.bz2"
+
+    @staticmethod
+    def upstream(status_code=200, headers=None, chunks=None):
+        resp = Mock()
+        resp.status_code = status_code
+        resp.headers = headers if headers else {}
+        resp.iter_content.return_value = iter(chunks if chunks else [])
+        return resp
+
+    def test_select_headers(self):
+        self.assertEqual(
+            {"Range": "bytes=0-1"},
+            assets.select_headers({"Range": "bytes=0-1", "Cookie": "x"}, assets.FORWARDED_REQUEST_HEADERS))
+
+    def test_stream_chunks(self):
+        upstream = self.upstream(headers={"Content-Length": "6", "ETag": '"abc"', "Server": "matchbox"},
+                                 chunks=[b"abc", b"def"])
+        session = Mock()
+        session.get.return_value = upstream
+        resp = assets.stream_upstream(session, self.url, {"Range": "bytes=0-5", "Cookie": "x"}, chunk_size=3)
+        session.get.assert_called_once_with(self.url, headers={"Range": "bytes=0-5"}, stream=True)
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual("6", resp.headers["Content-Length"])
+        self.assertEqual('"abc"', resp.headers["ETag"])
+        self.assertNotIn("Server", resp.headers)
+        upstream.close.assert_not_called()
+
+        self.assertEqual(b"abcdef", b"".join(resp.response))
+        upstream.iter_content.assert_called_once_with(chunk_size=3)
+        upstream.close.assert_called_once_with()
+
+    def test_stream_not_modified(self):
+        upstream = self.upstream(status_code=304, headers={"ETag": '"abc"'})
+        session = Mock()
+        session.get.return_value = upstream
+        resp = assets.stream_upstream(session, self.url, {"If-None-Match": '"abc"'}, chunk_size=3)
+
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(b"", b"".join(resp.response))
+        upstream.close.assert_called_once_with()
+
+
+class TestAssetCache(unittest.TestCase):
+    path = "coreos/serve/coreos_production_pxe.vmlinuz"
+    content = b"0123456789"
+    headers = {"Content-Length": "10", "Last-Modified": "Tue, 10 Oct 2017 10:10:10 GMT"}
+
+    def setUp(self):
+        self.cache_dir = mkdtemp(dir='/tmp')
+        self.session = Mock()
+        self.cache = assets.AssetCache(self.session, self.cache_dir, max_bytes=25, revalidate_seconds=60,
+                                       chunk_size=4)
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def upstream(self, status_code=200, content=None):
+        resp = Mock()
+        resp.status_code = status_code
+        resp.headers = dict(self.headers)
+        content = self.content if content is None else content
+        resp.iter_content.return_value = iter([content[i:i + 4] for i in range(0, len(content), 4)])
+        return resp
+
+    def upstreams(self, head, get):
+        self.session.head.return_value = head
+        self.session.get.return_value = get
+
+    def serve(self, path=None, headers=None):
+        path = self.path if path is None else path
+        with self.app.test_request_context("/assets/%s" % path, headers=headers):
+            resp = self.cache.serve(path, "http://127.0.0.1:8080/assets/%s" % path, request)
+            return resp, b"".join(resp.response)
+
+    def test_miss_then_hit(self):
+        self.upstreams(self.upstream(), self.upstream())
+        resp, body = self.serve()
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(self.content, body)
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        for _ in range(3):
+            resp, body = self.serve()
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual(self.content, body)
+            self.assertEqual(self.headers["Last-Modified"], resp.headers["Last-Modified"])
+
+        self.assertEqual(1, self.session.get.call_count)
+        self.assertEqual(1, self.session.head.call_count)
+
+    def test_hit_range(self):
+        self.upstreams(self.upstream(), self.upstream())
+        self.serve()
+        resp, body = self.serve(headers={"Range": "bytes=2-5"})
+
+        self.assertEqual(206, resp.status_code)
+        self.assertEqual(b"2345", body)
+        self.assertEqual("bytes 2-5/10", resp.headers["Content-Range"])
+
+    def test_hit_not_modified(self):
+        self.upstreams(self.upstream(), self.upstream())
+        self.serve()
+        resp, body = self.serve(headers={"If-Modified-Since": self.headers["Last-Modified"]})
+
+        self.assertEqual(304, resp.status_code)
+
+    def test_truncated_fill_is_dropped(self):
+        self.upstreams(self.upstream(), self.upstream(content=b"0123"))
+        self.serve()
+
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_not_cacheable(self):
+        self.upstreams(self.upstream(status_code=404), self.upstream(status_code=404))
+        resp, body = self.serve()
+
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_fill_failed_is_relayed(self):
+        self.upstreams(self.upstream(), self.upstream(status_code=503, content=b"down"))
+        resp, body = self.serve()
+
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual(b"down", body)
+        self.assertEqual(1, self.session.get.call_count)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_evict_lru(self):
+        for i in range(3):
+            self.upstreams(self.upstream(), self.upstream())
+            self.serve(path="%s-%d" % (self.path, i))
+            os.utime(os.path.join(self.cache_dir, self.cache._validators["%s-%d" % (self.path, i)][0]), (i, i))
+
+        # 3 files of 10 bytes for a budget of 25 bytes
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        self.assertNotIn(self.cache._validators["%s-0" % self.path][0], os.listdir(self.cache_dir))
@@ -2,6 +2,7 @@ import os
 from shutil import rmtree
 from tempfile import mkdtemp
 from unittest import TestCase
+from unittest.mock import patch
 
 from enjoliver import generator
 
@@ -115,9 +116,11 @@ class TestGenerateGroups(GenerateGroupTestCase):
         )
         self.assertTrue(new.dump())
         self.assertTrue(os.path.isfile("%s/groups/%s.json" % (self.test_matchbox_path, _id)))
+        digest = new.digest
 
         self.assertFalse(new.dump())
         self.assertTrue(os.path.isfile("%s/groups/%s.json" % (self.test_matchbox_path, _id)))
+        self.assertEqual(digest, new.digest)
 
         new = generator.GenerateGroup(
             api_uri=self.api_uri,
@@ -132,6 +135,39 @@ class TestGenerateGroups(GenerateGroupTestCase):
         os.remove("%s/groups/%s.json" % (self.test_matchbox_path, _id))
 
 
+    def test_992_dump_digest(self):
+        _id = "etcd-test-%s" % self.test_992_dump_digest.__name__
+        file_path = "%s/groups/%s.json" % (self.test_matchbox_path, _id)
+        new = generator.GenerateGroup(
+            api_uri=self.api_uri,
+            _id=_id,
+            name="etcd-test",
+            profile="etcd-test.yaml",
+            matchbox_path=self.test_matchbox_path
+        )
+        self.assertTrue(new.dump())
+
+        # the digest of the written file is known, the file isn't read again
+        with patch.object(generator, "open", side_effect=AssertionError, create=True):
+            self.assertFalse(new.dump())
+
+        # changed outside of the generator
+        with open(file_path, "w") as f:
+            f.write("{}")
+        with self.assertLogs(generator.logger, level="DEBUG") as logs:
+            self.assertTrue(new.dump())
+        self.assertTrue(any("-{}" in line for line in logs.output))
+        with open(file_path) as f:
+            self.assertEqual(new.render(), f.read())
+
+        # the diff is only computed in debug
+        with open(file_path, "w") as f:
+            f.write("{}")
+        with self.assertLogs(generator.logger, level="INFO") as logs:
+            self.assertTrue(new.dump())
+        self.assertFalse(any("diff on" in line for line in logs.output))
+        os.remove(file_path)
+
 class TestGenerateGroupsSelectorLower(GenerateGroupTestCase):
     @classmethod
     def setUpClass(cls):
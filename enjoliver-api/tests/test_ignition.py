@@ -0,0 +1,92 @@
+import hashlib
+import json
+import unittest
+from unittest.mock import Mock
+
+from werkzeug.contrib.cache import SimpleCache
+
+from enjoliver.ignition import IgnitionCache, canonical_digest
+
+
+class TestIgnitionCache(unittest.TestCase):
+    path = "/ignition?mac=52-54-00-e8-32-5b&os=installed"
+
+    def setUp(self):
+        self.session = Mock()
+        self.session.get.side_effect = self.matchbox
+        self.rendered = 0
+        self.ignition = IgnitionCache(SimpleCache(), self.session, "http://127.0.0.1:8080", timeout=60)
+
+    def matchbox(self, url):
+        self.rendered += 1
+        resp = Mock()
+        resp.status_code = 200
+        resp.content = b'{"ignition": {"version": "2.0.0"}, "rendered": %d}' % self.rendered
+        return resp
+
+    def test_hit(self):
+        status, content, etag = self.ignition.get(self.path)
+        self.assertEqual(200, status)
+        self.assertIsNotNone(etag)
+        self.assertEqual((status, content, etag), self.ignition.get(self.path))
+        self.session.get.assert_called_once_with("http://127.0.0.1:8080%s" % self.path)
+
+    def test_query_is_part_of_the_key(self):
+        self.ignition.get(self.path)
+        self.ignition.get(self.path.replace("mac=52-54-00-e8-32-5b", "mac=52-54-00-a5-24-f5"))
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_generation_invalidates(self):
+        self.ignition.set_generation("a")
+        _, _, first = self.ignition.get(self.path)
+        self.ignition.set_generation("a")
+        self.assertEqual(first, self.ignition.get(self.path)[2])
+
+        self.ignition.set_generation("b")
+        self.assertNotEqual(first, self.ignition.get(self.path)[2])
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_versions_invalidates(self):
+        _, _, first = self.ignition.get(self.path)
+        self.ignition.set_versions({"kubernetes-node": "storage: {}"})
+        self.assertNotEqual(first, self.ignition.get(self.path)[2])
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_not_found_is_not_cached(self):
+        resp = Mock()
+        resp.status_code = 404
+        resp.content = b"not found"
+        self.session.get.side_effect = None
+        self.session.get.return_value = resp
+
+        self.assertEqual((404, b"not found", None), self.ignition.get(self.path))
+        self.ignition.get(self.path)
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_digest(self):
+        digest = self.ignition.get_digest(self.path)
+        self.assertEqual(canonical_digest({"rendered": 1, "ignition": {"version": "2.0.0"}}), digest)
+        self.assertEqual(digest, self.ignition.get_digest(self.path))
+        self.assertEqual(1, self.session.get.call_count)
+
+    def test_digest_not_json(self):
+        resp = Mock()
+        resp.status_code = 200
+        resp.content = b"not a json"
+        self.session.get.side_effect = None
+        self.session.get.return_value = resp
+
+        self.assertIsNone(self.ignition.get_digest(self.path))
+
+
+class TestCanonicalDigest(unittest.TestCase):
+    def test_order_and_indent(self):
+        self.assertEqual(
+            canonical_digest(json.loads('{"a": [1, 2], "b": {"c": "é", "d": null}}')),
+            canonical_digest(json.loads('{\n  "b": {"d": null, "c": "\\u00e9"},\n  "a": [1, 2]\n}')))
+
+    def test_jq_compatible(self):
+        # echo '{"b": {"d": null, "c": "é"}, "a": [1, 2]}' | jq -cS . | tr -d '\n' | sha256sum
+        self.assertEqual(
+            hashlib.sha256('{"a":[1,2],"b":{"c":"é","d":null}}'.encode()).hexdigest(),
+            canonical_digest({"b": {"d": None, "c": "é"}, "a": [1, 2]}))
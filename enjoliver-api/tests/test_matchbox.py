@@ -0,0 +1,26 @@
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from enjoliver import configs, matchbox
+
+
+class TestMatchboxSession(unittest.TestCase):
+    def test_new_session(self):
+        ec = configs.EnjoliverConfig(importer=__file__)
+        session = matchbox.new_session(ec)
+        adapter = session.get_adapter(ec.matchbox_uri)
+        self.assertEqual(ec.matchbox_pool_size, adapter._pool_maxsize)
+        self.assertEqual(ec.matchbox_retries, adapter.max_retries.total)
+        self.assertIs(adapter, session.get_adapter("https://matchbox"))
+        self.assertEqual((ec.matchbox_connect_timeout, ec.matchbox_read_timeout), session.timeout)
+
+    def test_default_timeout(self):
+        session = matchbox.MatchboxSession(pool_size=1, connect_timeout=1, read_timeout=2, retries=0)
+        with patch.object(requests.Session, "request") as request:
+            session.get("http://127.0.0.1:8080/ipxe")
+            session.get("http://127.0.0.1:8080/ipxe", timeout=10)
+
+        self.assertEqual((1, 2), request.call_args_list[0][1]["timeout"])
+        self.assertEqual(10, request.call_args_list[1][1]["timeout"])
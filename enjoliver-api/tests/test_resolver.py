@@ -0,0 +1,85 @@
+import socket
+import threading
+import unittest
+from unittest.mock import patch
+
+from enjoliver.resolver import ReverseResolver
+
+
+class TestReverseResolver(unittest.TestCase):
+    interface = {
+        "mac": "52:54:00:e8:32:5b",
+        "ipv4": "172.20.0.65",
+        "fqdn": ["1.host.enjoliver.local."],
+    }
+
+    @staticmethod
+    def resolver(**kwargs):
+        params = dict(ttl=60, negative_ttl=60, workers=4, deadline=1, tries=1, verify_fqdn=True, deferred=False)
+        params.update(kwargs)
+        return ReverseResolver(**params)
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_verify_cached(self, gethostbyaddr):
+        gethostbyaddr.return_value = ("1.host.enjoliver.local", [], ["172.20.0.65"])
+        r = self.resolver()
+        for _ in range(3):
+            self.assertEqual("1.host.enjoliver.local", r.verify(self.interface))
+        gethostbyaddr.assert_called_once_with("172.20.0.65")
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_verify_mismatch(self, gethostbyaddr):
+        gethostbyaddr.return_value = ("other.enjoliver.local", [], ["172.20.0.65"])
+        self.assertIsNone(self.resolver().verify(self.interface))
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_verify_mismatch_retried(self, gethostbyaddr):
+        # the IPv4 has two PTR records returned in turn
+        gethostbyaddr.side_effect = [("other.enjoliver.local", [], ["172.20.0.65"]),
+                                     ("1.host.enjoliver.local", [], ["172.20.0.65"])]
+        self.assertEqual("1.host.enjoliver.local", self.resolver(tries=2).verify(self.interface))
+        self.assertEqual(2, gethostbyaddr.call_count)
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_unexpected_error(self, gethostbyaddr):
+        gethostbyaddr.side_effect = [RuntimeError("bug"), ("1.host.enjoliver.local", [], ["172.20.0.65"])]
+        r = self.resolver(negative_ttl=0)
+        self.assertIsNone(r.verify(self.interface))
+        self.assertEqual({}, r._inflight)
+        self.assertEqual("1.host.enjoliver.local", r.verify(self.interface))
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_negative_cache(self, gethostbyaddr):
+        gethostbyaddr.side_effect = socket.herror("Unknown host")
+        r = self.resolver(tries=2)
+        self.assertIsNone(r.verify(self.interface))
+        self.assertIsNone(r.verify(self.interface))
+        self.assertEqual(2, gethostbyaddr.call_count)
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_not_verified(self, gethostbyaddr):
+        r = self.resolver(verify_fqdn=False)
+        self.assertEqual("1.host.enjoliver.local.", r.verify(self.interface))
+        self.assertIsNone(r.verify({"mac": "52:54:00:e8:32:5b", "ipv4": "172.20.0.65"}))
+        gethostbyaddr.assert_not_called()
+
+    @patch("enjoliver.resolver.socket.gethostbyaddr")
+    def test_deadline(self, gethostbyaddr):
+        release = threading.Event()
+
+        def slow(ipv4):
+            release.wait(5)
+            return "1.host.enjoliver.local", [], [ipv4]
+
+        gethostbyaddr.side_effect = slow
+        r = self.resolver()
+        other = dict(self.interface, ipv4="172.20.0.66", fqdn=None)
+        fqdns, late = r.verify_many([other, self.interface], 0.05)
+        self.assertEqual([None, None], fqdns)
+        self.assertEqual({1}, late)
+
+        release.set()
+        fqdns, late = r.verify_many([self.interface], None)
+        self.assertEqual(["1.host.enjoliver.local"], fqdns)
+        self.assertEqual(set(), late)
+        gethostbyaddr.assert_called_once_with("172.20.0.65")
@@ -0,0 +1,34 @@
+import json
+import unittest
+from unittest.mock import Mock, patch
+
+from enjoliver import schedulerv2
+
+
+class TestSchedulerV2(unittest.TestCase):
+    api_uri = "http://127.0.0.1:5000"
+
+    @staticmethod
+    def response(status_code: int, body):
+        return Mock(status_code=status_code, content=json.dumps(body).encode())
+
+    @patch("enjoliver.schedulerv2.requests.post")
+    def test_allocate(self, post):
+        post.return_value = self.response(200, {"roles": ["kubernetes-node"], "allocated": ["52:54:00:e8:32:5b"]})
+        sch = schedulerv2.KubernetesNode(self.api_uri, apply_dep=False)
+        self.assertEqual(["52:54:00:e8:32:5b"], sch._allocate("all"))
+        self.assertEqual({"roles": sch.roles, "count": "all"}, json.loads(post.call_args[1]["data"]))
+
+    @patch("enjoliver.schedulerv2.requests.post")
+    def test_allocate_refused(self, post):
+        post.return_value = self.response(406, {"roles": ["etcd-member"], "count": "all"})
+        sch = schedulerv2.EtcdMemberKubernetesControlPlane(self.api_uri)
+        self.assertEqual([], sch._allocate(3))
+
+    @patch("enjoliver.schedulerv2.requests.get")
+    @patch("enjoliver.schedulerv2.requests.post")
+    def test_apply_budget_refused(self, post, get):
+        get.return_value = self.response(200, [])
+        post.return_value = self.response(406, {"roles": ["etcd-member"], "count": "all"})
+        sch = schedulerv2.EtcdMemberKubernetesControlPlane(self.api_uri)
+        self.assertFalse(sch.apply())
@@ -1,6 +1,9 @@
+import hashlib
 import json
 import os
+import tempfile
 from unittest import TestCase
+from unittest.mock import Mock, patch
 
 from enjoliver import sync
 
@@ -167,3 +170,161 @@ class TestConfigSyncSchedules(TestCase):
             },
         ])
         self.assertEqual("S", r)
+
+    @staticmethod
+    def machine(i):
+        return {"mac": "52:54:00:00:00:%02x" % i, "ipv4": "172.20.0.%d" % i, "cidrv4": "172.20.0.%d/19" % i,
+                "gateway": "172.20.0.1", "fqdn": None, "disks": []}
+
+    def fake_api(self, nb_nodes: int):
+        """
+        API with 2 control plane machines and nb_nodes nodes
+        :return: dict of the responses by path, the requests are appended to "calls", the notified generations
+        to "notified"
+        """
+        return {
+            "/fleet-generation": {"fleet-generation": 1},
+            "/scheduler/ip-list/etcd-member": ["172.20.0.2", "172.20.0.1"],
+            "/scheduler/etcd-member&kubernetes-control-plane": [self.machine(2), self.machine(1)],
+            "/scheduler/kubernetes-node": [self.machine(i) for i in range(3, 3 + nb_nodes)],
+            "calls": [],
+            "notified": [],
+        }
+
+    def apply_fleet(self, matchbox_path: str, api: dict, s: sync.ConfigSyncSchedules = None, **kwargs):
+        """
+        Apply a sync against the fake API
+        :return: the ConfigSyncSchedules, to apply again
+        """
+        def get(url):
+            path = url[len(self.api_uri):]
+            api["calls"].append(("GET", path))
+            return Mock(content=json.dumps(api[path]).encode())
+
+        def post(url, data):
+            path = url[len(self.api_uri):]
+            api["calls"].append(("POST", path))
+            if path == "/sync-notify":
+                api["notified"].append(json.loads(data)["generation"])
+            return Mock(content=json.dumps(api["/fleet-generation"]).encode())
+
+        if s is None:
+            for d in ("groups", "profiles", "ignition"):
+                os.mkdir(os.path.join(matchbox_path, d))
+            for v in ("cp", "node"):
+                with open(os.path.join(matchbox_path, "ignition", "%s.yaml" % v), "w") as f:
+                    f.write("{}")
+
+        with patch.object(sync.requests, "post", post), patch.object(sync.requests, "get", get):
+            if s is None:
+                s = sync.ConfigSyncSchedules(
+                    api_uri=self.api_uri,
+                    matchbox_path=matchbox_path,
+                    ignition_dict={"etcd_member_kubernetes_control_plane": "cp", "kubernetes_nodes": "node"},
+                    extra_selector_dict=None,
+                    **kwargs
+                )
+            del api["calls"][:]
+            self.assertEqual(2 + len(api["/scheduler/kubernetes-node"]), s.apply())
+        return s
+
+    @staticmethod
+    def read_dir(path: str):
+        content = {}
+        for d in ("groups", "profiles"):
+            for f in sorted(os.listdir(os.path.join(path, d))):
+                with open(os.path.join(path, d, f)) as fd:
+                    content["%s/%s" % (d, f)] = fd.read()
+        return content
+
+    def test_07_one_snapshot_by_apply(self):
+        with tempfile.TemporaryDirectory() as matchbox_path:
+            api = self.fake_api(7)
+            self.apply_fleet(matchbox_path, api)
+            self.assertEqual([
+                ("GET", "/fleet-generation"),
+                ("GET", "/scheduler/ip-list/etcd-member"),
+                ("GET", "/scheduler/etcd-member&kubernetes-control-plane"),
+                ("GET", "/scheduler/kubernetes-node"),
+                ("POST", "/sync-notify"),
+            ], api["calls"])
+
+            with open(os.path.join(matchbox_path, "groups", "kubernetes_nodes-6.json")) as f:
+                metadata = json.load(f)["metadata"]
+            self.assertEqual("172.20.0.1=https://172.20.0.1:%d,172.20.0.2=https://172.20.0.2:%d" % (
+                sync.EC.kubernetes_etcd_peer_port, sync.EC.kubernetes_etcd_peer_port),
+                metadata["kubernetes_etcd_initial_cluster"])
+            self.assertEqual(["172.20.0.1", "172.20.0.2"], metadata["etcd_member_kubernetes_control_plane_ip"])
+            with open(os.path.join(matchbox_path, "groups", "etcd_member_kubernetes_control_plane-0.json")) as f:
+                metadata = json.load(f)["metadata"]
+            self.assertEqual(2, metadata["kubernetes_apiserver_count"])
+            self.assertEqual("172.20.0.1", metadata["etcd_name"])
+
+    def test_08_workers(self):
+        results = []
+        for kwargs in [dict(workers=1), dict(workers=4), dict(workers=2, processes=True)]:
+            with tempfile.TemporaryDirectory() as matchbox_path:
+                api = self.fake_api(20)
+                s = self.apply_fleet(matchbox_path, api, **kwargs)
+                results.append((api["notified"], self.read_dir(matchbox_path)))
+                self.assertIn("total", s.timings)
+        self.assertEqual(22 + 2, len(results[0][1]))
+        for result in results[1:]:
+            self.assertEqual(results[0], result)
+
+    def test_09_incremental(self):
+        with tempfile.TemporaryDirectory() as matchbox_path:
+            api = self.fake_api(5)
+            s = self.apply_fleet(matchbox_path, api)
+            self.assertEqual(7, s._written)
+            content = self.read_dir(matchbox_path)
+
+            # unchanged fleet: one call, nothing rendered
+            with patch.object(sync, "dump_group") as dump_group:
+                self.apply_fleet(matchbox_path, api, s)
+                self.assertEqual(0, dump_group.call_count)
+            self.assertEqual([("POST", "/sync-notify")], api["calls"])
+            self.assertEqual(api["notified"][0], api["notified"][1])
+
+            # one node changed: only its group is written
+            api["/fleet-generation"] = {"fleet-generation": 2}
+            api["/scheduler/kubernetes-node"][2]["disks"] = [{"path": "/dev/sda", "size-bytes": 21474836480}]
+            self.apply_fleet(matchbox_path, api, s)
+            self.assertEqual(1, s._written)
+            changed = self.read_dir(matchbox_path)
+            self.assertEqual(["groups/kubernetes_nodes-2.json"],
+                             [k for k in sorted(content) if content[k] != changed[k]])
+
+            # same generation as a full pass of the changed fleet
+            with tempfile.TemporaryDirectory() as other_path:
+                other = self.fake_api(5)
+                other["/scheduler/kubernetes-node"] = api["/scheduler/kubernetes-node"]
+                self.apply_fleet(other_path, other)
+                self.assertEqual(other["notified"][-1], api["notified"][-1])
+                self.assertEqual(changed, self.read_dir(other_path))
+
+            # the ssh authorized keys are local inputs of the groups
+            os.mkdir(os.path.join(matchbox_path, "ssh_authorized_keys"))
+            with open(os.path.join(matchbox_path, "ssh_authorized_keys", "key.pub"), "w") as f:
+                f.write("ssh-rsa AAAA user@host")
+            self.apply_fleet(matchbox_path, api, s)
+            self.assertEqual(7, s._written)
+
+    def test_10_manifest(self):
+        with tempfile.TemporaryDirectory() as matchbox_path:
+            api = self.fake_api(3)
+            with patch.object(sync.generator.os, "fsync", wraps=os.fsync) as fsync:
+                self.apply_fleet(matchbox_path, api)
+            # the 5 groups, the 2 profiles, the manifest and the 3 directories
+            self.assertEqual(5 + 2 + 1 + 3, fsync.call_count)
+
+            with open(os.path.join(matchbox_path, "generation.json")) as f:
+                manifest = json.load(f)
+            self.assertEqual(api["notified"][-1], manifest["generation"])
+            self.assertEqual(1, manifest["fleet-generation"])
+            self.assertEqual(sorted(self.read_dir(matchbox_path)), sorted(manifest["files"]))
+            for path, digest in manifest["files"].items():
+                with open(os.path.join(matchbox_path, path), "rb") as f:
+                    self.assertEqual(hashlib.sha256(f.read()).hexdigest(), digest)
+                self.assertEqual(0o644, os.stat(os.path.join(matchbox_path, path)).st_mode & 0o777)
+            self.assertEqual([], os.listdir(os.path.join(matchbox_path, ".staging")))
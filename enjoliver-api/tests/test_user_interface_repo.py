@@ -1,6 +1,7 @@
+import threading
 import unittest
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 
 from enjoliver.db import session_commit
@@ -15,7 +16,12 @@ from enjoliver.model import (
     Schedule,
     ScheduleRoles,
 )
-from enjoliver.repositories import user_interface
+from enjoliver import crud
+from enjoliver.repositories import machine_overview, read_models, user_interface
+from enjoliver.repositories.machine_discovery import MachineDiscoveryRepository
+from enjoliver.repositories.machine_schedule import MachineScheduleRepository
+from enjoliver.repositories.machine_state import MachineStateRepository
+from tests.fixtures import posts
 
 
 class TestMachineStateRepo(unittest.TestCase):
@@ -71,6 +77,7 @@ class TestMachineStateRepo(unittest.TestCase):
                 'Roles': ''}
         )
         ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
         self.assertCountEqual(expect, ui.get_machines_overview())
 
     def test_one_machine_full(self):
@@ -107,6 +114,7 @@ class TestMachineStateRepo(unittest.TestCase):
                 'Roles': ''}
         )
         ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
         data = ui.get_machines_overview()
         self.assertCountEqual(expect, data)
 
@@ -147,6 +155,7 @@ class TestMachineStateRepo(unittest.TestCase):
                 'Roles': ScheduleRoles.kubernetes_control_plane}
         )
         ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
         data = ui.get_machines_overview()
         self.assertCountEqual(expect, data)
 
@@ -190,6 +199,7 @@ class TestMachineStateRepo(unittest.TestCase):
                 'Roles': ScheduleRoles.kubernetes_control_plane}
         )
         ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
         data = ui.get_machines_overview()
         self.assertCountEqual(expect, data)
 
@@ -233,5 +243,158 @@ class TestMachineStateRepo(unittest.TestCase):
                 'Roles': ScheduleRoles.kubernetes_control_plane}
         )
         ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
         data = ui.get_machines_overview()
         self.assertCountEqual(expect, data)
+
+    def add_machines(self, nb: int):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for i in range(nb):
+                mac = "00:00:00:00:00:%02x" % i
+                machine = Machine(uuid="b7f5f93a-b029-475f-b3a4-479ba198cb%02x" % i)
+                session.add(machine)
+                session.flush()
+                session.add(
+                    MachineInterface(machine_id=machine.id, mac=mac, netmask=1, ipv4="10.10.10.%d" % i,
+                                     cidrv4="10.10.10.%d/8" % i, as_boot=True, gateway="1.1.1.1", name="lol"))
+                session.add(MachineDisk(path="/dev/sda", size=(i + 1) * 10 * 1024 * 1024 * 1024,
+                                        machine_id=machine.id))
+                session.add(MachineCurrentState(machine_id=machine.id, machine_mac=mac,
+                                                state_name=MachineStates.states[i % len(MachineStates.states)]))
+                if i % 2:
+                    session.add(Schedule(machine_id=machine.id, role=ScheduleRoles.etcd_member))
+                    session.add(Schedule(machine_id=machine.id, role=ScheduleRoles.kubernetes_control_plane))
+            session.commit()
+
+    def test_machines_own_state(self):
+        self.add_machines(3)
+        ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
+        data = ui.get_machines_overview()
+        self.assertEqual(["00:00:00:00:00:00", "00:00:00:00:00:01", "00:00:00:00:00:02"], [r["MAC"] for r in data])
+        self.assertEqual(MachineStates.states[:3], [r["LastState"] for r in data])
+        self.assertEqual(["M", "L", "L"], [r["DiskProfile"] for r in data])
+        self.assertEqual(["", "%s,%s" % (ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane), ""],
+                         [r["Roles"] for r in data])
+
+    def test_pagination_and_sort(self):
+        self.add_machines(5)
+        ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
+        self.assertEqual(["00:00:00:00:00:04", "00:00:00:00:00:03"],
+                         [r["MAC"] for r in ui.get_machines_overview(limit=2, sort="-MAC")])
+        self.assertEqual(["00:00:00:00:00:02", "00:00:00:00:00:01"],
+                         [r["MAC"] for r in ui.get_machines_overview(limit=2, offset=2, sort="-MAC")])
+        self.assertEqual(["10.10.10.0/8"], [r["CIDR"] for r in ui.get_machines_overview(limit=1, sort="CIDR")])
+        self.assertEqual([], ui.get_machines_overview(offset=5))
+        self.assertEqual(["00:00:00:00:00:01", "00:00:00:00:00:03"],
+                         [r["MAC"] for r in ui.get_machines_overview(limit=2, sort="-Roles")])
+        with self.assertRaises(ValueError):
+            ui.get_machines_overview(sort="Unknown")
+
+    def test_delta_limit(self):
+        self.add_machines(5)
+        ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker, delta_overlap=0)
+        _, since = ui.fetch_overview()
+        # one transaction writes the 5 machines
+        ui.rebuild_overview()
+
+        macs = []
+        page = read_models.Page(limit=2)
+        data, next_since = ui.fetch_overview(since=since, page=page)
+        macs.extend(r["MAC"] for r in data)
+        while page.next_after is not None:
+            page = read_models.Page(limit=2, after=page.next_after)
+            data, _ = ui.fetch_overview(since=since, page=page)
+            macs.extend(r["MAC"] for r in data)
+        self.assertEqual(["00:00:00:00:00:%02x" % i for i in range(5)], macs)
+        self.assertEqual(([], next_since), ui.fetch_overview(limit=2, since=next_since))
+        with self.assertRaises(ValueError):
+            ui.fetch_overview(since=since, sort="MAC")
+
+    def test_delta_overlap(self):
+        self.add_machines(2)
+        ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker, delta_overlap=60)
+        ui.rebuild_overview()
+        with session_commit(sess_maker=self.sess_maker) as session:
+            first, second = [m.id for m in session.query(Machine).order_by(Machine.id)]
+        since = 0
+
+        def update(machine_id):
+            with session_commit(sess_maker=self.sess_maker) as s:
+                machine_overview.update(s, machine_id, last_state=MachineStates.discovery)
+
+        session = self.sess_maker()
+        try:
+            machine_overview.update(session, first, last_state=MachineStates.discovery)
+            # the second one takes a greater revision and commits first
+            other = threading.Thread(target=update, args=(second,))
+            other.start()
+            other.join(5)
+            self.assertFalse(other.is_alive())
+            data, since = ui.fetch_overview(since=since)
+            self.assertEqual([(MachineStates.states[0], "00:00:00:00:00:00"),
+                              (MachineStates.discovery, "00:00:00:00:00:01")],
+                             [(r["LastState"], r["MAC"]) for r in data])
+            self.assertEqual(0, since)
+            session.commit()
+        finally:
+            session.close()
+
+        # the rows of the last minute are sent again
+        data, since = ui.fetch_overview(since=since)
+        self.assertEqual(["00:00:00:00:00:00", "00:00:00:00:00:01"], [r["MAC"] for r in data])
+        self.assertEqual([MachineStates.discovery] * 2, [r["LastState"] for r in data])
+
+        ui.delta_overlap = 0
+        data, since = ui.fetch_overview(since=since)
+        self.assertEqual(2, len(data))
+        self.assertEqual(([], since), ui.fetch_overview(since=since))
+
+    def test_statements_independent_of_fleet_size(self):
+        self.add_machines(20)
+        ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
+        ui.rebuild_overview()
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *a):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            self.assertEqual(20, len(ui.get_machines_overview()))
+        finally:
+            event.remove(self.engine, "before_cursor_execute", before_cursor_execute)
+        # the date of the last refresh and the scan of machine_overview
+        self.assertEqual(2, len(statements))
+
+    def test_incremental_refresh(self):
+        ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker, delta_overlap=0)
+        mac = posts.M01["boot-info"]["mac"]
+        MachineDiscoveryRepository(sess_maker=self.sess_maker).upsert(posts.M01)
+        data, since = ui.fetch_overview()
+        self.assertEqual([mac], [r["MAC"] for r in data])
+        self.assertEqual((None, "", "Disable"), (data[0]["LastState"], data[0]["Roles"], data[0]["UpdateStrategy"]))
+
+        MachineStateRepository(sess_maker=self.sess_maker).update(mac, MachineStates.discovery)
+        data, since = ui.fetch_overview(since=since)
+        self.assertEqual(MachineStates.discovery, data[0]["LastState"])
+        self.assertEqual(([], since), ui.fetch_overview(since=since))
+
+        MachineScheduleRepository(sess_maker=self.sess_maker).create_schedule(
+            {"roles": [ScheduleRoles.kubernetes_node], "selector": {"mac": mac}})
+        data, since = ui.fetch_overview(since=since)
+        self.assertEqual(ScheduleRoles.kubernetes_node, data[0]["Roles"])
+
+        rawq = "mac=%s&uuid=%s&os=installed" % (mac.replace(":", "-"), posts.M01["boot-info"]["uuid"])
+        with session_commit(sess_maker=self.sess_maker) as session:
+            inject = crud.InjectLifecycle(session, rawq)
+            inject.refresh_lifecycle_ignition(True)
+            inject.apply_lifecycle_rolling(True, "reboot")
+        data, since = ui.fetch_overview(since=since)
+        self.assertEqual((True, "reboot"), (data[0]["UpToDate"], data[0]["UpdateStrategy"]))
+
+        MachineDiscoveryRepository(sess_maker=self.sess_maker).upsert(posts.M02)
+        data, since = ui.fetch_overview(since=since)
+        self.assertEqual([posts.M02["boot-info"]["mac"]], [r["MAC"] for r in data])
+        self.assertEqual(2, len(ui.get_machines_overview()))
@@ -5,11 +5,12 @@ import signal
 import sys
 
 import click
-from sqlalchemy import create_engine
+from sqlalchemy import and_, create_engine, func, inspect, select
+from sqlalchemy.orm import sessionmaker
 
 try:
     from enjoliver import configs, gunicorn_conf
-    from enjoliver.model import Base
+    from enjoliver.model import Base, Chassis, ChassisPort, Machine, MachineCurrentState
 except ModuleNotFoundError:
     click.echo('please install enjoliver first: cd enjoliver-api && pip install -e .')
     sys.exit(255)
@@ -28,10 +29,63 @@ def _fs_gunicorn_cleaning(ec):
             os.makedirs(directory)
 
 
+# columns added to the tables of the existing databases, create_all only creates the missing tables
+ADDED_COLUMNS = [
+    Machine.__table__.c.discovery_digest,
+    MachineCurrentState.__table__.c.state_date,
+]
+
+
+def _add_columns(engine):
+    existing = dict()
+    for column in ADDED_COLUMNS:
+        table = column.table.name
+        if engine.dialect.name in ("postgresql", "cockroachdb"):
+            if_not_exists = "IF NOT EXISTS "
+        else:
+            # SQLite has no IF NOT EXISTS clause for the columns
+            if table not in existing:
+                existing[table] = {c["name"] for c in inspect(engine).get_columns(table)}
+            if column.name in existing[table]:
+                continue
+            if_not_exists = ""
+        engine.execute("ALTER TABLE %s ADD COLUMN %s%s %s" % (
+            table, if_not_exists, column.name, column.type.compile(dialect=engine.dialect)))
+        for index in column.table.indexes:
+            if column.name in index.columns:
+                engine.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+                    index.name, table, ", ".join(c.name for c in index.columns)))
+
+
+def _add_chassis_index(engine):
+    """
+    Merge the duplicated chassis into the first one, then add their unique index to the existing databases
+    The duplicated ports of a machine interface are deleted by its next discovery
+    """
+    chassis, port = Chassis.__table__, ChassisPort.__table__
+    with engine.begin() as connection:
+        for first, mac, name in connection.execute(
+                select([func.min(chassis.c.id), chassis.c.mac, chassis.c.name])
+                .group_by(chassis.c.mac, chassis.c.name).having(func.count() > 1)).fetchall():
+            duplicates = [chassis_id for chassis_id, in connection.execute(select([chassis.c.id]).where(
+                and_(chassis.c.mac == mac, chassis.c.name == name, chassis.c.id != first)))]
+            connection.execute(port.update().where(port.c.chassis_id.in_(duplicates)).values(chassis_id=first))
+            connection.execute(chassis.delete().where(chassis.c.id.in_(duplicates)))
+            click.echo("merged %d duplicated chassis %s %s into %d" % (len(duplicates), mac, name, first))
+        connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chassis_mac_name ON chassis (mac, name)")
+
+
 def _init_db(ec):
+    # imports the modules reading the config at import time
+    from enjoliver.repositories.user_interface import UserInterfaceRepository
+
     click.echo("initializing db")
     engine = create_engine(ec.db_uri)
     Base.metadata.create_all(bind=engine)
+    _add_columns(engine)
+    _add_chassis_index(engine)
+    click.echo("refreshing the overview of %d machines" % UserInterfaceRepository(
+        sessionmaker(bind=engine)).rebuild_overview())
 
 
 def _init_journal_dir(ec):